@@ -0,0 +1,89 @@
+'''
+Benchmark of Excel detection, comparing time and peak (Python heap) memory of:
+
+* full - parsing the whole workbook with xlrd, which is how is_excel used to
+  decide
+* header - is_excel's check of the file structure only
+* validate - is_excel's check plus xlrd loading just the first sheet
+
+Give it some large spreadsheets to see the difference. The memory is measured
+with tracemalloc, so only on Python 3 - on Python 2 only the time is given.
+'''
+
+from optparse import OptionParser
+import logging
+import os
+import time
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def full_parse(filepath):
+    import xlrd
+    try:
+        xlrd.open_workbook(filepath)
+    except Exception:
+        return False
+    return True
+
+
+def header_only(filepath, validate=False):
+    from ckanext.qa.sniff_format import SniffContext, is_excel
+    with SniffContext(filepath) as ctx:
+        return is_excel(ctx, validate=validate)
+
+
+def measure(func, *args):
+    '''Returns func's result, the time it took and its peak memory (None if
+    it can't be measured).'''
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    result = func(*args)
+    duration = time.time() - start
+    peak = None
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, duration, peak
+
+
+def benchmark(filepaths):
+    # import before measuring anything
+    import ckanext.qa.sniff_format  # noqa
+
+    print('%-50s %10s %24s %24s %24s' % ('File', 'Size', 'full', 'header', 'validate'))
+    for filepath in filepaths:
+        row = ['%-50s %9.1fM' % (os.path.basename(filepath)[:50],
+                                 os.path.getsize(filepath) / 1e6)]
+        for func, args in ((full_parse, ()),
+                           (header_only, ()),
+                           (header_only, (True,))):
+            result, duration, peak = measure(func, filepath, *args)
+            row.append('%5s %7.3fs %9s' % (
+                result, duration,
+                '%.1fMB' % (peak / 1e6) if peak is not None else 'n/a'))
+        print(' '.join(row))
+
+
+if __name__ == '__main__':
+    usage = """Benchmark Excel detection
+
+    usage: %prog [file ...]
+
+    Defaults to the .xls test data files.
+    """
+    parser = OptionParser(usage=usage)
+    (options, args) = parser.parse_args()
+    if not args:
+        args = [os.path.join(DEFAULT_DATA_DIR, filename)
+                for filename in sorted(os.listdir(DEFAULT_DATA_DIR))
+                if filename.endswith('.xls')]
+
+    logging.basicConfig(level=logging.ERROR)
+    benchmark(args)
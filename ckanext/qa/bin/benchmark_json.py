@@ -0,0 +1,54 @@
+'''
+Micro-benchmark of the JSON detection (get_json_format) on the JSON test data
+files, or other files given.
+
+The prefix size is the amount of each file that is looked at - the same as
+sniff_file_format uses by default.
+'''
+
+from optparse import OptionParser
+import io
+import logging
+import os
+import time
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def benchmark(filepaths, prefix_size, repeats):
+    from ckanext.qa.sniff_format import get_json_format
+
+    print('%-40s %8s %10s  %s' % ('File', 'Chars', 'us/call', 'Result'))
+    for filepath in filepaths:
+        with io.open(filepath, 'r', encoding='ISO-8859-1', newline=None) as f:
+            buf = f.read(prefix_size)
+        start = time.time()
+        for i in range(repeats):
+            result = get_json_format(buf)
+        duration = (time.time() - start) / repeats
+        print('%-40s %8i %10.1f  %s' % (
+              os.path.basename(filepath)[:40], len(buf), duration * 1e6,
+              result['format'] if result else None))
+
+
+if __name__ == '__main__':
+    usage = """Benchmark JSON detection
+
+    usage: %prog [options] [file ...]
+
+    Defaults to the .json and .geojson test data files.
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-s', '--prefix-size', dest='prefix_size', type='int',
+                      default=10000, help='characters of each file to look at')
+    parser.add_option('-n', '--repeats', dest='repeats', type='int',
+                      default=1000, help='times to run the detection on each file')
+    (options, args) = parser.parse_args()
+    if not args:
+        args = [os.path.join(DEFAULT_DATA_DIR, filename)
+                for filename in sorted(os.listdir(DEFAULT_DATA_DIR))
+                if filename.endswith(('.json', '.geojson'))]
+
+    # The detection logs every file it looks at
+    logging.basicConfig(level=logging.ERROR)
+    benchmark(args, options.prefix_size, options.repeats)
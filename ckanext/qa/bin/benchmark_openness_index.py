@@ -0,0 +1,209 @@
+'''
+Benchmark of the openness index report (reports.openness_index), which gets
+the openness scores of all the datasets with one GROUP BY query, compared with
+the loop it replaced, which called qa_package_openness_show for each dataset
+of each organization.
+
+It generates a catalogue in the database given by the ckan.ini (by default 100
+organizations and 50,000 datasets, each with a couple of resources and their
+QA), runs both and checks they give the same report. The generated rows are
+named 'qabench-...' and are deleted at the end, unless you give --keep.
+
+With --combinations it instead compares generating the report for each of
+its option combinations (the index and every organization, with and without
+sub-organizations) one by one, with generating them all in one pass, as when
+ckanext-report refreshes its cache.
+
+Run it against a test database, not a live site.
+'''
+
+from optparse import OptionParser
+from collections import Counter
+import datetime
+import json
+import logging
+import random
+import time
+import uuid
+
+# NB put no CKAN imports here, or logging breaks
+
+PREFIX = 'qabench-'
+
+
+def load_config(config_ini):
+    from ckan.cli import load_config as ckan_load_config
+    from ckan.config.environment import load_environment
+    load_environment(ckan_load_config(config_ini))
+
+
+def generate(num_orgs, num_packages, seed=0):
+    from ckan import model
+    from ckanext.qa.model import QA
+
+    rand = random.Random(seed)
+    now = datetime.datetime.now()
+    orgs = [{'id': str(uuid.uuid4()), 'name': '%sorg-%03i' % (PREFIX, i),
+             'title': 'Benchmark organization %i' % i,
+             'type': 'organization', 'is_organization': True,
+             'state': 'active', 'approval_status': 'approved',
+             'created': now}
+            for i in range(num_orgs)]
+    model.Session.bulk_insert_mappings(model.Group, orgs)
+    packages, resources, qas = [], [], []
+    for i in range(num_packages):
+        package_id = str(uuid.uuid4())
+        packages.append({
+            'id': package_id, 'name': '%sdataset-%06i' % (PREFIX, i),
+            'title': 'Benchmark dataset %i' % i, 'type': 'dataset',
+            'owner_org': rand.choice(orgs)['id'], 'private': False,
+            'state': 'deleted' if rand.random() < 0.02 else 'active',
+            'metadata_created': now, 'metadata_modified': now})
+        for position in range(rand.randint(0, 3)):
+            resource_id = str(uuid.uuid4())
+            resources.append({
+                'id': resource_id, 'package_id': package_id,
+                'url': 'http://example.com/%i/%i.csv' % (i, position),
+                'position': position, 'created': now,
+                'state': 'deleted' if rand.random() < 0.05 else 'active'})
+            if rand.random() < 0.9:
+                score = rand.randint(0, 5)
+                qas.append({
+                    'id': str(uuid.uuid4()), 'package_id': package_id,
+                    'resource_id': resource_id, 'openness_score': score,
+                    'openness_score_reason': 'Benchmark score %i' % score,
+                    'format': 'CSV', 'created': now, 'updated': now})
+    model.Session.bulk_insert_mappings(model.Package, packages)
+    model.Session.bulk_insert_mappings(model.Resource, resources)
+    model.Session.bulk_insert_mappings(QA, qas)
+    model.Session.commit()
+    print('Generated %i organizations, %i datasets, %i resources, %i QA' % (
+          len(orgs), len(packages), len(resources), len(qas)))
+
+
+def delete_generated():
+    from ckan import model
+    from ckanext.qa.model import QA
+
+    package_ids = model.Session.query(model.Package.id) \
+        .filter(model.Package.name.like(PREFIX + '%'))
+    model.Session.query(QA) \
+        .filter(QA.package_id.in_(package_ids)) \
+        .delete(synchronize_session=False)
+    model.Session.query(model.Resource) \
+        .filter(model.Resource.package_id.in_(package_ids)) \
+        .delete(synchronize_session=False)
+    model.Session.query(model.Package) \
+        .filter(model.Package.name.like(PREFIX + '%')) \
+        .delete(synchronize_session=False)
+    model.Session.query(model.Group) \
+        .filter(model.Group.name.like(PREFIX + '%')) \
+        .delete(synchronize_session=False)
+    model.Session.commit()
+
+
+def openness_index_per_package():
+    '''The score counts per organization, as openness_index used to get them,
+    with a call to qa_package_openness_show for every dataset.'''
+    from ckan import model
+    import ckan.plugins as p
+
+    context = {'model': model, 'session': model.Session, 'ignore_auth': True}
+    counts = {}
+    orgs = model.Session.query(model.Group) \
+        .filter(model.Group.type == 'organization') \
+        .filter(model.Group.state == 'active').all()
+    for org in orgs:
+        pkgs = model.Session.query(model.Package) \
+                    .filter_by(owner_org=org.id) \
+                    .filter_by(state='active') \
+                    .all()
+        scores = [p.toolkit.get_action('qa_package_openness_show')(
+                  context, {'id': pkg.id})['openness_score']
+                  for pkg in pkgs]
+        counts[org.name] = Counter(scores)
+    return counts
+
+
+def benchmark():
+    from ckanext.qa import reports
+
+    start = time.time()
+    old_counts = openness_index_per_package()
+    old_duration = time.time() - start
+    print('%-12s %8.2fs' % ('per dataset', old_duration))
+
+    start = time.time()
+    report = reports.openness_index()
+    duration = time.time() - start
+    print('%-12s %8.2fs  x%.1f' % ('group by', duration,
+                                   old_duration / duration))
+
+    old_table = dict((org_name, reports.jsonify_counter(score_counts))
+                     for org_name, score_counts in old_counts.items()
+                     if score_counts)
+    new_table = dict((row['organization_name'],
+                      dict((k, v) for k, v in row.items()
+                           if k not in ('organization_title',
+                                        'organization_name', 'total_stars',
+                                        'average_stars')))
+                     for row in report['table'])
+    print('Same results' if old_table == new_table else 'DIFFERENT RESULTS')
+
+
+def benchmark_combinations():
+    '''Compares generating the report for every option combination, one by
+    one, with generating them all in one pass, as when the report cache is
+    refreshed.'''
+    from ckanext.qa import reports
+
+    start = time.time()
+    old_reports = [(option_dict, reports.openness_report(**option_dict))
+                   for option_dict in reports.openness_report_combinations_list()]
+    old_duration = time.time() - start
+    print('%-12s %8.2fs  (%i reports)' % ('one by one', old_duration,
+                                          len(old_reports)))
+
+    start = time.time()
+    new_reports = reports.openness_reports_for_all_combinations()
+    duration = time.time() - start
+    print('%-12s %8.2fs  x%.1f' % ('one pass', duration,
+                                   old_duration / duration))
+    # compare them as ckanext-report caches them, since the order of the score
+    # counts in a row is not significant
+    same = json.loads(json.dumps(old_reports)) == \
+        json.loads(json.dumps(new_reports))
+    print('Same results' if same else 'DIFFERENT RESULTS')
+
+
+if __name__ == '__main__':
+    usage = """Benchmark the openness index report on a generated catalogue
+
+    usage: %prog [options] <ckan.ini>
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-o', '--orgs', dest='num_orgs', type='int',
+                      default=100, help='number of organizations to generate')
+    parser.add_option('-n', '--datasets', dest='num_packages', type='int',
+                      default=50000, help='number of datasets to generate')
+    parser.add_option('-k', '--keep', action='store_true', dest='keep',
+                      help='keep the generated catalogue afterwards')
+    parser.add_option('-c', '--combinations', action='store_true',
+                      dest='combinations',
+                      help='benchmark generating all the option combinations')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments (%i)' % len(args))
+    config_ini = args[0]
+
+    logging.basicConfig(level=logging.WARNING)
+    load_config(config_ini)
+    generate(options.num_orgs, options.num_packages)
+    try:
+        if options.combinations:
+            benchmark_combinations()
+        else:
+            benchmark()
+    finally:
+        if not options.keep:
+            delete_generated()
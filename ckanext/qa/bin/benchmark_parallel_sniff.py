@@ -0,0 +1,98 @@
+'''
+Benchmark of sniffing the files of a large dataset one after another,
+compared with sniffing them in a pool of threads, as update_package does when
+qa.sniff_threads is set.
+
+It makes a synthetic dataset of files (copies of the test data files, by
+default 1000 of them) in a temporary directory. Also checks that the results
+are the same whichever way they are sniffed.
+
+To simulate the archived files being on slower storage (e.g. a network file
+system), give a delay, which is added to the opening of each file.
+'''
+
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
+import io
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def make_files(dir_, num_files):
+    sources = [os.path.join(DEFAULT_DATA_DIR, filename)
+               for filename in sorted(os.listdir(DEFAULT_DATA_DIR))]
+    sources = [filepath for filepath in sources if os.path.isfile(filepath)]
+    filepaths = []
+    for i in range(num_files):
+        source = sources[i % len(sources)]
+        filepath = os.path.join(dir_, '%04i-%s' % (i, os.path.basename(source)))
+        shutil.copyfile(source, filepath)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def add_open_delay(delay):
+    import ckanext.qa.sniff_format
+
+    def open_with_delay(*args, **kwargs):
+        time.sleep(delay)
+        return io.open(*args, **kwargs)
+    ckanext.qa.sniff_format.open = open_with_delay
+
+
+def benchmark(num_files, thread_counts):
+    from ckanext.qa.sniff_format import sniff_file_format
+
+    dir_ = tempfile.mkdtemp()
+    try:
+        filepaths = make_files(dir_, num_files)
+        sniff_file_format(filepaths[0])  # warm up
+
+        start = time.time()
+        sequential_results = [sniff_file_format(filepath)
+                              for filepath in filepaths]
+        sequential_duration = time.time() - start
+        print('%-12s %8.2fs' % ('sequential', sequential_duration))
+
+        for num_threads in thread_counts:
+            start = time.time()
+            pool = ThreadPool(num_threads)
+            try:
+                results = pool.map(sniff_file_format, filepaths)
+            finally:
+                pool.close()
+                pool.join()
+            duration = time.time() - start
+            print('%-12s %8.2fs  x%.1f%s' % (
+                  '%i threads' % num_threads, duration,
+                  sequential_duration / duration,
+                  '' if results == sequential_results else '  DIFFERENT RESULTS'))
+    finally:
+        shutil.rmtree(dir_)
+
+
+if __name__ == '__main__':
+    usage = """Benchmark sniffing files in a pool of threads
+
+    usage: %prog [options]
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--files', dest='num_files', type='int',
+                      default=1000, help='number of files in the dataset')
+    parser.add_option('-t', '--threads', dest='threads', default='2,4,8',
+                      help='comma-separated numbers of threads to try')
+    parser.add_option('-d', '--delay', dest='delay', type='float', default=0,
+                      help='seconds added to the opening of each file')
+    (options, args) = parser.parse_args()
+
+    # The sniffing logs every file it looks at
+    logging.basicConfig(level=logging.ERROR)
+    if options.delay:
+        add_open_delay(options.delay)
+    benchmark(options.num_files,
+              [int(num_threads) for num_threads in options.threads.split(',')])
@@ -0,0 +1,77 @@
+'''
+Micro-benchmark of QA.as_dict, which serializes the QA columns with a
+serializer made once for the table, compared with CKAN's generic
+dictization.table_dictize that it replaced, which inspects the table on every
+call. after_show does it for every resource of a dataset.
+
+It needs no database - the QA objects are made in memory.
+'''
+
+from optparse import OptionParser
+import datetime
+import logging
+import time
+
+# NB put no CKAN imports here, or logging breaks
+
+
+def make_qa_objs(num_resources):
+    from ckanext.qa.model import QA
+
+    now = datetime.datetime.now()
+    return [QA(id='qa-%i' % i, package_id='package',
+               resource_id='resource-%i' % i,
+               resource_timestamp=None, archival_timestamp=now,
+               openness_score=i % 6,
+               openness_score_reason='Benchmark score %i' % (i % 6),
+               format='CSV', fingerprint='%040x' % i,
+               created=now, updated=now)
+            for i in range(num_resources)]
+
+
+def table_dictize_without_ids(qa):
+    '''The QA dict of a resource, as after_show used to get it.'''
+    from ckan import model
+    from ckan.lib import dictization
+
+    qa_dict = dictization.table_dictize(qa, {'model': model})
+    del qa_dict['id']
+    del qa_dict['package_id']
+    del qa_dict['resource_id']
+    del qa_dict['fingerprint']
+    return qa_dict
+
+
+def benchmark(num_resources, repeats):
+    qa_objs = make_qa_objs(num_resources)
+
+    print('%-20s %10s' % ('', 'us/resource'))
+    results = {}
+    for name, serialize in (
+            ('table_dictize', table_dictize_without_ids),
+            ('as_dict', lambda qa: qa.as_dict(include_ids=False))):
+        start = time.time()
+        for i in range(repeats):
+            results[name] = [serialize(qa) for qa in qa_objs]
+        duration = (time.time() - start) / repeats / num_resources
+        print('%-20s %10.2f' % (name, duration * 1e6))
+    print('Same results' if results['table_dictize'] == results['as_dict']
+          else 'DIFFERENT RESULTS')
+
+
+if __name__ == '__main__':
+    usage = """Benchmark serializing QA objects
+
+    usage: %prog [options]
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-r', '--resources', dest='num_resources', type='int',
+                      default=5000, help='number of resources (QA objects)')
+    parser.add_option('-n', '--repeats', dest='repeats', type='int',
+                      default=20, help='times to serialize them all')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments: %s' % ' '.join(args))
+
+    logging.basicConfig(level=logging.WARNING)
+    benchmark(options.num_resources, options.repeats)
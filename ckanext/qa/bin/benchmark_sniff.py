@@ -0,0 +1,71 @@
+'''
+Benchmark of sniff_file_format, comparing detection throughput with the file
+signature fast path on and off (i.e. always running libmagic).
+
+Also checks that both give the same result for every file.
+'''
+
+from optparse import OptionParser
+import logging
+import os
+import time
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def get_filepaths(dirs):
+    filepaths = []
+    for dir_ in dirs:
+        for filename in sorted(os.listdir(dir_)):
+            filepath = os.path.join(dir_, filename)
+            if os.path.isfile(filepath):
+                filepaths.append(filepath)
+    return filepaths
+
+
+def benchmark(filepaths, repeats):
+    from ckanext.qa.sniff_format import sniff_file_format, \
+        get_mime_type_from_signature, SIGNATURE_SIZE
+
+    num_signature_matches = 0
+    for filepath in filepaths:
+        with open(filepath, 'rb') as f:
+            if get_mime_type_from_signature(f.read(SIGNATURE_SIZE)):
+                num_signature_matches += 1
+    print('%i files, %i identified by signature' %
+          (len(filepaths), num_signature_matches))
+
+    results = {}
+    for use_signatures in (False, True):
+        start = time.time()
+        for i in range(repeats):
+            for filepath in filepaths:
+                results[(use_signatures, filepath)] = \
+                    sniff_file_format(filepath, use_signatures=use_signatures)
+        duration = time.time() - start
+        print('Signatures %s: %.3fs  %.1f files/s' % (
+              'on ' if use_signatures else 'off', duration,
+              len(filepaths) * repeats / duration))
+
+    for filepath in filepaths:
+        if results[(False, filepath)] != results[(True, filepath)]:
+            print('DIFFERENT RESULT: %s %r %r' % (
+                filepath, results[(False, filepath)],
+                results[(True, filepath)]))
+
+
+if __name__ == '__main__':
+    usage = """Benchmark the sniffing of file formats
+
+    usage: %prog [options] [directory ...]
+
+    Defaults to the directory of test data files.
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--repeats', dest='repeats', type='int',
+                      default=5, help='times to sniff each file')
+    (options, args) = parser.parse_args()
+
+    # The sniffing logs every file it looks at
+    logging.basicConfig(level=logging.ERROR)
+    benchmark(get_filepaths(args or [DEFAULT_DATA_DIR]), options.repeats)
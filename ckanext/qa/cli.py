@@ -22,7 +22,8 @@ def qa():
 
         ckan -c <path to CKAN config file> qa [options] update [dataset/group name/id]
            - QA analysis on all resources in a given dataset, or on all
-           datasets if no dataset given
+           datasets if no dataset given. With --incremental, resources
+           that are unchanged since they were last scored are skipped
 
         ckan -c <path to CKAN config file> qa sniff {filepath}
            - Opens the file and determines its type by the contents
@@ -30,6 +31,14 @@ def qa():
         ckan -c <path to CKAN config file> qa view [dataset name/id]
            - See package score information
 
+        ckan -c <path to CKAN config file> qa slowest [--limit N] [--clear]
+           - Lists the resources that were slowest to score (when
+           qa.slowest_size is set)
+
+        ckan -c <path to CKAN config file> qa rebuild-package-qa
+           - Recalculates the QA of every dataset (the qa_package table)
+           from the QA of its resources
+
         ckan -c <path to CKAN config file> qa clean
            - Remove all package score information
 
@@ -55,8 +64,10 @@ def init():
 @qa.command()
 @click.argument('ids', nargs=-1)
 @click.option('-q', '--queue', help='Send to a particular queue')
-def update(ids, queue):
-    utils.update(ids, queue)
+@click.option('--incremental', is_flag=True,
+              help='Skip resources that are unchanged since they were last scored')
+def update(ids, queue, incremental):
+    utils.update(ids, queue, incremental)
 
 
 @qa.command()
@@ -75,6 +86,19 @@ def view(package_ref=None):
     utils.view(package_ref)
 
 
+@qa.command()
+@click.option('--limit', default=20, help='Number of resources to list')
+@click.option('--clear', is_flag=True,
+              help='Clear the list of slowest resources')
+def slowest(limit, clear):
+    utils.slowest(limit, clear)
+
+
+@qa.command('rebuild-package-qa')
+def rebuild_package_qa():
+    utils.rebuild_package_qa()
+
+
 @qa.command()
 def clean():
     utils.clean()
@@ -1,7 +1,8 @@
 import logging
 import sys
 import ckan.plugins as p
-from ckanext.qa.utils import init_db, update, sniff, view, clean, migrate1
+from ckanext.qa.utils import init_db, update, sniff, view, slowest, \
+    rebuild_package_qa, clean, migrate1
 
 REQUESTS_HEADER = {'content-type': 'application/json',
                    'User-Agent': 'ckanext-qa commands'}
@@ -23,7 +24,8 @@ class QACommand(p.toolkit.CkanCommand):
 
         paster qa [options] update [dataset/group name/id]
            - QA analysis on all resources in a given dataset, or on all
-           datasets if no dataset given
+           datasets if no dataset given. With --incremental, resources
+           that are unchanged since they were last scored are skipped
 
         paster qa sniff {filepath}
            - Opens the file and determines its type by the contents
@@ -31,6 +33,14 @@ class QACommand(p.toolkit.CkanCommand):
         paster qa view [dataset name/id]
            - See package score information
 
+        paster qa slowest [--limit N] [--clear]
+           - Lists the resources that were slowest to score (when
+           qa.slowest_size is set)
+
+        paster qa rebuild-package-qa
+           - Recalculates the QA of every dataset (the qa_package table)
+           from the QA of its resources
+
         paster qa clean
            - Remove all package score information
 
@@ -57,6 +67,23 @@ class QACommand(p.toolkit.CkanCommand):
                                action='store',
                                dest='queue',
                                help='Send to a particular queue')
+        self.parser.add_option('--limit',
+                               action='store',
+                               dest='limit',
+                               type='int',
+                               default=20,
+                               help='Number of resources to list')
+        self.parser.add_option('--clear',
+                               action='store_true',
+                               dest='clear',
+                               default=False,
+                               help='Clear the list of slowest resources')
+        self.parser.add_option('--incremental',
+                               action='store_true',
+                               dest='incremental',
+                               default=False,
+                               help='Skip resources that are unchanged since '
+                               'they were last scored')
 
     def command(self):
         """
@@ -82,6 +109,10 @@ class QACommand(p.toolkit.CkanCommand):
                 self.view(self.args[1])
             else:
                 self.view()
+        elif cmd == 'slowest':
+            self.slowest()
+        elif cmd == 'rebuild-package-qa':
+            self.rebuild_package_qa()
         elif cmd == 'clean':
             self.clean()
         elif cmd == 'migrate1':
@@ -97,7 +128,7 @@ class QACommand(p.toolkit.CkanCommand):
     def update(self):
         if len(self.args) > 1:
             ids = self.args[1:]
-        update(ids, self.options.queue)
+        update(ids, self.options.queue, self.options.incremental)
 
     def sniff(self):
         if len(self.args) < 2:
@@ -108,6 +139,12 @@ class QACommand(p.toolkit.CkanCommand):
     def view(self, package_ref=None):
         view(package_ref)
 
+    def slowest(self):
+        slowest(self.options.limit, self.options.clear)
+
+    def rebuild_package_qa(self):
+        rebuild_package_qa()
+
     def clean(self):
         clean()
 
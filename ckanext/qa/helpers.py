@@ -29,3 +29,24 @@ def qa_openness_stars_dataset_html(dataset):
     return tk.literal(
         tk.render('qa/openness_stars_brief.html',
                   extra_vars=extra_vars))
+
+
+def qa_search(fq='', facet_field='qa_openness_score', include_private=False):
+    '''Returns the number of datasets with each value of a QA field in the
+    search index (see plugin.qa_index_fields) - by default the openness score -
+    among the datasets matching a filter query. It is a single facet query.
+
+    e.g. the openness of an organization's datasets:
+    >>> qa_search('owner_org:"%s"' % org_id)
+    {'3': 10, '5': 2}
+    or the organizations with datasets of 3 stars or more:
+    >>> qa_search('qa_openness_score:[3 TO 5]', facet_field='owner_org')
+    '''
+    search_results = tk.get_action('package_search')({}, {
+        'fq': fq,
+        'rows': 0,
+        'facet.field': [facet_field],
+        'facet.limit': -1,
+        'include_private': include_private,
+        })
+    return search_results['facets'].get(facet_field, {})
@@ -5,14 +5,14 @@ import logging
 from ckan.plugins.toolkit import config
 
 from ckan import plugins as p
-from ckanext.qa.tasks import update_package, update
+from ckanext.qa.tasks import update_package, update, flush_search_index
 
 log = logging.getLogger(__name__)
 
 _RESOURCE_FORMAT_SCORES = None
 
 
-def compat_enqueue(name, fn, queue, args=None):
+def compat_enqueue(name, fn, queue, args=None, kwargs=None):
 
     u'''
     Enqueue a background job using Celery or RQ.
@@ -20,12 +20,13 @@ def compat_enqueue(name, fn, queue, args=None):
     try:
         # Try to use RQ
         from ckan.plugins.toolkit import enqueue_job
-        enqueue_job(fn, args=args, queue=queue)
+        enqueue_job(fn, args=args, kwargs=kwargs, queue=queue)
     except ImportError:
         # Fallback to Celery
         import uuid
         from ckan.lib.celery_app import celery
-        celery.send_task(name, args=args + [queue], task_id=str(uuid.uuid4()))
+        celery.send_task(name, args=args + [queue], kwargs=kwargs,
+                         task_id=str(uuid.uuid4()))
 
 
 def resource_format_scores():
@@ -84,13 +85,19 @@ def munge_format_to_be_canonical(format_name):
     return re.sub('[^a-z/+]', '', format_name)
 
 
-def create_qa_update_package_task(package, queue):
+def create_qa_update_package_task(package, queue, incremental=False):
 
-    compat_enqueue('qa.update_package', update_package, queue,  args=[package.id])
+    compat_enqueue('qa.update_package', update_package, queue,  args=[package.id],
+                   kwargs={'incremental': True} if incremental else None)
     log.debug('QA of package put into celery queue %s: %s',
               queue, package.name)
 
 
+def create_qa_flush_search_index_task(queue):
+    compat_enqueue('qa.flush_search_index', flush_search_index, queue, args=[])
+    log.debug('Flush of the reindex buffer put into queue %s', queue)
+
+
 def create_qa_update_task(resource, queue):
     if p.toolkit.check_ckan_version(max_version='2.2.99'):
         package = resource.resource_group.package
@@ -1,8 +1,11 @@
 import logging
+from collections import OrderedDict
+
+import six
 
 import ckan.plugins as p
 from ckanext.archiver.model import Archival
-from ckanext.qa.model import QA, aggregate_qa_for_a_dataset
+from ckanext.qa.model import QA, PackageQA, aggregate_qa_for_a_dataset
 
 log = logging.getLogger(__name__)
 _ = p.toolkit._
@@ -25,17 +28,66 @@ def qa_resource_show(context, data_dict):
 
     archival = Archival.get_for_resource(res_id)
     qa = QA.get_for_resource(res_id)
-    pkg = res.resource_group.package
+    if p.toolkit.check_ckan_version(max_version='2.2.99'):
+        pkg = res.resource_group.package
+    else:
+        pkg = res.package
+    return resource_qa_dict(res, pkg, archival, qa)
+
+
+def resource_qa_dict(res, pkg, archival, qa):
+    '''Returns the dict that qa_resource_show gives for a resource.'''
     return_dict = {
         'name': pkg.name,
         'title': pkg.title,
         'id': res.id
         }
-    return_dict['archival'] = archival.as_dict()
-    return_dict.update(qa.as_dict())
+    return_dict['archival'] = archival.as_dict() if archival else None
+    if qa:
+        return_dict.update(qa.as_dict())
     return return_dict
 
 
+@p.toolkit.side_effect_free
+def qa_resource_show_many(context, data_dict):
+    '''
+    Returns the QA and Archival information for several resources at once,
+    each as qa_resource_show gives it.
+
+    :param ids: the resource ids (a list, or comma-separated), at most
+                qa.show_many_limit of them (by default 1000)
+
+    :returns: {'results': {resource_id: qa_resource_show dict, ...},
+               'not_found': [resource_id, ...]}
+    '''
+    model = context['model']
+    session = context['session']
+    p.toolkit.check_access('qa_resource_show_many', context, data_dict)
+
+    res_ids = _get_ids(data_dict)
+    if p.toolkit.check_ckan_version(max_version='2.2.99'):
+        res_and_pkgs = session.query(model.Resource, model.Package) \
+            .join(model.ResourceGroup) \
+            .join(model.Package)
+    else:
+        res_and_pkgs = session.query(model.Resource, model.Package) \
+            .join(model.Package, model.Resource.package_id == model.Package.id)
+    res_and_pkgs = res_and_pkgs.filter(model.Resource.id.in_(res_ids)).all()
+    archivals = dict((archival.resource_id, archival) for archival in
+                     session.query(Archival)
+                     .filter(Archival.resource_id.in_(res_ids)))
+    qas = dict((qa.resource_id, qa) for qa in
+               session.query(QA).filter(QA.resource_id.in_(res_ids)))
+
+    results = {}
+    for res, pkg in res_and_pkgs:
+        results[res.id] = resource_qa_dict(
+            res, pkg, archivals.get(res.id), qas.get(res.id))
+    return {'results': results,
+            'not_found': [res_id for res_id in res_ids
+                          if res_id not in results]}
+
+
 @p.toolkit.side_effect_free
 def qa_package_openness_show(context, data_dict):
     '''
@@ -51,6 +103,63 @@ def qa_package_openness_show(context, data_dict):
     if not dataset:
         raise p.toolkit.ObjectNotFound
 
-    qa_objs = QA.get_for_package(dataset.id)
-    qa_dict = aggregate_qa_for_a_dataset(qa_objs)
-    return qa_dict
+    package_qa = PackageQA.get(dataset.id)
+    if not package_qa:
+        return aggregate_qa_for_a_dataset([])
+    return package_qa.as_dict()
+
+
+@p.toolkit.side_effect_free
+def qa_package_openness_show_many(context, data_dict):
+    '''
+    Returns the QA score for several packages at once, each as
+    qa_package_openness_show gives it.
+
+    :param ids: the package ids (a list, or comma-separated), at most
+                qa.show_many_limit of them (by default 1000)
+
+    :returns: {'results': {package_id: qa_package_openness_show dict, ...},
+               'not_found': [package_id, ...]}
+    '''
+    model = context['model']
+    session = context['session']
+    p.toolkit.check_access('qa_package_openness_show_many', context, data_dict)
+
+    dataset_ids = _get_ids(data_dict)
+    found_ids = [dataset_id for (dataset_id, ) in
+                 session.query(model.Package.id)
+                 .filter(model.Package.id.in_(dataset_ids))]
+    package_qas = dict((package_qa.package_id, package_qa) for package_qa in
+                       session.query(PackageQA)
+                       .filter(PackageQA.package_id.in_(found_ids)))
+
+    results = {}
+    for dataset_id in found_ids:
+        package_qa = package_qas.get(dataset_id)
+        results[dataset_id] = package_qa.as_dict() if package_qa \
+            else aggregate_qa_for_a_dataset([])
+    return {'results': results,
+            'not_found': [dataset_id for dataset_id in dataset_ids
+                          if dataset_id not in results]}
+
+
+def get_show_many_limit():
+    return int(p.toolkit.config.get('qa.show_many_limit', 1000))
+
+
+def _get_ids(data_dict):
+    '''Returns the ids requested of a *_show_many action, without
+    duplicates.'''
+    ids = p.toolkit.get_or_bust(data_dict, 'ids')
+    if isinstance(ids, six.string_types):
+        ids = [id_.strip() for id_ in ids.split(',') if id_.strip()]
+    if not isinstance(ids, list) or \
+            not all(isinstance(id_, six.string_types) for id_ in ids):
+        raise p.toolkit.ValidationError(
+            {'ids': [_('Must be a list of ids')]})
+    ids = list(OrderedDict.fromkeys(ids))
+    limit = get_show_many_limit()
+    if len(ids) > limit:
+        raise p.toolkit.ValidationError(
+            {'ids': [_('No more than %i ids may be given') % limit]})
+    return ids
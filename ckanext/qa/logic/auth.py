@@ -4,3 +4,11 @@ def qa_resource_show(context, data_dict):
 
 def qa_package_openness_show(context, data_dict):
     return {'success': True}
+
+
+def qa_resource_show_many(context, data_dict):
+    return {'success': True}
+
+
+def qa_package_openness_show_many(context, data_dict):
+    return {'success': True}
@@ -1,3 +1,5 @@
+import json
+import operator
 import sys
 import uuid
 import datetime
@@ -5,10 +7,11 @@ import six
 
 from sqlalchemy import Column
 from sqlalchemy import types
+from sqlalchemy import inspect
+from sqlalchemy import text
 from sqlalchemy.ext.declarative import declarative_base
 
 import ckan.model as model
-from ckan.lib import dictization
 from ckan.plugins import toolkit
 
 log = __import__('logging').getLogger(__name__)
@@ -33,29 +36,51 @@ class QA(Base):
 
     id = Column(types.UnicodeText, primary_key=True, default=make_uuid)
     package_id = Column(types.UnicodeText, nullable=False, index=True)
-    resource_id = Column(types.UnicodeText, nullable=False, index=True)
+    resource_id = Column(types.UnicodeText, nullable=False, index=True,
+                         unique=True)
     resource_timestamp = Column(types.DateTime)  # key to resource_revision
     archival_timestamp = Column(types.DateTime)
 
     openness_score = Column(types.Integer)
     openness_score_reason = Column(types.UnicodeText)
     format = Column(types.UnicodeText)
+    # digest of what the result depends on - see tasks.resource_fingerprint()
+    fingerprint = Column(types.UnicodeText)
 
     created = Column(types.DateTime, default=datetime.datetime.now)
     updated = Column(types.DateTime, default=datetime.datetime.now)
 
     def __repr__(self):
+        # NB no queries, so it is cheap to log. For the dataset's name, use
+        # with_package_name()
+        return self._repr(self.package_id)
+
+    def _repr(self, package_ref):
         summary = 'score=%s format=%s' % (self.openness_score, self.format)
         details = six.text_type(self.openness_score_reason).encode('unicode_escape')
-        package = model.Package.get(self.package_id)
-        package_name = package.name if package else '?%s?' % self.package_id
         return '<QA %s /dataset/%s/resource/%s %s>' % \
-            (summary, package_name, self.resource_id, details)
+            (summary, package_ref, self.resource_id, details)
 
-    def as_dict(self):
-        context = {'model': model}
-        qa_dict = dictization.table_dictize(self, context)
-        return qa_dict
+    def with_package_name(self):
+        '''Returns an object that formats as the repr, but with the dataset's
+        name. The name is only looked up when it is formatted, so in a log
+        call, only if the message is logged:
+
+        log.debug('QA: %s', qa.with_package_name())
+        '''
+        return _QAWithPackageName(self)
+
+    def as_dict(self, include_ids=True):
+        '''Returns the QA as a dict of its columns (except the internal
+        fingerprint), the same as dictization.table_dictize would (dates as ISO
+        strings), but quicker.
+
+        :param include_ids: set to False to leave out id, package_id and
+                            resource_id (as in a package_dict)
+        '''
+        if include_ids:
+            return _qa_to_dict(self)
+        return _qa_to_dict_without_ids(self)
 
     @classmethod
     def get_for_resource(cls, resource_id):
@@ -74,6 +99,22 @@ class QA(Base):
             .filter(model.Resource.state == 'active') \
             .all()
 
+    @classmethod
+    def get_for_packages(cls, package_ids):
+        '''Returns the QA for each of the given packages (like
+        get_for_package), in one query, as a dict of lists keyed by
+        package_id. Packages without any QA are not in the dict.'''
+        qa_objs_by_package = {}
+        if not package_ids:
+            return qa_objs_by_package
+        qa_objs = model.Session.query(cls) \
+            .filter(cls.package_id.in_(package_ids)) \
+            .join(model.Resource, cls.resource_id == model.Resource.id) \
+            .filter(model.Resource.state == 'active')
+        for qa in qa_objs:
+            qa_objs_by_package.setdefault(qa.package_id, []).append(qa)
+        return qa_objs_by_package
+
     @classmethod
     def create(cls, resource_id):
         c = cls()
@@ -91,6 +132,258 @@ class QA(Base):
         c.package_id = result[0]
         return c
 
+    @classmethod
+    def upsert(cls, rows):
+        '''Saves QA results, inserting or updating the row for each
+        resource_id as necessary.
+
+        :param rows: list of dicts of column values, all with the same keys,
+                     including resource_id and package_id
+
+        On PostgreSQL it is done in one INSERT ... ON CONFLICT statement, so
+        is safe against concurrent writers. Other databases (i.e. SQLite, in
+        tests) fall back to doing it row by row. The caller should commit.
+        '''
+        if not rows:
+            return
+        if model.Session.get_bind().dialect.name != 'postgresql':
+            for row in rows:
+                qa = cls.get_for_resource(row['resource_id'])
+                if not qa:
+                    qa = cls()
+                    model.Session.add(qa)
+                for key, value in row.items():
+                    setattr(qa, key, value)
+            model.Session.flush()
+            return
+
+        from sqlalchemy.dialects.postgresql import insert
+        now = datetime.datetime.now()
+        insert_rows = []
+        for row in rows:
+            insert_row = {'id': make_uuid(), 'created': now, 'updated': now}
+            insert_row.update(row)
+            insert_rows.append(insert_row)
+        statement = insert(cls.__table__).values(insert_rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.__table__.c.resource_id],
+            set_=dict((key, statement.excluded[key])
+                      for key in insert_rows[0]
+                      if key not in ('id', 'created', 'resource_id')))
+        model.Session.execute(statement)
+        expire_in_session(cls, 'resource_id',
+                          [row['resource_id'] for row in rows])
+
+
+class _QAWithPackageName(object):
+    def __init__(self, qa):
+        self.qa = qa
+
+    def __repr__(self):
+        package = model.Package.get(self.qa.package_id)
+        package_name = package.name if package else '?%s?' % self.qa.package_id
+        return self.qa._repr(package_name)
+
+    __str__ = __repr__
+
+
+def make_serializer(table, exclude=()):
+    '''Returns a function that returns an object of the table as a dict of its
+    columns, the same as dictization.table_dictize does. The columns, and how
+    to convert each, are worked out here once, rather than on every call.
+
+    It only handles the column types used in this module: text and integers
+    are returned as they are, and datetimes as ISO strings.'''
+    columns = [column for column in table.columns
+               if column.name not in exclude]
+    names = tuple(column.name for column in columns)
+    datetime_names = tuple(column.name for column in columns
+                           if isinstance(column.type, types.DateTime))
+    get_values = operator.attrgetter(*names)
+
+    def serialize(obj):
+        state = obj.__dict__
+        try:
+            # loaded values are in the instance's __dict__, which is much
+            # quicker than going through SQLAlchemy's attributes
+            values = [state[name] for name in names]
+        except KeyError:
+            # not all loaded (e.g. expired), so the attributes load them
+            values = get_values(obj)
+        obj_dict = dict(zip(names, values))
+        for name in datetime_names:
+            value = obj_dict[name]
+            if value is not None:
+                obj_dict[name] = value.isoformat()
+        return obj_dict
+    return serialize
+
+
+# the fingerprint is internal to incremental QA, so is not shown
+_qa_to_dict = make_serializer(QA.__table__, exclude=('fingerprint',))
+_qa_to_dict_without_ids = make_serializer(
+    QA.__table__, exclude=('id', 'package_id', 'resource_id', 'fingerprint'))
+
+
+class PackageQA(Base):
+    """
+    The QA of each dataset, aggregated from the QA of its active resources
+    (see aggregate_qa_for_a_dataset), so that it can be read with one lookup.
+    It is updated in the same transaction as the resources' QA - see
+    update_package_qa().
+    """
+    __tablename__ = 'qa_package'
+
+    package_id = Column(types.UnicodeText, primary_key=True)
+    openness_score = Column(types.Integer, index=True)
+    openness_score_reason = Column(types.UnicodeText)
+    # JSON of the number of resources with each openness_score
+    resource_score_counts = Column(types.UnicodeText)
+    updated = Column(types.DateTime)  # the newest of the resources' QA
+
+    def __repr__(self):
+        return '<PackageQA %s score=%s>' % (self.package_id,
+                                            self.openness_score)
+
+    def as_dict(self):
+        '''Returns the same dict as aggregate_qa_for_a_dataset.'''
+        return {'openness_score': self.openness_score,
+                'openness_score_reason': self.openness_score_reason,
+                'updated': self.updated.isoformat() if self.updated else None,
+                }
+
+    def get_resource_score_counts(self):
+        return json.loads(self.resource_score_counts or '{}')
+
+    @classmethod
+    def get(cls, package_id):
+        return model.Session.query(cls).get(package_id)
+
+    @classmethod
+    def upsert(cls, rows):
+        '''Saves the aggregated QA of packages, inserting or updating the row
+        for each package_id as necessary. Like QA.upsert, the caller should
+        commit.'''
+        if not rows:
+            return
+        if model.Session.get_bind().dialect.name != 'postgresql':
+            for row in rows:
+                package_qa = cls.get(row['package_id'])
+                if not package_qa:
+                    package_qa = cls()
+                    model.Session.add(package_qa)
+                for key, value in row.items():
+                    setattr(package_qa, key, value)
+            model.Session.flush()
+            return
+
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(cls.__table__).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.__table__.c.package_id],
+            set_=dict((key, statement.excluded[key])
+                      for key in rows[0] if key != 'package_id'))
+        model.Session.execute(statement)
+        expire_in_session(cls, 'package_id',
+                          [row['package_id'] for row in rows])
+
+
+def expire_in_session(cls, key, values):
+    '''Expires the objects of the class in the session whose key column has
+    one of the given values, so that they are read again. It is needed after
+    writing their rows with a Core statement (i.e. an upsert), which the ORM
+    doesn't know about. (CKAN's session doesn't expire objects on commit.)'''
+    values = set(values)
+    for obj in list(model.Session.identity_map.values()):
+        if isinstance(obj, cls) and getattr(obj, key) in values:
+            model.Session.expire(obj)
+
+
+def package_qa_row(package_id, qa_objs):
+    '''Returns the column values of the PackageQA for a package, given the
+    QA objects of its active resources.'''
+    qa_dict = aggregate_qa_for_a_dataset(qa_objs)
+    updated = [qa.updated for qa in qa_objs if qa.updated]
+    score_counts = {}
+    for qa in qa_objs:
+        score = six.text_type(qa.openness_score)
+        score_counts[score] = score_counts.get(score, 0) + 1
+    return {'package_id': package_id,
+            'openness_score': qa_dict['openness_score'],
+            'openness_score_reason': qa_dict['openness_score_reason'],
+            'resource_score_counts': json.dumps(score_counts, sort_keys=True),
+            'updated': max(updated) if updated else None,
+            }
+
+
+def _get_qa_objs_by_package(package_ids=None):
+    # NB populate_existing, because QA.upsert may have changed the rows of QA
+    # objects already in the session, and it mustn't aggregate their old
+    # values
+    qa_objs = model.Session.query(QA) \
+        .join(model.Resource, QA.resource_id == model.Resource.id) \
+        .filter(model.Resource.state == 'active') \
+        .populate_existing()
+    if package_ids is not None:
+        qa_objs = qa_objs.filter(QA.package_id.in_(package_ids))
+    qa_objs_by_package = {}
+    for qa in qa_objs:
+        qa_objs_by_package.setdefault(qa.package_id, []).append(qa)
+    return qa_objs_by_package
+
+
+def update_package_qa(package_ids):
+    '''Recalculates the PackageQA of the given packages, from the QA of their
+    active resources. The caller should commit.'''
+    package_ids = list(set(package_ids))
+    if not package_ids:
+        return
+    model.Session.flush()  # CKAN's session doesn't autoflush
+    qa_objs_by_package = _get_qa_objs_by_package(package_ids)
+    PackageQA.upsert([package_qa_row(package_id, qa_objs)
+                      for package_id, qa_objs in qa_objs_by_package.items()])
+    # packages without QA of active resources have no row
+    unscored_package_ids = [package_id for package_id in package_ids
+                            if package_id not in qa_objs_by_package]
+    if unscored_package_ids:
+        model.Session.query(PackageQA) \
+            .filter(PackageQA.package_id.in_(unscored_package_ids)) \
+            .delete(synchronize_session=False)
+
+
+def rebuild_package_qa(batch_size=1000):
+    '''Recalculates the PackageQA of all packages from the QA of their
+    resources. The caller should commit.
+
+    :returns: the number of packages with QA
+    '''
+    model.Session.query(PackageQA).delete(synchronize_session=False)
+    rows = [package_qa_row(package_id, qa_objs)
+            for package_id, qa_objs in _get_qa_objs_by_package().items()]
+    for i in range(0, len(rows), batch_size):
+        PackageQA.upsert(rows[i:i + batch_size])
+    return len(rows)
+
+
+class SniffResult(Base):
+    """
+    Cache of the formats sniffed from archived files, keyed by the file
+    contents. See ckanext.qa.sniff_cache.
+    """
+    __tablename__ = 'qa_sniff_cache'
+
+    key = Column(types.UnicodeText, primary_key=True)
+    detector_version = Column(types.Integer, nullable=False)
+    result = Column(types.UnicodeText)  # JSON of the sniff_file_format result
+
+    created = Column(types.DateTime, default=datetime.datetime.now)
+    last_used = Column(types.DateTime, default=datetime.datetime.now,
+                       index=True)
+
+    def __repr__(self):
+        return '<SniffResult %s v%s %s>' % \
+            (self.key, self.detector_version, self.result)
+
 
 def aggregate_qa_for_a_dataset(qa_objs):
     '''Returns aggregated archival info for a dataset, given the archivals for
@@ -122,5 +415,60 @@ def aggregate_qa_for_a_dataset(qa_objs):
 
 
 def init_tables(engine):
+    with engine.connect() as connection:
+        package_qa_table_existed = engine.dialect.has_table(
+            connection, PackageQA.__tablename__)
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    make_resource_id_unique(engine)
+    if not package_qa_table_existed:
+        # fill it from the QA there is already
+        num_packages = rebuild_package_qa()
+        model.Session.commit()
+        log.info('Filled the qa_package table: %i packages', num_packages)
     log.info('QA database tables are set-up')
+
+
+def add_missing_columns(engine):
+    '''Adds any columns that have been added to the model since the tables
+    were created. (New columns are all nullable, so this is all the migration
+    they need.)'''
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = set(column['name'] for column in
+                               inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            with engine.begin() as connection:
+                connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name,
+                    column.type.compile(dialect=engine.dialect))))
+            log.info('Added column %s.%s', table.name, column.name)
+
+
+def make_resource_id_unique(engine):
+    '''Migrates the qa table from when resource_id was not unique: deletes
+    any duplicate rows for a resource (keeping the most recently updated) and
+    replaces the index on resource_id with a unique one.'''
+    table = QA.__table__
+    indexes = [index for index in inspect(engine).get_indexes(table.name)
+               if index['column_names'] == ['resource_id']]
+    if any(index['unique'] for index in indexes):
+        return
+    with engine.begin() as connection:
+        result = connection.execute(text(
+            'DELETE FROM qa WHERE id IN ('
+            ' SELECT id FROM ('
+            '  SELECT id, row_number() OVER (PARTITION BY resource_id'
+            '   ORDER BY updated DESC NULLS LAST, id) AS row_number'
+            '  FROM qa) AS numbered'
+            ' WHERE row_number > 1)'))
+        if result.rowcount:
+            log.info('Deleted %i duplicate QA rows', result.rowcount)
+        for index in indexes:
+            connection.execute(text('DROP INDEX %s' % index['name']))
+        for index in table.indexes:
+            if [column.name for column in index.columns] == ['resource_id']:
+                index.create(bind=connection)
+    log.info('Made qa.resource_id unique')
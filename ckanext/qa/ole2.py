@@ -0,0 +1,223 @@
+'''
+Reads the OLE2 Compound File Binary format (CFB) used by MS Office 97-2003
+documents (doc, xls, ppt), so that they can be identified without handing the
+file to a subprocess. Only the parts needed to identify the file are read:
+the header, the directory and the SummaryInformation stream.
+
+Ref: [MS-CFB] and [MS-OLEPS] specifications.
+'''
+
+import struct
+
+import logging
+
+log = logging.getLogger(__name__)
+
+SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+# Special sector ids
+MAXREGSECT = 0xFFFFFFFA
+ENDOFCHAIN = 0xFFFFFFFE
+
+# Directory entry object types
+STREAM = 2
+ROOT_STORAGE = 5
+
+# SummaryInformation property ids and types
+PIDSI_CODEPAGE = 0x01
+PIDSI_APPNAME = 0x12
+VT_I2 = 0x02
+VT_LPSTR = 0x1E
+VT_LPWSTR = 0x1F
+
+CODEPAGES = {1200: 'utf-16-le', 65001: 'utf8'}
+
+
+class CompoundDocumentError(Exception):
+    pass
+
+
+class CompoundDocument(object):
+    '''A compound document in a seekable file object.
+
+    e.g.
+    >>> doc = CompoundDocument(open('report.doc', 'rb'))
+    >>> doc.stream_names()
+    ['WordDocument', '\\x05SummaryInformation', '1Table', ...]
+    >>> doc.creating_application()
+    'Microsoft Office Word'
+    '''
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._file.seek(0, 2)
+        self._file_size = self._file.tell()
+        header = self._read(0, 512)
+        if len(header) < 512 or header[:8] != SIGNATURE:
+            raise CompoundDocumentError('Not a compound document')
+        (sector_shift, mini_sector_shift) = struct.unpack('<HH', header[30:34])
+        if not 7 <= sector_shift <= 16 or mini_sector_shift >= sector_shift:
+            raise CompoundDocumentError('Bad sector size')
+        self.sector_size = 1 << sector_shift
+        self.mini_sector_size = 1 << mini_sector_shift
+        (self._first_directory_sector, ) = struct.unpack('<I', header[48:52])
+        (self.mini_stream_cutoff, self._first_mini_fat_sector) = \
+            struct.unpack('<II', header[56:64])
+        (first_difat_sector, num_difat_sectors) = \
+            struct.unpack('<II', header[68:76])
+        self._difat = [sid for sid in struct.unpack('<109I', header[76:512])
+                       if sid <= MAXREGSECT]
+        # the DIFAT continues in a chain of sectors
+        sid = first_difat_sector
+        ids_per_sector = self.sector_size // 4
+        for i in range(num_difat_sectors):
+            if sid > MAXREGSECT:
+                break
+            ids = struct.unpack('<%iI' % ids_per_sector, self._read_sector(sid))
+            self._difat.extend(id_ for id_ in ids[:-1] if id_ <= MAXREGSECT)
+            sid = ids[-1]
+        self._fat_sectors = {}  # fat sector index: list of sector ids
+        self._directory = None
+        self._mini_stream = None
+
+    def _read(self, offset, size):
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    def _read_sector(self, sid):
+        data = self._read((sid + 1) * self.sector_size, self.sector_size)
+        if len(data) < self.sector_size:
+            raise CompoundDocumentError('Sector beyond the end of the file')
+        return data
+
+    def _next_sector(self, sid):
+        # Only the FAT sectors needed to follow the chain are read, so the
+        # cost does not grow with the size of the file
+        ids_per_sector = self.sector_size // 4
+        fat_index, position = divmod(sid, ids_per_sector)
+        if fat_index not in self._fat_sectors:
+            if fat_index >= len(self._difat):
+                raise CompoundDocumentError('Sector not in the FAT')
+            self._fat_sectors[fat_index] = struct.unpack(
+                '<%iI' % ids_per_sector,
+                self._read_sector(self._difat[fat_index]))
+        return self._fat_sectors[fat_index][position]
+
+    def _read_chain(self, sid, size=None):
+        sectors = []
+        length = 0
+        # a chain can't be longer than the file, so guard against loops
+        max_sectors = self._file_size // self.sector_size
+        while sid != ENDOFCHAIN and (size is None or length < size):
+            if sid > MAXREGSECT or len(sectors) > max_sectors:
+                raise CompoundDocumentError('Broken sector chain')
+            sectors.append(self._read_sector(sid))
+            length += self.sector_size
+            sid = self._next_sector(sid)
+        data = b''.join(sectors)
+        return data if size is None else data[:size]
+
+    def directory(self):
+        '''Returns the directory entries, as a list of
+        (name, object_type, start_sector, size).'''
+        if self._directory is None:
+            self._directory = []
+            data = self._read_chain(self._first_directory_sector)
+            for offset in range(0, len(data) - 127, 128):
+                entry = data[offset:offset + 128]
+                (name_length, ) = struct.unpack('<H', entry[64:66])
+                (object_type, ) = struct.unpack('<B', entry[66:67])
+                if not object_type or name_length < 2:
+                    continue
+                name = entry[:min(name_length, 64) - 2].decode('utf-16-le', 'replace')
+                (start_sector, size) = struct.unpack('<II', entry[116:124])
+                self._directory.append((name, object_type, start_sector, size))
+        return self._directory
+
+    def stream_names(self):
+        return [entry[0] for entry in self.directory()
+                if entry[1] == STREAM]
+
+    def read_stream(self, name):
+        '''Returns the contents of the named stream, or None if there is no
+        such stream.'''
+        for entry_name, object_type, start_sector, size in self.directory():
+            if entry_name == name and object_type == STREAM:
+                break
+        else:
+            return None
+        if size < self.mini_stream_cutoff:
+            return self._read_mini_chain(start_sector, size)
+        return self._read_chain(start_sector, size)
+
+    def _read_mini_chain(self, sid, size):
+        if self._mini_stream is None:
+            root = [entry for entry in self.directory()
+                    if entry[1] == ROOT_STORAGE]
+            if not root:
+                raise CompoundDocumentError('No root storage')
+            self._mini_stream = self._read_chain(root[0][2], root[0][3])
+            self._mini_fat = self._read_chain(self._first_mini_fat_sector)
+        num_mini_fat_entries = len(self._mini_fat) // 4
+        sectors = []
+        length = 0
+        while sid != ENDOFCHAIN and length < size:
+            if sid >= num_mini_fat_entries or len(sectors) > num_mini_fat_entries:
+                raise CompoundDocumentError('Broken mini sector chain')
+            offset = sid * self.mini_sector_size
+            sectors.append(self._mini_stream[offset:offset + self.mini_sector_size])
+            length += self.mini_sector_size
+            (sid, ) = struct.unpack('<I', self._mini_fat[sid * 4:sid * 4 + 4])
+        return b''.join(sectors)[:size]
+
+    def creating_application(self):
+        '''Returns the "Name of Creating Application" from the
+        SummaryInformation stream, or None if it is not recorded.'''
+        data = self.read_stream(u'\x05SummaryInformation')
+        if not data:
+            return None
+        properties = read_property_set(data, (PIDSI_CODEPAGE, PIDSI_APPNAME))
+        return properties.get(PIDSI_APPNAME)
+
+
+def read_property_set(data, property_ids):
+    '''Returns the values of the given properties (of type code page or
+    string) from the first section of a property set stream, as a dict keyed
+    by property id.'''
+    properties = {}
+    try:
+        (section_offset, ) = struct.unpack('<I', data[44:48])
+        (num_properties, ) = struct.unpack(
+            '<I', data[section_offset + 4:section_offset + 8])
+        for i in range(num_properties):
+            entry_offset = section_offset + 8 + i * 8
+            (property_id, offset) = struct.unpack(
+                '<II', data[entry_offset:entry_offset + 8])
+            if property_id not in property_ids:
+                continue
+            offset += section_offset
+            (value_type, ) = struct.unpack('<H', data[offset:offset + 2])
+            if value_type == VT_I2:
+                (value, ) = struct.unpack('<H', data[offset + 4:offset + 6])
+            elif value_type == VT_LPSTR:
+                # decoded below, once the code page is known
+                (length, ) = struct.unpack('<I', data[offset + 4:offset + 8])
+                value = data[offset + 8:offset + 8 + length]
+            elif value_type == VT_LPWSTR:
+                (length, ) = struct.unpack('<I', data[offset + 4:offset + 8])
+                value = data[offset + 8:offset + 8 + length * 2] \
+                    .decode('utf-16-le', 'replace').rstrip(u'\x00')
+            else:
+                continue
+            properties[property_id] = value
+    except struct.error:
+        log.info('Property set is truncated')
+    codepage = properties.get(PIDSI_CODEPAGE)
+    encoding = CODEPAGES.get(codepage, 'cp%s' % codepage if codepage else 'cp1252')
+    for property_id, value in properties.items():
+        if isinstance(value, bytes):
+            try:
+                value = value.decode(encoding)
+            except (LookupError, UnicodeDecodeError):
+                value = value.decode('ISO-8859-1')
+            properties[property_id] = value.rstrip(u'\x00')
+    return properties
@@ -1,5 +1,8 @@
 import logging
 import os
+from collections import Counter
+
+import six
 
 import ckan.model as model
 import ckan.plugins as p
@@ -7,9 +10,12 @@ from ckan.plugins import toolkit
 
 from ckanext.archiver.interfaces import IPipe
 from ckanext.qa.logic import action, auth
-from ckanext.qa.model import QA, aggregate_qa_for_a_dataset
-from ckanext.qa.helpers import qa_openness_stars_resource_html, qa_openness_stars_dataset_html
+from ckanext.qa.model import QA, aggregate_qa_for_a_dataset, update_package_qa
+from ckanext.qa.helpers import qa_openness_stars_resource_html, qa_openness_stars_dataset_html, \
+    qa_search
 from ckanext.qa.lib import create_qa_update_package_task
+from ckanext.qa import reindex
+from ckanext.qa import show_cache
 from ckanext.report.interfaces import IReport
 from ckan.lib.plugins import DefaultTranslation
 import ckanext.qa
@@ -33,6 +39,8 @@ class QAPlugin(MixinPlugin, p.SingletonPlugin, p.toolkit.DefaultDatasetForm, Def
     p.implements(p.IPackageController, inherit=True)
     if p.toolkit.check_ckan_version(min_version='2.5.0'):
         p.implements(p.ITranslation, inherit=True)
+    if hasattr(p, 'IForkObserver'):
+        p.implements(p.IForkObserver, inherit=True)
 
     # IConfigurer
 
@@ -53,6 +61,14 @@ class QAPlugin(MixinPlugin, p.SingletonPlugin, p.toolkit.DefaultDatasetForm, Def
 
         create_qa_update_package_task(dataset, queue=queue)
 
+    # IForkObserver
+
+    def before_fork(self):
+        # Called in the RQ worker process, before it forks for each job. The
+        # job processes skip exit handlers, so flush the reindex buffer when
+        # the worker exits.
+        reindex.register_exit_flush()
+
     # IReport
 
     def register_reports(self):
@@ -66,6 +82,9 @@ class QAPlugin(MixinPlugin, p.SingletonPlugin, p.toolkit.DefaultDatasetForm, Def
         return {
             'qa_resource_show': action.qa_resource_show,
             'qa_package_openness_show': action.qa_package_openness_show,
+            'qa_resource_show_many': action.qa_resource_show_many,
+            'qa_package_openness_show_many':
+            action.qa_package_openness_show_many,
             }
 
     # IAuthFunctions
@@ -74,6 +93,9 @@ class QAPlugin(MixinPlugin, p.SingletonPlugin, p.toolkit.DefaultDatasetForm, Def
         return {
             'qa_resource_show': auth.qa_resource_show,
             'qa_package_openness_show': auth.qa_package_openness_show,
+            'qa_resource_show_many': auth.qa_resource_show_many,
+            'qa_package_openness_show_many':
+            auth.qa_package_openness_show_many,
             }
 
     # ITemplateHelpers
@@ -84,6 +106,7 @@ class QAPlugin(MixinPlugin, p.SingletonPlugin, p.toolkit.DefaultDatasetForm, Def
             qa_openness_stars_resource_html,
             'qa_openness_stars_dataset_html':
             qa_openness_stars_dataset_html,
+            'qa_search': qa_search,
             }
 
     # IPackageController
@@ -95,22 +118,53 @@ class QAPlugin(MixinPlugin, p.SingletonPlugin, p.toolkit.DefaultDatasetForm, Def
         # it they will be saved in the resources (not the dataset). I can't see
         # and easy way to stop this, but I think it is harmless. It will get
         # overwritten here when output again.
-        qa_objs = QA.get_for_package(pkg_dict['id'])
-        if not qa_objs:
-            return
-        # dataset
-        dataset_qa = aggregate_qa_for_a_dataset(qa_objs)
-        pkg_dict['qa'] = dataset_qa
-        # resources
-        qa_by_res_id = dict((a.resource_id, a) for a in qa_objs)
-        for res in pkg_dict['resources']:
-            qa = qa_by_res_id.get(res['id'])
-            if qa:
-                qa_dict = qa.as_dict()
-                del qa_dict['id']
-                del qa_dict['package_id']
-                del qa_dict['resource_id']
-                res['qa'] = qa_dict
+        # It is cached, as package_show is often called several times for a
+        # dataset in a request.
+        dataset_qa, resource_qa_dicts = show_cache.get(
+            pkg_dict['id'],
+            lambda package_id: get_qa_dicts(QA.get_for_package(package_id)))
+        add_qa_dicts_to_package_dict(pkg_dict, dataset_qa, resource_qa_dicts)
+
+    def after_search(self, search_results, search_params):
+        # Insert the qa info into each of the datasets found, as after_show
+        # does, getting the QA for all of them in one query
+        pkg_dicts = [pkg_dict for pkg_dict in search_results.get('results', [])
+                     if isinstance(pkg_dict, dict) and 'id' in pkg_dict]
+        qa_objs_by_package = QA.get_for_packages(
+            [pkg_dict['id'] for pkg_dict in pkg_dicts])
+        for pkg_dict in pkg_dicts:
+            add_qa_to_package_dict(
+                pkg_dict, qa_objs_by_package.get(pkg_dict['id'], []))
+        return search_results
+
+    def before_index(self, pkg_dict):
+        # Index the QA as fields of its own, so that datasets can be filtered
+        # and faceted by it (see helpers.qa_search). The 'qa' dict that
+        # after_show adds can't be indexed as it is.
+        pkg_dict.pop('qa', None)
+        pkg_dict.update(qa_index_fields(QA.get_for_package(pkg_dict['id'])))
+        return pkg_dict
+
+    def after_update(self, context, pkg_dict):
+        # A resource may have been deleted, which changes the dataset's QA
+        # (saved with the dataset)
+        update_package_qa([pkg_dict['id']])
+        show_cache.invalidate([pkg_dict['id']])
+
+    # CKAN 2.10+ names. (It only calls the old names if these aren't defined,
+    # which inherit=True does.)
+
+    def after_dataset_show(self, context, pkg_dict):
+        self.after_show(context, pkg_dict)
+
+    def after_dataset_search(self, search_results, search_params):
+        return self.after_search(search_results, search_params)
+
+    def before_dataset_index(self, pkg_dict):
+        return self.before_index(pkg_dict)
+
+    def after_dataset_update(self, context, pkg_dict):
+        self.after_update(context, pkg_dict)
 
     # ITranslation
     def i18n_directory(self):
@@ -118,4 +172,61 @@ class QAPlugin(MixinPlugin, p.SingletonPlugin, p.toolkit.DefaultDatasetForm, Def
         return os.path.join(
             os.path.dirname(ckanext.qa.__file__),
             'i18n'
-        )
\ No newline at end of file
+        )
+
+
+def add_qa_to_package_dict(pkg_dict, qa_objs):
+    '''Adds the QA of a dataset and of its resources to its package_dict,
+    given the QA objects for its resources (as from QA.get_for_package).'''
+    add_qa_dicts_to_package_dict(pkg_dict, *get_qa_dicts(qa_objs))
+
+
+def get_qa_dicts(qa_objs):
+    '''Returns the QA dict of a dataset, and those of its resources keyed by
+    resource_id, given the QA objects for its resources. The dataset's is None
+    if it has no QA.'''
+    if not qa_objs:
+        return None, {}
+    # dataset
+    dataset_qa = aggregate_qa_for_a_dataset(qa_objs)
+    # resources
+    resource_qa_dicts = {}
+    for qa in qa_objs:
+        resource_qa_dicts[qa.resource_id] = qa.as_dict(include_ids=False)
+    return dataset_qa, resource_qa_dicts
+
+
+def add_qa_dicts_to_package_dict(pkg_dict, dataset_qa, resource_qa_dicts):
+    if dataset_qa is None:
+        return
+    pkg_dict['qa'] = dataset_qa
+    for res in pkg_dict.get('resources', []):
+        qa_dict = resource_qa_dicts.get(res['id'])
+        if qa_dict:
+            res['qa'] = qa_dict
+
+
+def qa_index_fields(qa_objs):
+    '''Returns the fields to add to a dataset in the search index, given the
+    QA objects for its resources (as from QA.get_for_package). The values are
+    strings, to suit the dynamic fields of CKAN's Solr schema:
+
+    qa_openness_score - the dataset's score e.g. '3', so that a filter query
+                        qa_openness_score:[3 TO 5] works
+    qa_resources_score_<score> - the number of resources with each score
+    vocab_qa_formats - the resources' formats (vocab_* is the schema's
+                       multi-valued string field, so they can be faceted)
+    '''
+    if not qa_objs:
+        return {}
+    fields = {}
+    openness_score = aggregate_qa_for_a_dataset(qa_objs)['openness_score']
+    if openness_score is not None:
+        fields['qa_openness_score'] = six.text_type(openness_score)
+    score_counts = Counter(qa.openness_score for qa in qa_objs
+                           if qa.openness_score is not None)
+    for score, count in score_counts.items():
+        fields['qa_resources_score_%s' % score] = six.text_type(count)
+    fields['vocab_qa_formats'] = sorted(set(qa.format for qa in qa_objs
+                                            if qa.format))
+    return fields
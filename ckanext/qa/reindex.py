@@ -0,0 +1,194 @@
+'''
+Buffers the updates to the search index that are needed when QA results
+change, so that during a bulk QA run Solr gets a commit per batch of datasets,
+rather than a hard commit per dataset.
+
+The ids of the datasets to reindex are collected (without duplicates) in a
+redis set, so that the buffer is shared by all the QA jobs - each RQ job runs
+in a process of its own. The buffer is flushed, i.e. the datasets are
+reindexed and a single commit is made, when:
+
+* it holds qa.reindex_batch_size datasets
+* a dataset is added, or a QA job ends, when the first in the buffer has been
+  waiting for qa.reindex_flush_interval seconds
+* a QA job ends and there are no more jobs waiting in its RQ queue
+* the 'qa update' command's jobs are done - it queues a flush after them
+* the RQ worker exits (its forked job processes skip exit handlers, so the
+  plugin registers the flush in the worker process - see
+  register_exit_flush), or another process that added datasets exits
+
+The default qa.reindex_batch_size of 1 reindexes each dataset immediately,
+without using redis (requires CKAN 2.7+ for larger batches).
+'''
+import atexit
+import time
+import uuid
+
+import six
+
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+import logging
+
+log = logging.getLogger(__name__)
+
+_registered_exit_flush = False
+
+
+def get_batch_size():
+    return int(config.get('qa.reindex_batch_size', 1))
+
+
+def get_flush_interval():
+    return float(config.get('qa.reindex_flush_interval', 60))
+
+
+def _connect_to_redis():
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+def _get_key():
+    return 'ckanext-qa:%s:reindex' % config.get('ckan.site_id')
+
+
+def add(package_id):
+    '''Requests that the dataset is reindexed, which happens when the buffer
+    is next flushed.'''
+    batch_size = get_batch_size()
+    if batch_size <= 1:
+        index_packages([package_id])
+        return
+
+    redis = _connect_to_redis()
+    key = _get_key()
+    now = time.time()
+    pipeline = redis.pipeline()
+    pipeline.sadd(key, package_id)
+    pipeline.set(key + ':since', now, nx=True)
+    pipeline.scard(key)
+    pipeline.get(key + ':since')
+    size, since = pipeline.execute()[2:]
+    register_exit_flush()
+
+    if size >= batch_size:
+        log.info('Reindex buffer is full')
+        flush()
+    elif now - float(since or now) >= get_flush_interval():
+        log.info('Reindex buffer flush interval has elapsed')
+        flush()
+    else:
+        log.info('Dataset added to reindex buffer (%i waiting): %s',
+                 size, package_id)
+
+
+def flush():
+    '''Reindexes the datasets in the buffer, with a single commit.
+
+    Returns the number of datasets reindexed.
+    '''
+    from redis.exceptions import ResponseError
+    redis = _connect_to_redis()
+    key = _get_key()
+    # take the current contents, so that datasets added during the flush
+    # are left for the next one. Its time is removed in the same transaction,
+    # so that it isn't the time of a dataset added in between.
+    flushing_key = '%s:flushing:%s' % (key, uuid.uuid4())
+    pipeline = redis.pipeline(transaction=True)
+    pipeline.rename(key, flushing_key)
+    pipeline.delete(key + ':since')
+    try:
+        pipeline.execute()
+    except ResponseError:
+        return 0  # "no such key" i.e. the buffer is empty
+    try:
+        package_ids = sorted(six.ensure_text(package_id)
+                             for package_id in redis.smembers(flushing_key))
+        try:
+            index_packages(package_ids)
+        except Exception:
+            # put them back, to be tried again next time
+            pipeline = redis.pipeline(transaction=True)
+            pipeline.sadd(key, *package_ids)
+            pipeline.set(key + ':since', time.time(), nx=True)
+            pipeline.execute()
+            raise
+    finally:
+        redis.delete(flushing_key)
+    return len(package_ids)
+
+
+def job_done():
+    '''Called at the end of each QA job. Flushes the buffer if the first
+    dataset in it has been waiting for qa.reindex_flush_interval, or if
+    there are no more jobs waiting in the job's queue, since otherwise on a
+    quiet site the datasets could wait indefinitely.'''
+    if get_batch_size() <= 1:
+        return
+    try:
+        since = _connect_to_redis().get(_get_key() + ':since')
+        if since is None:
+            return  # the buffer is empty
+        if time.time() - float(since) >= get_flush_interval():
+            log.info('Reindex buffer flush interval has elapsed')
+            flush()
+        elif _is_last_job():
+            log.info('No more jobs queued - flushing the reindex buffer')
+            flush()
+    except Exception:
+        log.exception('Error flushing the reindex buffer after the job')
+
+
+def _is_last_job():
+    '''Returns whether this is an RQ job, with no more jobs waiting in its
+    queue.'''
+    try:
+        from rq import get_current_job, Queue
+    except ImportError:
+        return False  # celery (CKAN 2.6 and earlier)
+    job = get_current_job()
+    if job is None:
+        return False
+    return Queue(job.origin, connection=job.connection).count == 0
+
+
+def register_exit_flush():
+    '''Makes sure the buffer is flushed when this process exits. The plugin
+    calls it in the RQ worker process (before it forks each job), since the
+    job processes skip exit handlers.'''
+    global _registered_exit_flush
+    if get_batch_size() <= 1 or _registered_exit_flush:
+        return
+    atexit.register(_flush_at_exit)
+    _registered_exit_flush = True
+
+
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        log.exception('Error flushing the reindex buffer at exit')
+
+
+def index_packages(package_ids):
+    '''Tells CKAN to update its search index for the given datasets, with a
+    single commit.'''
+    from ckan import model
+    from ckan.lib.search.index import PackageSearchIndex
+    package_index = PackageSearchIndex()
+    context_ = {'model': model, 'ignore_auth': True, 'session': model.Session,
+                'use_cache': False, 'validate': False}
+    defer_commit = len(package_ids) > 1
+    for package_id in package_ids:
+        try:
+            package = toolkit.get_action('package_show')(
+                dict(context_), {'id': package_id})
+        except toolkit.ObjectNotFound:
+            log.warning('Dataset to reindex no longer exists: %s', package_id)
+            continue
+        package_index.index_package(package, defer_commit=defer_commit)
+        log.info('Search indexed %s', package['name'])
+    if defer_commit:
+        package_index.commit()
+        log.info('Search index committed: %i datasets', len(package_ids))
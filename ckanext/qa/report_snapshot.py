@@ -0,0 +1,89 @@
+'''
+A snapshot of the data behind the openness report, so that when the report
+cache is refreshed, only the organizations whose datasets have changed since
+the last refresh have their datasets and QA read again.
+
+For each organization it keeps the report rows of its datasets (their names,
+scores etc). An organization is read again when one of its datasets (now, or
+in the snapshot) has QA updated since the snapshot was taken, or has itself
+been modified (e.g. created, deleted, moved to another organization or had a
+resource deleted), or when its datasets are not the ones in the snapshot
+(e.g. one has been purged). Changes are looked for from a margin
+(reports.CHANGE_MARGIN) before the snapshot was taken, to catch those that
+were stamped before it but committed after. The reports that include
+sub-organizations, and the index, are put together from the organizations'
+rows, so a change also shows in the reports of the organization's parents.
+
+It is enabled with config option:
+
+    qa.openness_report_incremental = true
+
+The snapshot is kept in redis. clear() it to have the next refresh read all
+the datasets again.
+'''
+import datetime
+import json
+
+import six
+
+from ckan.plugins.toolkit import asbool, config
+
+import logging
+
+log = logging.getLogger(__name__)
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def is_enabled():
+    return asbool(config.get('qa.openness_report_incremental', False))
+
+
+def _connect_to_redis():
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+def _get_key():
+    return 'ckanext-qa:%s:openness_report' % config.get('ckan.site_id')
+
+
+def get():
+    '''Returns the snapshot, or None if there isn't one. It is a dict:
+
+        {'built': when it was taken (local time, as QA.updated),
+         'built_utc': when it was taken (UTC, as Package.metadata_modified),
+         'org_rows': {org_id: [package_row, ...]}}
+    '''
+    fields = _connect_to_redis().hgetall(_get_key())
+    if not fields:
+        return None
+    fields = dict((six.ensure_text(name), json.loads(six.ensure_text(value)))
+                  for name, value in fields.items())
+    built = fields.pop('_built')
+    return {
+        'built': datetime.datetime.strptime(built['built'], DATETIME_FORMAT),
+        'built_utc': datetime.datetime.strptime(built['built_utc'],
+                                                DATETIME_FORMAT),
+        'org_rows': fields,
+        }
+
+
+def save(built, built_utc, org_rows, removed_org_ids=()):
+    '''Stores the rows of the given organizations in the snapshot, replacing
+    any already there, and removes those of removed_org_ids.'''
+    redis = _connect_to_redis()
+    key = _get_key()
+    pipeline = redis.pipeline()
+    for org_id, rows in org_rows.items():
+        pipeline.hset(key, org_id, json.dumps(rows))
+    if removed_org_ids:
+        pipeline.hdel(key, *removed_org_ids)
+    pipeline.hset(key, '_built', json.dumps({
+        'built': built.strftime(DATETIME_FORMAT),
+        'built_utc': built_utc.strftime(DATETIME_FORMAT)}))
+    pipeline.execute()
+
+
+def clear():
+    _connect_to_redis().delete(_get_key())
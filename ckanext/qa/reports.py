@@ -1,11 +1,14 @@
-import copy
+import datetime
 import logging
-from collections import Counter
+from collections import Counter, defaultdict
+
+from sqlalchemy import func
 
 import ckan.model as model
 import ckan.plugins as p
 
 from ckanext.report import lib
+from ckanext.qa.logic.action import get_show_many_limit
 
 try:
     from collections import OrderedDict  # from python 2.7
@@ -16,7 +19,16 @@ except ImportError:
 log = logging.getLogger(__name__)
 
 
+# Reports generated in one pass, for openness_report to return as ckanext-report
+# asks for each option combination. See openness_report_combinations.
+_generated_reports = {}
+
+
 def openness_report(organization, include_sub_organizations=False):
+    report = _generated_reports.pop(
+        (organization, include_sub_organizations), None)
+    if report is not None:
+        return report
     if organization is None:
         return openness_index(include_sub_organizations=include_sub_organizations)
     else:
@@ -26,51 +38,42 @@ def openness_report(organization, include_sub_organizations=False):
 def openness_index(include_sub_organizations=False):
     '''Returns the counts of 5 stars of openness for all organizations.'''
 
-    context = {'model': model, 'session': model.Session, 'ignore_auth': True}
+    orgs = model.Session.query(model.Group) \
+        .filter(model.Group.type == 'organization') \
+        .filter(model.Group.state == 'active').all()
+    # Get the number of packages with each score, for all the orgs at once
+    org_score_counts = dict((org.id, Counter()) for org in orgs)
+    for owner_org, score, count in openness_score_counts_by_org():
+        if owner_org in org_score_counts:
+            org_score_counts[owner_org][score] = count
+
+    # Get total number of packages & resources
+    num_packages = model.Session.query(model.Package)\
+                        .filter_by(state='active')\
+                        .count()
+    children = get_organization_children() \
+        if include_sub_organizations else None
+    return _openness_index(orgs, org_score_counts, num_packages, children)
+
+
+def _openness_index(orgs, org_score_counts, num_packages, children=None):
+    '''Returns the openness index report, given the organizations and the
+    Counter of the scores of each one's packages (keyed by org id). Given the
+    organization hierarchy (see get_organization_children), the counts of the
+    sub-organizations are included.'''
     total_score_counts = Counter()
-    counts = {}
-    # Get all the scores and build up the results by org
-    orgs = add_progress_bar(model.Session.query(model.Group)
-                            .filter(model.Group.type == 'organization')
-                            .filter(model.Group.state == 'active').all())
-    for org in orgs:
-        scores = []
-        # NB org.packages() misses out many - see:
-        # http://redmine.dguteam.org.uk/issues/1844
-        pkgs = model.Session.query(model.Package) \
-                    .filter_by(owner_org=org.id) \
-                    .filter_by(state='active') \
-                    .all()
-        for pkg in pkgs:
-            try:
-                qa = p.toolkit.get_action('qa_package_openness_show')(context, {'id': pkg.id})
-            except p.toolkit.ObjectNotFound:
-                log.warning('No QA info for package %s', pkg.name)
-                return
-            scores.append(qa['openness_score'])
-        score_counts = Counter(scores)
+    for score_counts in org_score_counts.values():
         total_score_counts += score_counts
-        counts[org.name] = {
+    if children is not None:
+        org_score_counts = add_sub_organization_counts(
+            org_score_counts, children)
+    results = OrderedDict()
+    for org in orgs:
+        results[org.name] = {
             'organization_title': org.title,
-            'score_counts': score_counts,
+            'score_counts': org_score_counts[org.id],
         }
 
-    counts_with_sub_orgs = copy.deepcopy(counts)  # new dict
-    if include_sub_organizations:
-        for org_name in counts_with_sub_orgs:
-            org = model.Group.by_name(org_name)
-
-            for sub_org_id, sub_org_name, sub_org_title, sub_org_parent_id \
-                    in org.get_children_group_hierarchy(type='organization'):
-                if sub_org_name not in counts:
-                    # occurs only if there is an organization created since the last loop?
-                    continue
-                counts_with_sub_orgs[org_name]['score_counts'] += \
-                    counts[sub_org_name]['score_counts']
-        results = counts_with_sub_orgs
-    else:
-        results = counts
-
     table = []
     for org_name, org_counts in results.items():
         if not org_counts['score_counts']:  # Let's skip if there are no counts at all.
@@ -92,10 +95,6 @@ def openness_index(include_sub_organizations=False):
     table.sort(key=lambda x: (-x['total_stars'],
                               -x['average_stars']))
 
-    # Get total number of packages & resources
-    num_packages = model.Session.query(model.Package)\
-                        .filter_by(state='active')\
-                        .count()
     return {'table': table,
             'total_score_counts': jsonify_counter(total_score_counts),
             'num_packages_scored': sum(total_score_counts.values()),
@@ -103,6 +102,88 @@ def openness_index(include_sub_organizations=False):
             }
 
 
+def package_openness_scores():
+    '''Returns a subquery of the openness score of each package that has QA
+    results (package_id, openness_score) - the highest score of its active
+    resources, as given by qa_package_openness_show.'''
+    from ckanext.qa.model import PackageQA
+    return model.Session.query(
+        PackageQA.package_id.label('package_id'),
+        PackageQA.openness_score.label('openness_score')) \
+        .subquery()
+
+
+def openness_score_counts_by_org():
+    '''Returns the number of active packages with each openness score, for
+    each organization, as a list of (owner_org, openness_score, count).
+    Packages without QA results have a score of None.'''
+    scores = package_openness_scores()
+    return model.Session.query(
+        model.Package.owner_org, scores.c.openness_score,
+        func.count(model.Package.id)) \
+        .outerjoin(scores, scores.c.package_id == model.Package.id) \
+        .filter(model.Package.state == 'active') \
+        .group_by(model.Package.owner_org, scores.c.openness_score) \
+        .all()
+
+
+def get_organization_children():
+    '''Returns the organization hierarchy, loaded in one query, as a dict of
+    the ids of the (active) child organizations of each organization id.'''
+    children = defaultdict(list)
+    # NB the child is the member of its parent
+    rows = model.Session.query(model.Member.group_id, model.Member.table_id) \
+        .join(model.Group, model.Group.id == model.Member.group_id) \
+        .filter(model.Member.table_name == 'group') \
+        .filter(model.Member.state == 'active') \
+        .filter(model.Group.type == 'organization') \
+        .filter(model.Group.state == 'active')
+    for child_id, parent_id in rows:
+        children[parent_id].append(child_id)
+    return children
+
+
+def walk_down_tree(org_id, children):
+    '''Yields the id of the organization and those of all the organizations
+    underneath it, parents before their children (like lib.go_down_tree).'''
+    seen = set()
+    stack = [org_id]
+    while stack:
+        org_id = stack.pop()
+        if org_id in seen:
+            continue
+        seen.add(org_id)
+        yield org_id
+        stack.extend(reversed(children.get(org_id, [])))
+
+
+def add_sub_organization_counts(org_counts, children):
+    '''Given Counters keyed by organization id, returns new ones which also
+    include the counts of all the organizations underneath each one. They are
+    added up in one pass, children before their parents.'''
+    totals = {}
+    in_progress = set()  # guards against loops in the hierarchy
+    for root_id in org_counts:
+        stack = [(root_id, False)]
+        while stack:
+            org_id, children_added = stack.pop()
+            if org_id in totals:
+                continue
+            child_ids = children.get(org_id, [])
+            if children_added:
+                total = Counter(org_counts.get(org_id, {}))
+                for child_id in child_ids:
+                    total += totals.get(child_id, Counter())
+                totals[org_id] = total
+                in_progress.discard(org_id)
+            elif org_id not in in_progress:
+                in_progress.add(org_id)
+                stack.append((org_id, True))
+                stack.extend((child_id, False) for child_id in child_ids
+                             if child_id not in totals)
+    return dict((org_id, totals[org_id]) for org_id in org_counts)
+
+
 def openness_for_organization(organization=None, include_sub_organizations=False):
     org = model.Group.get(organization)
     if not org:
@@ -111,36 +192,74 @@ def openness_for_organization(organization=None, include_sub_organizations=False
     if not include_sub_organizations:
         orgs = [org]
     else:
-        orgs = lib.go_down_tree(org)
+        org_ids = list(walk_down_tree(org.id, get_organization_children()))
+        orgs_by_id = dict(
+            (org_.id, org_) for org_ in model.Session.query(model.Group)
+            .filter(model.Group.id.in_(org_ids)))
+        orgs = [orgs_by_id[org_id] for org_id in org_ids]
+
+    # NB org.packages() misses out many - see:
+    # http://redmine.dguteam.org.uk/issues/1844
+    pkgs_by_org = defaultdict(list)
+    for pkg in model.Session.query(model.Package) \
+            .filter(model.Package.owner_org.in_([org_.id for org_ in orgs])) \
+            .filter_by(state='active'):
+        pkgs_by_org[pkg.owner_org].append(pkg)
 
+    # get the QA a batch of packages at a time
     context = {'model': model, 'session': model.Session, 'ignore_auth': True}
+    pkg_ids = [pkg.id for org_ in orgs for pkg in pkgs_by_org[org_.id]]
+    batch_size = get_show_many_limit()
+    qa_by_pkg_id = {}
+    for i in range(0, len(pkg_ids), batch_size):
+        qa_by_pkg_id.update(
+            p.toolkit.get_action('qa_package_openness_show_many')(
+                context, {'ids': pkg_ids[i:i + batch_size]})['results'])
+
+    org_rows = {}
+    for org in orgs:
+        org_rows[org.id] = []
+        for pkg in pkgs_by_org[org.id]:
+            qa = qa_by_pkg_id.get(pkg.id)
+            if qa is None:
+                log.warning('No QA info for package %s', pkg.name)
+                return
+            org_rows[org.id].append(package_row(pkg, qa))
+    return _openness_for_organization(orgs, org_rows)
+
+
+def package_row(pkg, qa):
+    '''Returns the details of a package for the openness report, given its
+    QA (as given by qa_package_openness_show).'''
+    return {'package_id': pkg.id,
+            'dataset_name': pkg.name,
+            'dataset_title': pkg.title,
+            'dataset_notes': lib.dataset_notes(pkg),
+            'openness_score': qa['openness_score'],
+            'openness_score_reason': qa['openness_score_reason'],
+            }
+
+
+def _openness_for_organization(orgs, org_rows):
+    '''Returns the openness report for the packages of the given
+    organizations, given the package_row()s of each org (keyed by org id).'''
     score_counts = Counter()
     rows = []
     num_packages = 0
     for org in orgs:
-        # NB org.packages() misses out many - see:
-        # http://redmine.dguteam.org.uk/issues/1844
-        pkgs = model.Session.query(model.Package) \
-                    .filter_by(owner_org=org.id) \
-                    .filter_by(state='active') \
-                    .all()
-        num_packages += len(pkgs)
-        for pkg in pkgs:
-            try:
-                qa = p.toolkit.get_action('qa_package_openness_show')(context, {'id': pkg.id})
-            except p.toolkit.ObjectNotFound:
-                log.warning('No QA info for package %s', pkg.name)
-                return
+        pkg_rows = org_rows.get(org.id, [])
+        num_packages += len(pkg_rows)
+        for pkg_row in pkg_rows:
             rows.append(OrderedDict((
-                ('dataset_name', pkg.name),
-                ('dataset_title', pkg.title),
-                ('dataset_notes', lib.dataset_notes(pkg)),
+                ('dataset_name', pkg_row['dataset_name']),
+                ('dataset_title', pkg_row['dataset_title']),
+                ('dataset_notes', pkg_row['dataset_notes']),
                 ('organization_name', org.name),
                 ('organization_title', org.title),
-                ('openness_score', qa['openness_score']),
-                ('openness_score_reason', qa['openness_score_reason']),
+                ('openness_score', pkg_row['openness_score']),
+                ('openness_score_reason', pkg_row['openness_score_reason']),
                 )))
-            score_counts[qa['openness_score']] += 1
+            score_counts[pkg_row['openness_score']] += 1
 
     total_stars = sum([k*v for k, v in score_counts.items() if k])
     num_pkgs_with_stars = sum([v for k, v in score_counts.items()
@@ -157,11 +276,165 @@ def openness_for_organization(organization=None, include_sub_organizations=False
             }
 
 
+def get_package_rows(org_ids=None):
+    '''Returns the package_row()s of the active packages of the given
+    organizations (or of all of them), keyed by org id. Reads the packages and
+    their QA in one query.'''
+    from ckanext.qa.model import PackageQA, aggregate_qa_for_a_dataset
+
+    pkgs = model.Session.query(model.Package, PackageQA) \
+        .outerjoin(PackageQA, PackageQA.package_id == model.Package.id) \
+        .filter(model.Package.state == 'active')
+    if org_ids is not None:
+        if not org_ids:
+            return {}
+        pkgs = pkgs.filter(model.Package.owner_org.in_(org_ids))
+    org_rows = dict((org_id, []) for org_id in org_ids or [])
+    for pkg, package_qa in pkgs:
+        qa = package_qa.as_dict() if package_qa \
+            else aggregate_qa_for_a_dataset([])
+        org_rows.setdefault(pkg.owner_org, []).append(package_row(pkg, qa))
+    return org_rows
+
+
+# QA.updated and Package.metadata_modified are stamped before their
+# transaction commits, so a snapshot can be taken after a change is stamped
+# but before it can be read. Changes stamped this long before the snapshot are
+# looked for again next time.
+CHANGE_MARGIN = datetime.timedelta(minutes=10)
+
+
+def get_changed_organizations(snapshot, org_ids):
+    '''Returns the ids of the organizations (of those given) whose packages
+    may have changed since the report_snapshot was taken - because of their
+    QA or the packages themselves, or packages added, purged or moved without
+    being modified - or that are not in the snapshot.'''
+    from ckanext.qa.model import QA
+
+    changed = model.Session.query(model.Package.id, model.Package.owner_org) \
+        .join(QA, QA.package_id == model.Package.id) \
+        .filter(QA.updated > snapshot['built'] - CHANGE_MARGIN) \
+        .distinct().all()
+    changed += model.Session.query(model.Package.id, model.Package.owner_org) \
+        .filter(model.Package.metadata_modified >
+                snapshot['built_utc'] - CHANGE_MARGIN) \
+        .all()
+    changed_package_ids = set(package_id for package_id, owner_org in changed)
+    changed_org_ids = set(owner_org for package_id, owner_org in changed)
+    # and the organizations they were in before
+    for org_id, rows in snapshot['org_rows'].items():
+        if any(row['package_id'] in changed_package_ids for row in rows):
+            changed_org_ids.add(org_id)
+    # and those whose active packages are not the ones in the snapshot
+    package_ids_by_org = defaultdict(set)
+    for package_id, owner_org in model.Session.query(
+            model.Package.id, model.Package.owner_org) \
+            .filter(model.Package.state == 'active'):
+        package_ids_by_org[owner_org].add(package_id)
+    for org_id, rows in snapshot['org_rows'].items():
+        if set(row['package_id'] for row in rows) != \
+                package_ids_by_org.get(org_id, set()):
+            changed_org_ids.add(org_id)
+    return [org_id for org_id in org_ids
+            if org_id in changed_org_ids or org_id not in snapshot['org_rows']]
+
+
+def openness_reports_for_all_combinations():
+    '''Generates the openness report for every option combination, with one
+    pass over the packages and their QA, rather than querying them again for
+    each organization.
+
+    If enabled, only the packages of organizations that have changed since the
+    last time are read (see report_snapshot).
+
+    :returns: a list of (option_dict, report)
+    '''
+    from ckanext.qa import report_snapshot
+
+    orgs = model.Session.query(model.Group) \
+        .filter(model.Group.type == 'organization') \
+        .filter(model.Group.state == 'active').all()
+    orgs_by_name = dict((org.name, org) for org in orgs)
+    orgs_by_id = dict((org.id, org) for org in orgs)
+    children = get_organization_children()
+
+    # the time before reading anything, so no change is missed next time
+    built = datetime.datetime.now()
+    built_utc = datetime.datetime.utcnow()
+    snapshot = report_snapshot.get() if report_snapshot.is_enabled() else None
+    if snapshot is None:
+        org_rows = get_package_rows()
+        changed_org_rows = org_rows
+    else:
+        changed_org_ids = get_changed_organizations(snapshot, list(orgs_by_id))
+        log.info('Openness report: %i of %i organizations have changed',
+                 len(changed_org_ids), len(orgs))
+        changed_org_rows = get_package_rows(changed_org_ids)
+        org_rows = snapshot['org_rows']
+        org_rows.update(changed_org_rows)
+    if report_snapshot.is_enabled():
+        if snapshot is None:
+            report_snapshot.clear()
+            removed_org_ids = ()
+        else:
+            removed_org_ids = [org_id for org_id in org_rows
+                               if org_id not in orgs_by_id]
+        report_snapshot.save(
+            built, built_utc,
+            dict((org_id, rows) for org_id, rows in changed_org_rows.items()
+                 if org_id in orgs_by_id),
+            removed_org_ids)
+
+    org_score_counts = dict(
+        (org.id, Counter(row['openness_score']
+                         for row in org_rows.get(org.id, [])))
+        for org in orgs)
+    num_packages = model.Session.query(model.Package)\
+        .filter_by(state='active')\
+        .count()
+
+    reports = []
+    for option_dict in openness_report_combinations_list():
+        if option_dict['organization'] is None:
+            report = _openness_index(
+                orgs, org_score_counts, num_packages,
+                children if option_dict['include_sub_organizations'] else None)
+        else:
+            org = orgs_by_name[option_dict['organization']]
+            if option_dict['include_sub_organizations']:
+                tree = [orgs_by_id[org_id]
+                        for org_id in walk_down_tree(org.id, children)]
+            else:
+                tree = [org]
+            report = _openness_for_organization(tree, org_rows)
+        reports.append((option_dict, report))
+    return reports
+
+
+def openness_report_combinations_list():
+    return [{'organization': organization,
+             'include_sub_organizations': include_sub_organizations}
+            for organization in lib.all_organizations(include_none=True)
+            for include_sub_organizations in (False, True)]
+
+
 def openness_report_combinations():
-    for organization in lib.all_organizations(include_none=True):
-        for include_sub_organizations in (False, True):
-            yield {'organization': organization,
-                   'include_sub_organizations': include_sub_organizations}
+    # ckanext-report refreshes its cache by generating the report for each of
+    # these combinations in turn. Instead of each one querying the packages and
+    # QA again, generate them all in one pass now, for openness_report to
+    # return as they are asked for.
+    _generated_reports.clear()
+    try:
+        reports = openness_reports_for_all_combinations()
+        for option_dict, report in reports:
+            _generated_reports[(option_dict['organization'],
+                                option_dict['include_sub_organizations'])] = \
+                report
+        for option_dict, report in reports:
+            yield option_dict
+    finally:
+        # don't keep any that were not asked for, which would become stale
+        _generated_reports.clear()
 
 
 openness_report_info = {
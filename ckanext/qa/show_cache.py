@@ -0,0 +1,154 @@
+'''
+A cache of the QA that the plugin adds to a dataset's package_dict in
+after_show, since package_show is often called several times for the same
+dataset in one request (by templates, helpers and other plugins), and each
+time the QA of all its resources would be read and dictized again.
+
+There are two layers:
+
+* per request (always on) - keyed by package id. It is dropped at the end of
+  the request, and invalidated when this process saves QA for the dataset (see
+  tasks.save_qa_results) or updates the dataset.
+
+* per process (optional) - keyed by package id and the dataset's qa_package
+  'updated' (the newest QA of its resources) and resource score counts, which
+  change whenever QA is saved for one of its resources or one is deleted, by
+  whichever process. Checking them is one primary key lookup. It is bounded,
+  evicting the least recently used datasets, and entries expire after a
+  time-to-live, as a backstop. It is enabled by setting config option
+  qa.show_cache_size to the maximum number of datasets to keep, and
+  qa.show_cache_ttl to the time-to-live in seconds (by default 60).
+
+The counts of hits and misses in this process are in stats, and get_stats()
+gives the hit ratios too.
+'''
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from ckan.plugins.toolkit import config
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Counts for this process
+stats = {'request_hits': 0, 'process_hits': 0, 'misses': 0}
+
+# package_id: (version, expires, value), least recently used first
+_process_cache = OrderedDict()
+_process_cache_lock = threading.Lock()
+
+
+def get_max_size():
+    return int(config.get('qa.show_cache_size', 0))
+
+
+def get_ttl():
+    return float(config.get('qa.show_cache_ttl', 60))
+
+
+def is_enabled():
+    '''Returns whether the per-process cache is enabled.'''
+    return get_max_size() > 0
+
+
+def _get_request_cache():
+    '''Returns the dict of this request's cached values, or None if not in a
+    (Flask) request.'''
+    try:
+        from flask import g, has_request_context
+    except ImportError:
+        return None
+    if not has_request_context():
+        return None
+    if not hasattr(g, 'qa_show_cache'):
+        g.qa_show_cache = {}
+    return g.qa_show_cache
+
+
+def _get_version(package_id):
+    from ckan import model
+    from ckanext.qa.model import PackageQA
+    return model.Session.query(PackageQA.updated,
+                               PackageQA.resource_score_counts) \
+        .filter(PackageQA.package_id == package_id) \
+        .first()
+
+
+def get(package_id, load):
+    '''Returns the cached value for a dataset, or else gets it with
+    load(package_id) and caches it. It returns a copy, so the caller is free
+    to change it.'''
+    request_cache = _get_request_cache()
+    if request_cache is not None and package_id in request_cache:
+        stats['request_hits'] += 1
+        return copy.deepcopy(request_cache[package_id])
+
+    value = None
+    enabled = is_enabled()
+    if enabled:
+        # NB the version is read before loading, so if the QA changes in
+        # between, the value is stored with the older version, and is not
+        # used again
+        version = tuple(_get_version(package_id) or ())
+        with _process_cache_lock:
+            entry = _process_cache.get(package_id)
+            if entry and entry[0] == version and entry[1] > time.time():
+                # most recently used goes to the end
+                _process_cache[package_id] = _process_cache.pop(package_id)
+                value = entry[2]
+        if value is not None:
+            stats['process_hits'] += 1
+    if value is None:
+        stats['misses'] += 1
+        value = load(package_id)
+        if enabled:
+            _put_in_process_cache(package_id, version, value)
+
+    if request_cache is not None:
+        request_cache[package_id] = value
+    return copy.deepcopy(value)
+
+
+def _put_in_process_cache(package_id, version, value):
+    max_size = get_max_size()
+    with _process_cache_lock:
+        _process_cache.pop(package_id, None)
+        _process_cache[package_id] = (version, time.time() + get_ttl(), value)
+        while len(_process_cache) > max_size:
+            _process_cache.popitem(last=False)
+
+
+def invalidate(package_ids):
+    '''Removes the given datasets from the caches of this process.'''
+    request_cache = _get_request_cache()
+    with _process_cache_lock:
+        for package_id in package_ids:
+            _process_cache.pop(package_id, None)
+            if request_cache is not None:
+                request_cache.pop(package_id, None)
+
+
+def clear():
+    request_cache = _get_request_cache()
+    if request_cache is not None:
+        request_cache.clear()
+    with _process_cache_lock:
+        _process_cache.clear()
+
+
+def get_stats():
+    '''Returns the counts of hits and misses in this process, with the hit
+    ratios of each layer and overall (None before there are any lookups).'''
+    stats_ = dict(stats)
+    num_lookups = sum(stats.values())
+    hits = 0
+    for layer in ('request', 'process'):
+        hits += stats['%s_hits' % layer]
+        stats_['%s_hit_ratio' % layer] = \
+            float(stats['%s_hits' % layer]) / num_lookups \
+            if num_lookups else None
+    stats_['hit_ratio'] = float(hits) / num_lookups if num_lookups else None
+    return stats_
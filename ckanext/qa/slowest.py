@@ -0,0 +1,91 @@
+'''
+A ledger of the resources that were slowest to score, to find the files that
+make QA runs overrun (e.g. huge spreadsheets).
+
+For each resource it keeps the timing event of its latest scoring (see
+ckanext.qa.timing), which includes the time of each stage, the detectors that
+ran, the file size and the mimetype libmagic gave. Only the slowest
+qa.slowest_size resources are kept (by default none - the ledger is off).
+
+The ledger is kept in redis, so that it is shared by all the QA jobs and
+workers. See it with the command: qa slowest
+'''
+import json
+
+import six
+from redis import VERSION as REDIS_VERSION
+from redis.exceptions import RedisError
+
+from ckan.plugins.toolkit import config
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def get_max_size():
+    return int(config.get('qa.slowest_size', 0))
+
+
+def is_enabled():
+    return get_max_size() > 0
+
+
+def _connect_to_redis():
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+def _get_key():
+    return 'ckanext-qa:%s:slowest' % config.get('ckan.site_id')
+
+
+def _zadd(pipeline, key, member, score):
+    '''Adds a member to a sorted set. redis-py 3 changed the signature from
+    keyword arguments to a mapping, and CKAN < 2.9 comes with redis-py 2.'''
+    if REDIS_VERSION >= (3,):
+        pipeline.zadd(key, {member: score})
+    else:
+        pipeline.zadd(key, **{member: score})
+
+
+def add(event):
+    '''Records the timing event of scoring a resource, if it is one of the
+    slowest.'''
+    max_size = get_max_size()
+    key = _get_key()
+    resource_id = event['resource_id']
+    try:
+        redis = _connect_to_redis()
+        pipeline = redis.pipeline()
+        # durations are in a sorted set, and the events in a hash
+        _zadd(pipeline, key, resource_id, event['total'])
+        pipeline.hset(key + ':events', resource_id, json.dumps(event))
+        pipeline.zcard(key)
+        size = pipeline.execute()[-1]
+        if size > max_size:
+            fastest = redis.zrange(key, 0, size - max_size - 1)
+            if fastest:
+                pipeline = redis.pipeline()
+                pipeline.zrem(key, *fastest)
+                pipeline.hdel(key + ':events', *fastest)
+                pipeline.execute()
+    except RedisError as e:
+        # not worth failing the QA for
+        log.warning('Could not record the resource in the slowest ledger: %s',
+                    e)
+
+
+def get_slowest(limit=None):
+    '''Returns the timing events of the slowest resources, slowest first.'''
+    redis = _connect_to_redis()
+    key = _get_key()
+    resource_ids = redis.zrevrange(key, 0, (limit or 0) - 1)
+    if not resource_ids:
+        return []
+    events = redis.hmget(key + ':events', resource_ids)
+    return [json.loads(six.ensure_text(event)) for event in events if event]
+
+
+def clear():
+    _connect_to_redis().delete(_get_key(), _get_key() + ':events')
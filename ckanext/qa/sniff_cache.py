@@ -0,0 +1,139 @@
+'''
+A persistent cache of sniff_file_format results, so that an archived file
+that hasn't changed since it was last scored isn't sniffed again.
+
+Entries are keyed by the archiver's hash of the file contents, or failing
+that by the file's size, mtime and inode. Each records the
+SNIFF_DETECTOR_VERSION that produced it, so that upgrading the detection
+invalidates the old entries.
+
+It is enabled by setting config option qa.sniff_cache_size to the maximum
+number of entries to keep. When it is full the least recently used are
+evicted (checked every EVICTION_CHECK_INTERVAL puts).
+'''
+import datetime
+import json
+import os
+
+from sqlalchemy.exc import IntegrityError
+
+from ckan.plugins.toolkit import config
+
+from ckanext.qa.sniff_format import SNIFF_DETECTOR_VERSION
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Counts for this process
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+# Counting the entries to see if any need evicting takes a scan of the table,
+# so it is only done every this many puts. The cache can go over its size by
+# up to this many entries per worker in between.
+EVICTION_CHECK_INTERVAL = 100
+_state = {'puts_since_eviction_check': 0}
+
+
+def get_max_size():
+    return int(config.get('qa.sniff_cache_size', 0))
+
+
+def is_enabled():
+    return get_max_size() > 0
+
+
+def get_key(filepath, content_hash=None):
+    '''Returns the cache key for a file, or None if the file can't be
+    identified.'''
+    if content_hash:
+        return u'hash:%s' % content_hash
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return u'stat:%s:%.6f:%s:%s' % (stat.st_size, stat.st_mtime,
+                                    stat.st_dev, stat.st_ino)
+
+
+def get(key):
+    '''Returns (True, result) if there is a valid cached result for the key,
+    otherwise (False, None).
+
+    The change to the entry's last_used is committed with the session.'''
+    from ckan import model
+    from ckanext.qa.model import SniffResult
+    entry = model.Session.query(SniffResult).get(key)
+    if entry is None or entry.detector_version != SNIFF_DETECTOR_VERSION:
+        stats['misses'] += 1
+        return False, None
+    stats['hits'] += 1
+    entry.last_used = datetime.datetime.now()
+    return True, json.loads(entry.result)
+
+
+def put(key, result):
+    '''Stores a sniff_file_format result. Every EVICTION_CHECK_INTERVAL puts
+    (by this process) it evicts the least recently used entries, if the cache
+    is over its size.
+
+    If another worker has stored a result for the same key meanwhile, that is
+    kept (it is for the same contents), unless it is from another detector
+    version.
+
+    The changes are committed with the session.'''
+    from ckan import model
+    from ckanext.qa.model import SniffResult, expire_in_session
+    now = datetime.datetime.now()
+    row = {'key': key, 'detector_version': SNIFF_DETECTOR_VERSION,
+           'result': json.dumps(result), 'created': now, 'last_used': now}
+    if model.Session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        table = SniffResult.__table__
+        statement = insert(table).values(row)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_=dict((name, statement.excluded[name])
+                      for name in ('detector_version', 'result',
+                                   'last_used')),
+            where=(table.c.detector_version !=
+                   statement.excluded.detector_version))
+        model.Session.execute(statement)
+        expire_in_session(SniffResult, 'key', [key])
+    else:
+        entry = model.Session.query(SniffResult).get(key)
+        if entry is None:
+            try:
+                with model.Session.begin_nested():
+                    model.Session.add(SniffResult(**row))
+            except IntegrityError:
+                # stored by another worker meanwhile
+                pass
+        elif entry.detector_version != SNIFF_DETECTOR_VERSION:
+            for name in ('detector_version', 'result', 'last_used'):
+                setattr(entry, name, row[name])
+            model.Session.flush()
+
+    _state['puts_since_eviction_check'] += 1
+    if _state['puts_since_eviction_check'] >= EVICTION_CHECK_INTERVAL:
+        evict()
+
+
+def evict():
+    '''Evicts the least recently used entries beyond the cache's size.
+
+    The changes are committed with the session.'''
+    from ckan import model
+    from ckanext.qa.model import SniffResult
+    _state['puts_since_eviction_check'] = 0
+    num_excess = model.Session.query(SniffResult).count() - get_max_size()
+    if num_excess > 0:
+        keys = [key_ for (key_, ) in
+                model.Session.query(SniffResult.key)
+                .order_by(SniffResult.last_used)
+                .limit(num_excess)]
+        model.Session.query(SniffResult) \
+            .filter(SniffResult.key.in_(keys)) \
+            .delete(synchronize_session='fetch')
+        stats['evictions'] += len(keys)
+        log.info('Sniff cache evicted %i entries', len(keys))
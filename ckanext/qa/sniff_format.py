@@ -1,18 +1,23 @@
 # -*- coding: utf-8 -*-
 
-from io import BytesIO, open
+from io import open
 import sys
 import re
 import zipfile
 import os
+import mmap
+import struct
 from collections import defaultdict
-import subprocess
 
 import xlrd
 import magic
-import messytables
 
 from ckan.lib import helpers as ckan_helpers
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+from ckanext.qa import ole2
+from ckanext.qa.timing import detector, note
 
 
 if sys.version_info[0] >= 3:
@@ -23,7 +28,202 @@ import logging
 log = logging.getLogger(__name__)
 
 
-def sniff_file_format(filepath):
+# Increment this when a change to the detection could change the result for a
+# file, so that results cached by ckanext.qa.sniff_cache are not used
+SNIFF_DETECTOR_VERSION = 1
+
+# The largest prefix of the file that any of the text detectors looks at
+SNIFF_PREFIX_SIZE = 100000
+
+
+class SniffContext(object):
+    '''The file being sniffed, opened once and shared by all the detectors.
+
+    The file is memory-mapped (or if that is not possible, a bounded prefix of
+    it is read) so that detectors can be handed views of it without going back
+    to the filesystem. Text views are decoded as ISO-8859-1 with universal
+    newlines, i.e. the same as the detectors used to get from open().read(n),
+    and the decoded prefix is shared between them.
+
+    bytes_read counts the bytes of the file that were actually needed.
+    '''
+    def __init__(self, filepath, prefix_size=SNIFF_PREFIX_SIZE):
+        self.filepath = filepath
+        self.prefix_size = prefix_size
+        self.size = 0
+        self._prefix_read = 0  # high-water mark of the mapped/read prefix
+        self._other_read = 0  # read through fileobj()
+        self._whole_file_read = False
+        self._file = None
+        self._data = b''
+        self._mmapped = False
+        self._raw_length_decoded = 0
+        self._text = u''
+        self._compound_document = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        self._file = open(self.filepath, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            self._mmapped = True
+        except (ValueError, EnvironmentError):
+            # e.g. an empty file, or a filesystem that cannot be mapped
+            self._data = self._file.read(self.prefix_size)
+            self._prefix_read = len(self._data)
+
+    def close(self):
+        if self._mmapped:
+            self._data.close()
+            self._mmapped = False
+        self._data = b''
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    @property
+    def bytes_read(self):
+        if self._whole_file_read:
+            return self.size
+        return self._prefix_read + self._other_read
+
+    def _count(self, length):
+        if self._mmapped and length > self._prefix_read:
+            self._prefix_read = min(length, self.size)
+
+    def head(self, size):
+        '''Returns the first bytes of the file.'''
+        self._count(size)
+        return self._data[:size]
+
+    def text(self, size):
+        '''Returns the first "size" characters of the file, as if it had
+        been opened with: open(filepath, 'r', encoding='ISO-8859-1').'''
+        available = min(len(self._data), self.prefix_size)
+        raw_length = self._raw_length_decoded
+        while len(self._text) < size and raw_length < available:
+            # newline translation can only shrink the text, so decode at
+            # least as many bytes as characters are still needed
+            raw_length = min(raw_length + size - len(self._text), available)
+            if self._data[raw_length - 1:raw_length] == b'\r' and \
+                    raw_length < available:
+                # don't split a \r\n
+                raw_length += 1
+            self._text = _translate_newlines(
+                self._data[:raw_length].decode('ISO-8859-1'))
+        self._raw_length_decoded = raw_length
+        self._count(raw_length)
+        return self._text[:size]
+
+    def compound_document(self):
+        '''Returns the file as an ole2.CompoundDocument, or None if it is not
+        one.'''
+        if self._compound_document is None:
+            try:
+                self._compound_document = ole2.CompoundDocument(self.fileobj())
+            except ole2.CompoundDocumentError:
+                self._compound_document = False
+        return self._compound_document or None
+
+    def count_whole_file(self):
+        '''For detectors that read the file by themselves.'''
+        self._whole_file_read = True
+
+    def fileobj(self):
+        '''Returns a seekable file object for the whole file, for
+        detectors that need random access e.g. zipfile.'''
+        self._file.seek(0)
+        return _CountingFile(self._file, self)
+
+
+class _CountingFile(object):
+    '''Wraps a file object, adding what is read from it to the bytes_read of
+    the SniffContext.'''
+    def __init__(self, file_, ctx):
+        self._file = file_
+        self._ctx = ctx
+
+    def read(self, *args):
+        data = self._file.read(*args)
+        self._ctx._other_read += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def _translate_newlines(text):
+    return text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+
+
+# How much of the start of the file the signature table is checked against
+SIGNATURE_SIZE = 512
+
+
+def _zip_mime_type(head):
+    # The first entry's filename starts at offset 30. OpenDocument files store
+    # their mimetype, uncompressed, as the first entry.
+    if head[30:38] == b'mimetype' and head[8:10] == b'\x00\x00':
+        size, = struct.unpack('<I', head[18:22])
+        match = re.match(br'application/[\w.+-]+$', head[38:38 + size])
+        return match.group().decode('ascii') if match else None
+    if re.match(br'\[Content_Types\]\.xml|_rels/|META-INF/|mimetype',
+                head[30:]):
+        # Office Open XML, Java archive etc - libmagic looks further in
+        return None
+    return 'application/zip'
+
+
+def _xml_mime_type(head):
+    if re.search(br'<(!doctype\s+)?html', head, re.IGNORECASE):
+        # XHTML - leave it to libmagic, which may say it is HTML
+        return None
+    return 'text/xml'
+
+
+# Formats that can be identified with certainty from their first few bytes,
+# so there is no need to run libmagic on them. Each is (regex to match at the
+# start of the file, the mimetype libmagic gives it). Where the signature is
+# not conclusive on its own, a function of the head bytes gives the mimetype
+# or None.
+FILE_SIGNATURES = [
+    (br'PK\x03\x04', _zip_mime_type),
+    (br'%PDF-', 'application/pdf'),
+    (br'\x89PNG\r\n\x1a\n', 'image/png'),
+    (br'GIF8[79]a', 'image/gif'),
+    (br'II\*\x00|MM\x00\*', 'image/tiff'),
+    (br'\x1f\x8b', 'application/gzip'),
+    (br'(\xef\xbb\xbf)?<\?xml\s', _xml_mime_type),
+]
+_file_signatures = [(re.compile(regex), mime_type)
+                    for regex, mime_type in FILE_SIGNATURES]
+
+
+@detector
+def get_mime_type_from_signature(head):
+    '''Returns the mimetype for the given first bytes of a file, if they
+    match one of the FILE_SIGNATURES, otherwise None.'''
+    for signature_re, mime_type in _file_signatures:
+        if signature_re.match(head):
+            if callable(mime_type):
+                mime_type = mime_type(head)
+            return mime_type
+
+
+@detector
+def get_mime_type_from_magic(filepath):
+    return magic.from_file(filepath, mime=True)
+
+
+def sniff_file_format(filepath, use_signatures=True):
     '''For a given filepath, work out what file format it is.
 
     Returns a dict with format as a string, which is the format's canonical
@@ -35,52 +235,72 @@ def sniff_file_format(filepath):
           }
     or None if it can\'t tell what it is.
 
+    use_signatures - whether to identify the file from FILE_SIGNATURES where
+    possible, before resorting to libmagic.
+
     Note, log is a logger, either a Celery one or a standard Python logging
     one.
     '''
-    format_ = None
     log.info('Sniffing file format of: %s', filepath)
-    filepath_utf8 = filepath.encode('utf8') if isinstance(filepath, unicode) \
-        else filepath
-    mime_type = magic.from_file(filepath_utf8, mime=True)
-    log.info('Magic detects file as: %s', mime_type)
+    with SniffContext(filepath) as ctx:
+        format_ = _sniff_file_format(ctx, use_signatures)
+        log.info('Sniffing read %i of %i bytes of: %s',
+                 ctx.bytes_read, ctx.size, filepath)
+        note('file_size', ctx.size)
+    return format_
+
+
+def _sniff_file_format(ctx, use_signatures=True):
+    format_ = None
+    filepath = ctx.filepath
+    mime_type = None
+    if use_signatures:
+        head = ctx.head(SIGNATURE_SIZE)
+        mime_type = get_mime_type_from_signature(head)
+        if not mime_type and head.startswith(ole2.SIGNATURE):
+            mime_type = get_ole2_mime_type(ctx)
+        if mime_type:
+            log.info('File signature detects file as: %s', mime_type)
+    if not mime_type:
+        filepath_utf8 = filepath.encode('utf8') \
+            if isinstance(filepath, unicode) else filepath
+        mime_type = get_mime_type_from_magic(filepath_utf8)
+        log.info('Magic detects file as: %s', mime_type)
+        note('magic_mime_type', mime_type)
     if mime_type:
         if mime_type in ('application/xml', 'text/xml'):
-            with open(filepath, 'r', encoding='ISO-8859-1') as f:
-                buf = f.read(5000)
+            buf = ctx.text(5000)
             format_ = get_xml_variant_including_xml_declaration(buf)
         elif mime_type == 'application/zip':
-            format_ = get_zipped_format(filepath)
+            format_ = get_zipped_format(ctx)
         elif mime_type in ('application/msword', 'application/vnd.ms-office'):
             # In the past Magic gives the msword mime-type for Word and other
-            # MS Office files too, so use BSD File to be sure which it is.
-            format_ = run_bsd_file(filepath)
-            if not format_ and is_excel(filepath):
+            # MS Office files too, so look inside to be sure which it is.
+            format_ = inspect_binary_file(ctx)
+            if not format_ and is_excel(ctx):
                 format_ = {'format': 'XLS'}
         elif mime_type == 'application/octet-stream':
             # Excel files sometimes come up as this
-            if is_excel(filepath):
+            if is_excel(ctx):
                 format_ = {'format': 'XLS'}
             else:
                 # e.g. Shapefile
-                format_ = run_bsd_file(filepath)
+                format_ = inspect_binary_file(ctx)
             if not format_:
-                with open(filepath, 'r', encoding='ISO-8859-1') as f:
-                    buf = f.read(500)
+                buf = ctx.text(500)
                 format_ = is_html(buf)
         elif mime_type == 'text/html':
             # Magic can mistake IATI for HTML
-            with open(filepath, 'r', encoding='ISO-8859-1') as f:
-                buf = f.read(100)
+            buf = ctx.text(100)
             if is_iati(buf):
                 format_ = {'format': 'IATI'}
+        elif mime_type in ('application/json', 'application/x-ndjson'):
+            # Magic doesn't distinguish GeoJSON
+            buf = ctx.text(10000)
+            format_ = get_json_format(buf)
         elif mime_type == 'application/csv':
-            with open(filepath, 'r', encoding='ISO-8859-1', newline=None) as f:
-                buf = f.read(10000)
-            if is_csv(buf):
-                format_ = {'format': 'CSV'}
-            elif is_psv(buf):
-                format_ = {'format': 'PSV'}
+            buf = ctx.text(10000)
+            format_ = get_delimited_format(buf)
 
         if format_:
             return format_
@@ -91,16 +311,9 @@ def sniff_file_format(filepath):
 
         if not format_:
             if mime_type.startswith('text/'):
-                # is it JSON?
-                with open(filepath, 'r', encoding='ISO-8859-1', newline=None) as f:
-                    buf = f.read(10000)
-                if is_json(buf):
-                    format_ = {'format': 'JSON'}
-                # is it CSV?
-                elif is_csv(buf):
-                    format_ = {'format': 'CSV'}
-                elif is_psv(buf):
-                    format_ = {'format': 'PSV'}
+                # is it JSON or CSV?
+                buf = ctx.text(10000)
+                format_ = get_json_format(buf) or get_delimited_format(buf)
 
         if not format_:
             log.warning('Mimetype not recognised by CKAN as a data format: %s',
@@ -111,16 +324,11 @@ def sniff_file_format(filepath):
                      format_['format'])
 
             if format_['format'] == 'TXT':
-                # is it JSON?
-                with open(filepath, 'r', encoding='ISO-8859-1', newline=None) as f:
-                    buf = f.read(10000)
-                if is_json(buf):
-                    format_ = {'format': 'JSON'}
-                # is it CSV?
-                elif is_csv(buf):
-                    format_ = {'format': 'CSV'}
-                elif is_psv(buf):
-                    format_ = {'format': 'PSV'}
+                # is it JSON or CSV?
+                buf = ctx.text(10000)
+                text_format = get_json_format(buf) or get_delimited_format(buf)
+                if text_format:
+                    format_ = text_format
                 # XML files without the "<?xml ... ?>" tag end up here
                 elif is_xml_but_without_declaration(buf):
                     format_ = get_xml_variant_without_xml_declaration(buf)
@@ -129,131 +337,257 @@ def sniff_file_format(filepath):
 
             elif format_['format'] == 'HTML':
                 # maybe it has RDFa in it
-                with open(filepath, 'r', encoding='ISO-8859-1') as f:
-                    buf = f.read(100000)
+                buf = ctx.text(100000)
                 if has_rdfa(buf):
                     format_ = {'format': 'RDFa'}
 
     else:
         # Excel files sometimes not picked up by magic, so try alternative
-        if is_excel(filepath):
+        if is_excel(ctx):
             format_ = {'format': 'XLS'}
-        # BSD file picks up some files that Magic misses
+        # Looking inside picks up some files that Magic misses
         # e.g. some MS Word files
         if not format_:
-            format_ = run_bsd_file(filepath)
+            format_ = inspect_binary_file(ctx)
 
     if not format_:
         log.warning('Could not detect format of file: %s', filepath)
     return format_
 
 
-def is_json(buf):
-    '''Returns whether this text buffer (potentially truncated) is in
-    JSON format.'''
-    string = '"[^"]*"'
-    string_re = re.compile(string)
-    number_re = re.compile(r'-?\d+(\.\d+)?([eE][+-]?\d+)?')
-    extra_values_re = re.compile('true|false|null')
-    object_start_re = re.compile(r'{%s:\s?' % string)
-    object_middle_re = re.compile(r'%s:\s?' % string)
-    object_end_re = re.compile('}')
-    comma_re = re.compile(r',\s?')
-    array_start_re = re.compile(r'\[')
-    array_end_re = re.compile(r'\]')
-    any_value_regexs = [string_re, number_re, object_start_re, array_start_re, extra_values_re]
-
-    # simplified state machine - just looks at stack of object/array and
-    # ignores contents of them, beyond just being simple JSON bits
-    pos = 0
-    state_stack = []  # stack of 'object', 'array'
-    number_of_matches = 0
-    while pos < len(buf):
-        part_of_buf = buf[pos:]
-        if pos == 0:
-            potential_matches = (object_start_re, array_start_re, string_re, number_re, extra_values_re)
-        elif not state_stack:
-            # cannot have content beyond the first byte that is not nested
-            return False
-        elif state_stack[-1] == 'object':
-            # any value
-            potential_matches = [comma_re, object_middle_re, object_end_re] + any_value_regexs
-        elif state_stack[-1] == 'array':
-            # any value or end it
-            potential_matches = any_value_regexs + [comma_re, array_end_re]
-        for matcher in potential_matches:
-            if matcher.match(part_of_buf):
-                if matcher in any_value_regexs and state_stack and state_stack[-1] == 'comma':
-                    state_stack.pop()
-                if matcher == object_start_re:
-                    state_stack.append('object')
-                elif matcher == array_start_re:
-                    state_stack.append('array')
-                elif matcher in (object_end_re, array_end_re):
-                    try:
-                        state_stack.pop()
-                    except IndexError:
-                        # nothing to pop
-                        log.info('Not JSON - %i matches', number_of_matches)
-                        return False
+# Tokens of JSON, for get_json_format(). Each is matched in place with
+# regex.match(buf, pos), so the buffer is never copied.
+_json_whitespace_re = re.compile(r'[ \t\r\n]*')
+_json_line_whitespace_re = re.compile(r'[ \t\r]*')
+_json_string_re = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+_json_number_re = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?')
+_json_literal_re = re.compile(r'true|false|null')
+# what may be left of a value when the buffer is cut off part way through it
+_json_truncated_value_re = re.compile(
+    r'(?:"[^"\\]*(?:\\.[^"\\]*)*\\?|-?\d*(?:\.\d*)?(?:[eE][+-]?\d*)?'
+    r'|t(?:ru?)?|f(?:a(?:ls?)?)?|n(?:ul?)?)\Z')
+# the token to expect, given the first character of a value
+_json_scalar_res = {'"': _json_string_re, '-': _json_number_re,
+                    't': _json_literal_re, 'f': _json_literal_re,
+                    'n': _json_literal_re}
+_json_scalar_res.update((digit, _json_number_re) for digit in '0123456789')
+_json_closing_chars = {'{': '}', '[': ']'}
+
+# Values of the "type" member of a GeoJSON object
+GEOJSON_TYPES = set((
+    'FeatureCollection', 'Feature', 'GeometryCollection', 'Point',
+    'MultiPoint', 'LineString', 'MultiLineString', 'Polygon', 'MultiPolygon'))
+
+# JSON detection stops once this many tokens have been seen to be valid
+JSON_MAX_TOKENS = 200
+
+# get_json_format() states
+(_JSON_VALUE, _JSON_VALUE_OR_END, _JSON_KEY, _JSON_KEY_OR_END, _JSON_COLON,
+ _JSON_COMMA_OR_END) = range(6)
+
+
+@detector
+def get_json_format(buf):
+    '''If this text buffer (potentially truncated) is JSON, return the format
+    type: GeoJSON, or otherwise JSON. Newline-delimited JSON (a JSON object or
+    array on each line) counts as JSON.
+
+    The buffer is tokenized in a single pass, keeping only a stack of the
+    open objects/arrays, and up to JSON_MAX_TOKENS tokens are checked, so the
+    time taken doesn't depend on the size of the buffer.
+    '''
+    length = len(buf)
+    stack = []  # of '{' and '['
+    state = _JSON_VALUE
+    key = None  # the latest key of the top-level object
+    is_geojson = False
+    num_tokens = 0
+    num_lines = 0  # of top-level values
+    pos = _json_whitespace_re.match(buf).end()
+    mismatch = True
+    while pos < length and num_tokens < JSON_MAX_TOKENS:
+        char = buf[pos]
+        value_ended = False
+        if state in (_JSON_VALUE, _JSON_VALUE_OR_END):
+            if char == '{':
+                stack.append(char)
+                state = _JSON_KEY_OR_END
+                pos += 1
+            elif char == '[':
+                stack.append(char)
+                state = _JSON_VALUE_OR_END
+                pos += 1
+            elif char == ']' and state == _JSON_VALUE_OR_END:
+                stack.pop()
+                value_ended = True
+                pos += 1
+            else:
+                match = char in _json_scalar_res and \
+                    _json_scalar_res[char].match(buf, pos)
+                if not match:
+                    break
+                if len(stack) == 1 and key == '"type"' and not num_lines \
+                        and match.group()[1:-1] in GEOJSON_TYPES:
+                    is_geojson = True
+                value_ended = True
+                pos = match.end()
+        elif state in (_JSON_KEY, _JSON_KEY_OR_END):
+            if char == '}' and state == _JSON_KEY_OR_END:
+                stack.pop()
+                value_ended = True
+                pos += 1
+            else:
+                match = char == '"' and _json_string_re.match(buf, pos)
+                if not match:
+                    break
+                if len(stack) == 1:
+                    key = match.group()
+                state = _JSON_COLON
+                pos = match.end()
+        elif state == _JSON_COLON:
+            if char != ':':
                 break
-        else:
-            # no match
-            log.info('Not JSON - %i matches', number_of_matches)
-            return False
-        match_length = matcher.match(part_of_buf).end()
-        # print "MATCHED %r %r %s" % (matcher.match(part_of_buf).string[:match_length], matcher.pattern, state_stack)
-        pos += match_length
-        number_of_matches += 1
-        if number_of_matches > 5:
-            log.info('JSON detected: %i matches', number_of_matches)
-            return True
-
-    log.info('JSON detected: %i matches', number_of_matches)
-    return True
-
-
-def is_csv(buf):
-    '''If the buffer is a CSV file then return True.'''
-    buf_rows = BytesIO(buf.encode('ISO-8859-1'))
-    table_set = messytables.CSVTableSet(buf_rows)
-    return _is_spreadsheet(table_set, 'CSV')
-
+            state = _JSON_VALUE
+            pos += 1
+        elif state == _JSON_COMMA_OR_END:
+            if char == ',':
+                state = _JSON_KEY if stack[-1] == '{' else _JSON_VALUE
+            elif char == _json_closing_chars[stack[-1]]:
+                stack.pop()
+                value_ended = True
+            else:
+                break
+            pos += 1
+        num_tokens += 1
 
-def is_psv(buf):
-    '''If the buffer is a PSV file then return True.'''
-    buf_rows = BytesIO(buf.encode('ISO-8859-1'))
-    table_set = messytables.CSVTableSet(buf_rows, delimiter='|')
-    return _is_spreadsheet(table_set, 'PSV')
+        if value_ended:
+            if stack:
+                state = _JSON_COMMA_OR_END
+            else:
+                # A complete top-level value. Only whitespace may follow it,
+                # unless it starts another line of newline-delimited JSON.
+                num_lines += 1
+                pos = _json_line_whitespace_re.match(buf, pos).end()
+                if pos < length and buf[pos] != '\n':
+                    break
+                pos = _json_whitespace_re.match(buf, pos).end()
+                if pos < length and \
+                        (buf[pos] not in '{[' or char not in '}]'):
+                    break
+                state = _JSON_VALUE
+        pos = _json_whitespace_re.match(buf, pos).end()
+    else:
+        mismatch = False
+
+    if mismatch and not (
+            stack and state in (_JSON_VALUE, _JSON_VALUE_OR_END,
+                                _JSON_KEY, _JSON_KEY_OR_END) and
+            _json_truncated_value_re.match(buf, pos)):
+        log.info('Not JSON - %i tokens', num_tokens)
+        return None
+    if not num_tokens:
+        log.info('Not JSON - empty')
+        return None
+    if is_geojson:
+        log.info('GeoJSON detected: %i tokens', num_tokens)
+        return {'format': 'GeoJSON'}
+    log.info('JSON detected: %i tokens, %i lines', num_tokens, num_lines)
+    return {'format': 'JSON'}
 
 
-def _is_spreadsheet(table_set, format):
+def is_json(buf):
+    '''Returns whether this text buffer (potentially truncated) is in
+    JSON format.'''
+    return bool(get_json_format(buf))
+
+
+# Delimiters of tabular text, in order of preference, and the format each
+# indicates
+DELIMITED_FORMATS = ((',', 'CSV'), ('\t', 'TSV'), (';', 'CSV'), ('|', 'PSV'))
+# a quoted field, which may contain delimiters and newlines
+_quoted_field_re = re.compile(r'(?:^|(?<=[,\t;|]))"[^"]*(?:""[^"]*)*"',
+                              re.MULTILINE)
+_field_start_quote_re = re.compile(r'(?:^|(?<=[,\t;|]))"', re.MULTILINE)
+# a delimiter is only chosen if it splits this proportion of the lines (net
+# of the lines it splits differently) into the same number of cells
+DELIMITER_CONSISTENCY = 0.9
+
+
+@detector
+def get_delimited_format(buf):
+    '''If this text buffer (potentially truncated) is a table of delimited
+    values, return the format type: CSV, TSV or PSV.
+
+    Quoted fields are blanked out, then all the candidate delimiters on each
+    line are counted in a single pass. The delimiter is the one that splits
+    the lines most consistently (as csv.Sniffer does), then into the most
+    cells, otherwise comma. If that doesn't give enough cells per row, pipe
+    is tried too.
+    '''
+    if buf.startswith((u'\xff\xfe', u'\xfe\xff')):
+        # UTF-16 (the buffer is bytes decoded as ISO-8859-1)
+        buf = buf.encode('ISO-8859-1').decode('utf-16', 'ignore')
+    if '\x00' in buf:
+        log.info('Not delimited - contains null characters')
+        return None
+    buf = _quoted_field_re.sub('_', buf)
+    unclosed_quote = _field_start_quote_re.search(buf)
+    if unclosed_quote:
+        # the quoted field carries on to the end of the buffer
+        buf = buf[:unclosed_quote.start()] + '_'
+
+    # for each delimiter, the number of cells in each (non-blank) line
+    cells_per_row = dict((delimiter, []) for delimiter, _ in DELIMITED_FORMATS)
+    for line in buf.split('\n'):
+        if line:
+            for delimiter, cells in cells_per_row.items():
+                cells.append(line.count(delimiter) + 1)
+    num_rows = len(cells_per_row[','])
+    if not num_rows:
+        log.info('Not delimited - no rows')
+        return None
+
+    consistent_delimiters = []
+    for preference, (delimiter, _) in enumerate(DELIMITED_FORMATS):
+        histogram = defaultdict(int)
+        for cells in cells_per_row[delimiter]:
+            histogram[cells] += 1
+        mode, num_mode_rows = max(histogram.items(),
+                                  key=lambda item: (item[1], item[0]))
+        consistency = float(2 * num_mode_rows - num_rows) / num_rows
+        if mode > 1 and consistency >= DELIMITER_CONSISTENCY:
+            consistent_delimiters.append(
+                (-consistency, -mode, preference, delimiter))
+    delimiter = min(consistent_delimiters)[-1] if consistent_delimiters else ','
+
+    formats = dict(DELIMITED_FORMATS)
+    # pipe-separated files often have few pipes, so try them anyway
+    for delimiter in [delimiter] if delimiter == '|' else [delimiter, '|']:
+        if _is_spreadsheet(cells_per_row[delimiter], formats[delimiter]):
+            return {'format': formats[delimiter]}
+    return None
+
+
+def _is_spreadsheet(row_cell_counts, format):
     def get_cells_per_row(num_cells, num_rows):
         if not num_rows:
             return 0
         return float(num_cells) / float(num_rows)
 
     num_cells = num_rows = 0
-    try:
-        table = table_set.tables[0]
-        # Iterate through the table.sample (sample because otherwise
-        # it will barf if there is an unclosed string at the end)
-        for row in table.sample:
-            if row:
-                # Must have enough cells
-                num_cells += len(row)
-                num_rows += 1
-                if num_cells > 20 or num_rows > 10:
-                    cells_per_row = get_cells_per_row(num_cells, num_rows)
-                    # over the long term, 2 columns is the minimum
-                    if cells_per_row > 1.9:
-                        log.info('Is %s because %.1f cells per row (%i cells, %i rows)',
-                                 format,
-                                 get_cells_per_row(num_cells, num_rows),
-                                 num_cells, num_rows)
-                        return True
-    finally:
-        pass
+    for row_cells in row_cell_counts:
+        # Must have enough cells
+        num_cells += row_cells
+        num_rows += 1
+        if num_cells > 20 or num_rows > 10:
+            cells_per_row = get_cells_per_row(num_cells, num_rows)
+            # over the long term, 2 columns is the minimum
+            if cells_per_row > 1.9:
+                log.info('Is %s because %.1f cells per row (%i cells, %i rows)',
+                         format,
+                         get_cells_per_row(num_cells, num_rows),
+                         num_cells, num_rows)
+                return True
     # if file is short then be more lenient
     if num_cells > 3 or num_rows > 1:
         cells_per_row = get_cells_per_row(num_cells, num_rows)
@@ -269,6 +603,7 @@ def _is_spreadsheet(table_set, format):
     return False
 
 
+@detector
 def is_html(buf):
     '''If this buffer is HTML, return that format type, else None.'''
     xml_re = r'.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<html[^>]*>'
@@ -279,6 +614,7 @@ def is_html(buf):
     log.debug('Not HTML')
 
 
+@detector
 def is_iati(buf):
     '''If this buffer is IATI format, return that format type, else None.'''
     xml_re = r'.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<iati-(activities|organisations)[^>]*>'
@@ -289,6 +625,7 @@ def is_iati(buf):
     log.debug('Not IATI')
 
 
+@detector
 def is_xml_but_without_declaration(buf):
     '''Decides if this is a buffer of XML, but missing the usual <?xml ...?>
     tag.'''
@@ -308,6 +645,7 @@ def is_xml_but_without_declaration(buf):
     return False
 
 
+@detector
 def get_xml_variant_including_xml_declaration(buf):
     '''If this buffer is in a format based on XML and has the <xml>
     declaration, return the format type.'''
@@ -315,6 +653,7 @@ def get_xml_variant_including_xml_declaration(buf):
     log.debug('XML declaration not found: %s', buf)
 
 
+@detector
 def get_xml_variant_without_xml_declaration(buf):
     '''If this buffer is in a format based on XML, without any XML declaration
     or other boilerplate, return the format type.'''
@@ -362,6 +701,7 @@ def get_xml_variant_without_xml_declaration(buf):
     return {'format': 'XML'}
 
 
+@detector
 def has_rdfa(buf):
     '''If the buffer HTML contains RDFa then this returns True'''
     # quick check for the key words
@@ -384,8 +724,9 @@ def has_rdfa(buf):
     return True
 
 
-def get_zipped_format(filepath):
-    '''For a given zip file, return the format of file inside.
+@detector
+def get_zipped_format(ctx):
+    '''For a given zip file (SniffContext), return the format of file inside.
     For multiple files, choose by the most open, and then by the most
     popular extension.'''
     from ckanext.qa.lib import resource_format_scores
@@ -393,7 +734,7 @@ def get_zipped_format(filepath):
     try:
         # note: Cannot use "with" with a zipfile before python 2.7
         #       so we have to close it manually.
-        zip = zipfile.ZipFile(filepath, 'r')
+        zip = zipfile.ZipFile(ctx.fileobj(), 'r')
         try:
             filepaths = zip.namelist()
         finally:
@@ -452,9 +793,57 @@ def get_zipped_format(filepath):
     return format_
 
 
-def is_excel(filepath):
+# Opcodes of the BOF record that starts a BIFF2-8 stream
+EXCEL_BOF_OPCODES = (0x0009, 0x0209, 0x0409, 0x0809)
+
+
+@detector
+def is_excel(ctx, validate=None):
+    '''Returns whether the file (SniffContext) is an Excel (XLS) workbook.
+
+    This only looks at the file's structure - for a Workbook (or Book) stream
+    in an OLE2 document, or the BOF record of a bare BIFF stream - so the cost
+    doesn't grow with the size of the spreadsheet. With validate=True (default
+    from config option qa.sniff_validate_excel) the workbook is also opened by
+    xlrd, loading just the first sheet, to check it really can be read.
+    '''
+    if validate is None:
+        validate = toolkit.asbool(config.get('qa.sniff_validate_excel', False))
+    doc = ctx.compound_document()
+    if doc:
+        try:
+            stream_names = doc.stream_names()
+        except ole2.CompoundDocumentError as e:
+            log.info('Not Excel - OLE2 directory could not be read: %s', e)
+            return False
+        if 'Workbook' not in stream_names and 'Book' not in stream_names:
+            log.info('Not Excel - no workbook stream in the OLE2 document')
+            return False
+    else:
+        head = ctx.head(4)
+        if len(head) < 4:
+            log.info('Not Excel - too short')
+            return False
+        opcode, length = struct.unpack('<HH', head)
+        if opcode not in EXCEL_BOF_OPCODES or not 4 <= length <= 20:
+            log.info('Not Excel - no BOF record')
+            return False
+    if validate:
+        ctx.count_whole_file()
+        return is_excel_readable(ctx.filepath)
+    log.info('Excel workbook structure detected')
+    return True
+
+
+def is_excel_readable(filepath):
+    '''Returns whether xlrd can open the workbook and its first sheet.'''
     try:
-        xlrd.open_workbook(filepath)
+        book = xlrd.open_workbook(filepath, on_demand=True)
+        try:
+            if book.nsheets:
+                book.sheet_by_index(0)
+        finally:
+            book.release_resources()
     except Exception as e:
         log.info('Not Excel - failed to load: %s %s', e, e.args)
         return False
@@ -463,51 +852,85 @@ def is_excel(filepath):
         return True
 
 
-# same as the python 2.7 subprocess.check_output
-def check_output(*popenargs, **kwargs):
-    if 'stdout' in kwargs:
-        raise ValueError('stdout argument not allowed, it will be overridden.')
-    process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
-    output, unused_err = process.communicate()
-    retcode = process.poll()
-    if retcode:
-        cmd = kwargs.get("args")
-        if cmd is None:
-            cmd = popenargs[0]
-        raise Exception('Non-zero exit status %s: %s' % (retcode, output))
-    return output
-
-
-def run_bsd_file(filepath):
-    '''Run the BSD command-line tool "file" to determine file type. Returns
-    a format dict or None if it fails.'''
-    result = check_output(['file', filepath])
-    match = re.search(b'Name of Creating Application: ([^,]*),', result)
-    if match:
-        app_name = match.groups()[0]
-        format_map = {'Microsoft Office PowerPoint': 'ppt',
-                      'Microsoft PowerPoint': 'ppt',
-                      'Microsoft Excel': 'xls',
-                      'Microsoft Office Word': 'doc',
-                      'Microsoft Word 10.0': 'doc',
-                      'Microsoft Macintosh Word': 'doc',
-                      }
-        if app_name in format_map:
-            extension = format_map[app_name]
+# "Name of Creating Application" recorded in an OLE2 document: extension
+OLE2_APPLICATION_FORMATS = {
+    'Microsoft Office PowerPoint': 'ppt',
+    'Microsoft PowerPoint': 'ppt',
+    'Microsoft Excel': 'xls',
+    'Microsoft Office Word': 'doc',
+    'Microsoft Word 10.0': 'doc',
+    'Microsoft Macintosh Word': 'doc',
+}
+
+# A stream found in an OLE2 document: the mimetype libmagic gives it
+OLE2_STREAM_MIME_TYPES = (
+    ('WordDocument', 'application/msword'),
+    ('Workbook', 'application/vnd.ms-excel'),
+    ('Book', 'application/vnd.ms-excel'),  # Excel 5.0/95
+    ('PowerPoint Document', 'application/vnd.ms-powerpoint'),
+)
+
+
+@detector
+def get_ole2_mime_type(ctx):
+    '''For an OLE2 compound document (SniffContext), returns the mimetype
+    that its streams show it to be, or None.'''
+    doc = ctx.compound_document()
+    if not doc:
+        return None
+    try:
+        stream_names = doc.stream_names()
+    except ole2.CompoundDocumentError as e:
+        log.info('OLE2 directory could not be read: %s', e)
+        return None
+    for stream_name, mime_type in OLE2_STREAM_MIME_TYPES:
+        if stream_name in stream_names:
+            return mime_type
+
+
+@detector
+def inspect_binary_file(ctx):
+    '''Looks inside a binary file (SniffContext) for the things the BSD
+    "file" tool would report: the creating application of an OLE2 (MS Office)
+    document, or the header of an ESRI Shapefile. Returns a format dict or
+    None.'''
+    doc = ctx.compound_document()
+    if doc:
+        try:
+            app_name = doc.creating_application()
+        except ole2.CompoundDocumentError as e:
+            log.info('OLE2 SummaryInformation could not be read: %s', e)
+            app_name = None
+        if app_name in OLE2_APPLICATION_FORMATS:
+            extension = OLE2_APPLICATION_FORMATS[app_name]
             format_tuple = ckan_helpers.resource_formats()[extension]
-            log.info('"file" detected file format: %s',
+            log.info('OLE2 creating application detected file format: %s',
                      format_tuple[2])
             return {'format': format_tuple[1]}
-    match = re.search(b': ESRI Shapefile', result)
-    if match:
-        format_ = {'format': 'SHP'}
-        log.info('"file" detected file format: %s',
-                 format_['format'])
-        return format_
-    log.info('"file" could not determine file format of "%s": %s',
-             filepath, result)
+        log.info('OLE2 creating application not recognised: %r', app_name)
+        return None
+    if is_shapefile(ctx.head(SHAPEFILE_HEADER_SIZE)):
+        log.info('Shapefile header detected')
+        return {'format': 'SHP'}
+    log.info('Could not determine file format from its header: %s',
+             ctx.filepath)
+
+
+SHAPEFILE_HEADER_SIZE = 100
+
+
+def is_shapefile(head):
+    '''Returns whether these first bytes of a file are the header of an ESRI
+    Shapefile (main file): big-endian file code 9994, five unused zero ints,
+    then little-endian version 1000.'''
+    if len(head) < SHAPEFILE_HEADER_SIZE:
+        return False
+    file_code, unused, version = struct.unpack('>I20s4x4s', head[:32])
+    return file_code == 9994 and unused == b'\x00' * 20 and \
+        struct.unpack('<I', version)[0] == 1000
 
 
+@detector
 def is_ttl(buf):
     '''If the buffer is a Turtle RDF file then return True.'''
     # Turtle spec: "Turtle documents may have the strings '@prefix' or '@base' (case dependent) near the
@@ -4,15 +4,24 @@ Berners-Lee\'s five stars of openness
 '''
 import sys
 import datetime
+import hashlib
 import json
 import os
 import traceback
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from ckan.common import _
 
 from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
 import ckan.lib.helpers as ckan_helpers
-from ckanext.qa.sniff_format import sniff_file_format
+from ckanext.qa.sniff_format import sniff_file_format, SNIFF_DETECTOR_VERSION
+from ckanext.qa import sniff_cache
+from ckanext.qa import reindex
+from ckanext.qa import timing
+from ckanext.qa import slowest
+from ckanext.qa import show_cache
 from ckanext.archiver.model import Archival, Status
 
 import logging
@@ -25,13 +34,19 @@ if sys.version_info[0] >= 3:
 if toolkit.check_ckan_version(max_version='2.6.99'):
     from ckan.lib import celery_app
 
+    # compat_enqueue adds the queue name to the args for Celery, which the
+    # tasks don't need
     @celery_app.celery.task(name="qa.update_package")
-    def update_package_celery(*args, **kwargs):
-        update_package(*args, **kwargs)
+    def update_package_celery(package_id, queue=None, **kwargs):
+        update_package(package_id, **kwargs)
 
     @celery_app.celery.task(name="qa.update")
-    def update_celery(*args, **kwargs):
-        update(*args, **kwargs)
+    def update_celery(resource_id, queue=None, **kwargs):
+        update(resource_id, **kwargs)
+
+    @celery_app.celery.task(name="qa.flush_search_index")
+    def flush_search_index_celery(*args, **kwargs):
+        flush_search_index()
 
 
 import logging
@@ -42,6 +57,10 @@ class QAError(Exception):
     pass
 
 
+# Default for optional arguments, meaning the object is to be looked up in the
+# db (because None means that it doesn't exist)
+_LOOKUP = object()
+
 # Description of each score, used elsewhere
 OPENNESS_SCORE_DESCRIPTION = {
     0: 'Not obtainable or license is not open',
@@ -53,41 +72,114 @@ OPENNESS_SCORE_DESCRIPTION = {
 }
 
 
-def update_package(package_id):
+def update_package(package_id, incremental=False):
     """
     Given a package, calculates an openness score for each of its resources.
     It is more efficient to call this than 'update' for each resource.
 
-    Returns None
+    If incremental is set, resources whose fingerprint (see
+    resource_fingerprint) is unchanged since they were last scored are skipped,
+    and the search index is only updated if a score changes.
+
+    Returns a dict with keys:
+
+        'rescored': number of resources that were scored (int)
+        'skipped': number of resources skipped as unchanged (int)
     """
 
     try:
-        update_package_(package_id)
+        return update_package_(package_id, incremental=incremental)
     except Exception as e:
         log.error('Exception occurred during QA update_package: %s: %s',
                   e.__class__.__name__, unicode(e))
         raise
+    finally:
+        reindex.job_done()
 
 
-def update_package_(package_id):
+def update_package_(package_id, incremental=False):
     from ckan import model
+    from ckanext.qa.model import QA
     package = model.Package.get(package_id)
     if not package:
         raise QAError('Package ID not found: %s' % package_id)
 
-    log.info('Openness scoring package %s (%i resources)', package.name,
-             len(package.resources))
-
+    log.info('Openness scoring package %s (%i resources)%s', package.name,
+             len(package.resources), ' incrementally' if incremental else '')
+    timer = timing.Timer('update_package', package_id=package.id)
+
+    # Get the archivals and previous QA results for all the resources up
+    # front, rather than querying for each resource
+    with timer.stage('prefetch'):
+        archivals = dict((archival.resource_id, archival)
+                         for archival in Archival.get_for_package(package.id))
+        qas = dict((qa.resource_id, qa)
+                   for qa in model.Session.query(QA)
+                   .filter(QA.package_id == package.id))
+
+    counts = {'rescored': 0, 'skipped': 0}
+    resources = []
     for resource in package.resources:
-        qa_result = resource_score(resource)
+        qa = qas.get(resource.id)
+        if incremental and qa and qa.fingerprint == \
+                resource_fingerprint(resource, archivals.get(resource.id)):
+            log.info('Resource unchanged - skipping: %s', resource.id)
+            counts['skipped'] += 1
+            continue
+        resources.append(resource)
+
+    resource_timers = dict(
+        (resource.id, timing.Timer('resource_score', resource_id=resource.id))
+        for resource in resources)
+    num_threads = get_sniff_threads()
+    if num_threads > 1:
+        with timer.stage('sniff_in_threads'):
+            sniffed_formats = sniff_archived_files(
+                [archivals[resource.id] for resource in resources
+                 if resource.id in archivals], num_threads, resource_timers)
+    else:
+        sniffed_formats = {}
+
+    changed = False
+    results = []
+    for resource in resources:
+        qa = qas.get(resource.id)
+        previous_result = (qa.openness_score, qa.openness_score_reason,
+                           qa.format) if incremental and qa else None
+        with timer.stage('score'):
+            qa_result = resource_score(
+                resource, archival=archivals.get(resource.id), qa=qa,
+                sniffed_format=sniffed_formats.get(resource.id, _LOOKUP),
+                timer=resource_timers[resource.id])
         log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
                  resource.url)
-        save_qa_result(resource, qa_result)
-        log.info('CKAN updated with openness score')
-
-    # Refresh the index for this dataset, so that it contains the latest
-    # qa info
-    _update_search_index(package.id)
+        results.append((resource, qa_result))
+        counts['rescored'] += 1
+        if previous_result != (qa_result['openness_score'],
+                               qa_result['openness_score_reason'],
+                               qa_result['format']):
+            changed = True
+
+    # all the results are written in one statement
+    with timer.stage('save'):
+        save_qa_results(results)
+    log.info('CKAN updated with openness scores')
+
+    if sniff_cache.is_enabled():
+        log.info('Sniff cache: %(hits)i hits, %(misses)i misses, '
+                 '%(evictions)i evictions', sniff_cache.stats)
+
+    if changed or not incremental:
+        # Refresh the index for this dataset, so that it contains the latest
+        # qa info
+        with timer.stage('reindex'):
+            _update_search_index(package.id)
+    else:
+        log.info('No scores changed - search index not updated')
+    log.info('Openness scoring package %s done: %i rescored, %i skipped',
+             package.name, counts['rescored'], counts['skipped'])
+    timer.emit(**counts)
+    return counts
 
 
 def update(resource_id):
@@ -105,6 +197,8 @@ def update(resource_id):
         log.error('Exception occurred during QA update_resource: %s: %s',
                   e.__class__.__name__, unicode(e))
         raise
+    finally:
+        reindex.job_done()
 
 
 def update_resource_(resource_id):
@@ -112,10 +206,13 @@ def update_resource_(resource_id):
     resource = model.Resource.get(resource_id)
     if not resource:
         raise QAError('Resource ID not found: %s' % resource_id)
-    qa_result = resource_score(resource)
+    timer = timing.Timer('update_resource', resource_id=resource.id)
+    with timer.stage('score'):
+        qa_result = resource_score(resource)
     log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
              resource.url)
-    save_qa_result(resource, qa_result)
+    with timer.stage('save'):
+        save_qa_result(resource, qa_result)
     log.info('CKAN updated with openness score')
 
     if toolkit.check_ckan_version(max_version='2.2.99'):
@@ -125,9 +222,11 @@ def update_resource_(resource_id):
     if package:
         # Refresh the index for this dataset, so that it contains the latest
         # qa info
-        _update_search_index(package.id)
+        with timer.stage('reindex'):
+            _update_search_index(package.id)
     else:
         log.warning('Resource not connected to a package. Res: %r', resource)
+    timer.emit()
     return json.dumps(qa_result)
 
 
@@ -154,48 +253,69 @@ def format_get(key):
     return format_tuple[1]  # short name
 
 
-def resource_score(resource):
+def resource_score(resource, archival=_LOOKUP, qa=_LOOKUP,
+                   sniffed_format=_LOOKUP, timer=None):
     """
     Score resource on Sir Tim Berners-Lee\'s five stars of openness.
 
+    The resource's Archival and existing QA object (or None if there isn't
+    one) can be supplied, if they have already been got, otherwise they are
+    looked up. Similarly the format sniffed from the archived file can be
+    supplied (see sniff_archived_files).
+
+    The time taken by each stage is emitted as a timing event (see
+    ckanext.qa.timing), adding to the stages already in timer, if given.
+
     Returns a dict with keys:
 
         'openness_score': score (int)
         'openness_score_reason': the reason for the score (string)
         'format': format of the data (string)
         'archival_timestamp': time of the archival that this result is based on (iso string)
+        'fingerprint': digest of the inputs to the score (string)
 
     Raises QAError for reasonable errors
     """
     score = 0
     score_reason = ''
     format_ = None
+    timer = timer or timing.Timer('resource_score', resource_id=resource.id)
 
     try:
         score_reasons = []  # a list of strings detailing how we scored it
-        archival = Archival.get_for_resource(resource_id=resource.id)
+        if archival is _LOOKUP:
+            with timer.stage('archival'):
+                archival = Archival.get_for_resource(resource_id=resource.id)
         if not resource:
             raise QAError('Could not find resource "%s"' % resource.id)
 
-        score, format_ = score_if_link_broken(archival, resource, score_reasons)
+        with timer.stage('link_check'):
+            score, format_ = score_if_link_broken(archival, resource,
+                                                  score_reasons, qa)
         if score is None:
             # we don't want to take the publisher's word for it, in case the link
             # is only to a landing page, so highest priority is the sniffed type
-            score, format_ = score_by_sniffing_data(archival, resource,
-                                                    score_reasons)
+            with timer.stage('sniff'), timer.record_detectors():
+                score, format_ = score_by_sniffing_data(archival, resource,
+                                                        score_reasons,
+                                                        sniffed_format)
             if score is None:
                 # Fall-backs are user-given data
-                score, format_ = score_by_url_extension(resource, score_reasons)
-                if score is None:
-                    score, format_ = score_by_format_field(resource, score_reasons)
+                with timer.stage('format_fallbacks'):
+                    score, format_ = score_by_url_extension(resource, score_reasons)
                     if score is None:
-                        log.warning('Could not score resource: "%s" with url: "%s"',
-                                    resource.id, resource.url)
-                        score_reasons.append(_('Could not understand the file format, therefore score is 1.'))
-                        score = 1
-                        if format_ is None:
-                            # use any previously stored format value for this resource
-                            format_ = get_qa_format(resource.id)
+                        score, format_ = score_by_format_field(resource, score_reasons)
+                        if score is None:
+                            log.warning('Could not score resource: "%s" with url: "%s"',
+                                        resource.id, resource.url)
+                            score_reasons.append(_('Could not understand the file format, therefore score is 1.'))
+                            score = 1
+                            if format_ is None:
+                                # use any previously stored format value for this resource
+                                if qa is _LOOKUP:
+                                    format_ = get_qa_format(resource.id)
+                                elif qa:
+                                    format_ = qa.format
         score_reason = ' '.join(score_reasons)
         format_ = format_ or None
     except Exception as e:
@@ -214,9 +334,10 @@ def resource_score(resource):
         package = resource.resource_group.package
     else:
         package = resource.package
-    if score > 0 and not package.isopen():
-        score_reason = _('License not open')
-        score = 0
+    with timer.stage('licence'):
+        if score > 0 and not package.isopen():
+            score_reason = _('License not open')
+            score = 0
 
     log.info('Score: %s Reason: %s', score, score_reason)
 
@@ -226,12 +347,35 @@ def resource_score(resource):
         'openness_score': score,
         'openness_score_reason': score_reason,
         'format': format_,
-        'archival_timestamp': archival_updated
+        'archival_timestamp': archival_updated,
+        'fingerprint': resource_fingerprint(resource, archival),
     }
 
+    timer.emit(package_id=package.id, score=score, format=format_)
+    if slowest.is_enabled():
+        slowest.add(timer.get_event(package_id=package.id, score=score,
+                                    format=format_))
     return result
 
 
+def resource_fingerprint(resource, archival):
+    '''Returns a digest of everything that the score of a resource depends
+    on - its URL, format and licence, and its archival. If this is unchanged
+    since the resource was last scored, then there is no need to score it
+    again.
+    '''
+    if toolkit.check_ckan_version(max_version='2.2.99'):
+        package = resource.resource_group.package
+    else:
+        package = resource.package
+    archival_updated = archival.updated.isoformat() \
+        if archival and archival.updated else None
+    inputs = [resource.url, resource.format,
+              package.license_id if package else None,
+              archival_updated, SNIFF_DETECTOR_VERSION]
+    return hashlib.sha1(json.dumps(inputs).encode('utf8')).hexdigest()
+
+
 def broken_link_error_message(archival):
     '''Given an archival for a broken link, it returns a helpful
     error message (string) describing the attempts.'''
@@ -263,10 +407,11 @@ def broken_link_error_message(archival):
     return ' '.join(messages)
 
 
-def score_if_link_broken(archival, resource, score_reasons):
+def score_if_link_broken(archival, resource, score_reasons, qa=_LOOKUP):
     '''
     Looks to see if the archiver said it was broken, and if so, writes to
-    the score_reasons and returns a score.
+    the score_reasons and returns a score. The resource's existing QA object
+    (or None) can be supplied, for its format, otherwise it is looked up.
 
     Return values:
       * Returns a tuple: (score, format_)
@@ -277,17 +422,23 @@ def score_if_link_broken(archival, resource, score_reasons):
     if archival and archival.is_broken:
         # Score 0 since we are sure the link is currently broken
         score_reasons.append(broken_link_error_message(archival))
-        format_ = get_qa_format(resource.id)
+        if qa is _LOOKUP:
+            format_ = get_qa_format(resource.id)
+        else:
+            format_ = qa.format if qa else ''
         log.info('Archiver says link is broken. Previous format: %r' % format_)
         return (0, format_)
     return (None, None)
 
 
-def score_by_sniffing_data(archival, resource, score_reasons):
+def score_by_sniffing_data(archival, resource, score_reasons,
+                           sniffed_format=_LOOKUP):
     '''
     Looks inside a data file\'s contents to determine its format and score.
 
     It adds strings to score_reasons list about how it came to the conclusion.
+    If the file has already been sniffed, the result can be supplied as
+    sniffed_format.
 
     Return values:
       * It returns a tuple: (score, format_string)
@@ -305,7 +456,8 @@ def score_by_sniffing_data(archival, resource, score_reasons):
         return (None, None)
     else:
         if filepath:
-            sniffed_format = sniff_file_format(filepath)
+            if sniffed_format is _LOOKUP:
+                sniffed_format = sniff_archived_file_format(archival, filepath)
             score = resource_format_scores().get(sniffed_format['format']) \
                 if sniffed_format else None
             if sniffed_format:
@@ -333,6 +485,91 @@ def score_by_sniffing_data(archival, resource, score_reasons):
                 return (None, None)
 
 
+def sniff_archived_file_format(archival, filepath):
+    '''
+    Sniffs the format of an archived file, or if the sniff cache is enabled
+    (qa.sniff_cache_size), returns the result for the same file contents from
+    a previous run.
+    '''
+    key = sniff_cache.get_key(filepath, archival.hash) \
+        if sniff_cache.is_enabled() else None
+    if key:
+        cached, sniffed_format = sniff_cache.get(key)
+        if cached:
+            log.info('Sniffed format from the cache: %r', sniffed_format)
+            return sniffed_format
+    sniffed_format = sniff_file_format(filepath)
+    if key:
+        sniff_cache.put(key, sniffed_format)
+    return sniffed_format
+
+
+def get_sniff_threads():
+    return int(config.get('qa.sniff_threads', 1))
+
+
+def sniff_archived_files(archivals, num_threads, timers=None):
+    '''
+    Sniffs the formats of the archived files of several resources, with the
+    files read and sniffed concurrently by a pool of threads. (The sniff cache,
+    and so all db access, stays on this thread.)
+
+    Returns a dict of the sniffed formats keyed by resource id. Resources whose
+    file doesn't exist are left out, as score_by_sniffing_data deals with them,
+    as are broken links, which resource_score scores without sniffing.
+
+    The sniffing time is added to the resources' Timers, if given as a dict
+    keyed by resource id.
+    '''
+    sniffed_formats = {}
+    # files to sniff, keyed by the sniff cache key (or filepath), so that
+    # files with the same contents are only sniffed once
+    to_sniff = OrderedDict()
+    for archival in archivals:
+        if archival.is_broken:
+            continue
+        filepath = archival.cache_filepath
+        if not filepath or not os.path.exists(filepath):
+            continue
+        key = sniff_cache.get_key(filepath, archival.hash) \
+            if sniff_cache.is_enabled() else None
+        if key and key not in to_sniff:
+            cached, sniffed_format = sniff_cache.get(key)
+            if cached:
+                sniffed_formats[archival.resource_id] = sniffed_format
+                continue
+        to_sniff.setdefault(key or filepath, (filepath, key, []))[2] \
+            .append(archival.resource_id)
+    if not to_sniff:
+        return sniffed_formats
+
+    log.info('Sniffing %i files with %i threads', len(to_sniff), num_threads)
+    pool = ThreadPool(min(num_threads, len(to_sniff)))
+    try:
+        results = pool.map(_sniff_file_format_timed,
+                           [filepath for filepath, key, resource_ids
+                            in to_sniff.values()])
+    finally:
+        pool.close()
+        pool.join()
+    for (filepath, key, resource_ids), (sniffed_format, sniff_timer) in \
+            zip(to_sniff.values(), results):
+        if key:
+            sniff_cache.put(key, sniffed_format)
+        for resource_id in resource_ids:
+            sniffed_formats[resource_id] = sniffed_format
+            if timers and resource_id in timers:
+                timers[resource_id].merge(sniff_timer)
+    return sniffed_formats
+
+
+def _sniff_file_format_timed(filepath):
+    timer = timing.Timer('sniff')
+    with timer.stage('sniff'), timer.record_detectors():
+        sniffed_format = sniff_file_format(filepath)
+    return sniffed_format, timer
+
+
 def score_by_url_extension(resource, score_reasons):
     '''
     Looks at the URL for a resource to determine its format and score.
@@ -416,40 +653,61 @@ def score_by_format_field(resource, score_reasons):
 
 def _update_search_index(package_id):
     '''
-    Tells CKAN to update its search index for a given package.
+    Tells CKAN to update its search index for a given package. This may be
+    buffered, to be done in a batch - see ckanext.qa.reindex.
     '''
-    from ckan import model
-    from ckan.lib.search.index import PackageSearchIndex
-    package_index = PackageSearchIndex()
-    context_ = {'model': model, 'ignore_auth': True, 'session': model.Session,
-                'use_cache': False, 'validate': False}
-    package = toolkit.get_action('package_show')(context_, {'id': package_id})
-    package_index.index_package(package, defer_commit=False)
-    log.info('Search indexed %s', package['name'])
+    reindex.add(package_id)
+
+
+def flush_search_index():
+    '''
+    Updates the search index for any packages waiting in the reindex buffer.
+    '''
+    num_packages = reindex.flush()
+    log.info('Reindex buffer flushed: %i datasets', num_packages)
 
 
 def save_qa_result(resource, qa_result):
     """
     Saves the results of the QA check to the qa table.
     """
-    import ckan.model as model
     from ckanext.qa.model import QA
 
-    now = datetime.datetime.now()
+    save_qa_results([(resource, qa_result)])
+    return QA.get_for_resource(resource.id)  # for tests
 
-    qa = QA.get_for_resource(resource.id)
-    if not qa:
-        qa = QA.create(resource.id)
-        model.Session.add(qa)
-    else:
-        log.info(u'QA from before: %r', qa)
 
-    for key in ('openness_score', 'openness_score_reason', 'format'):
-        setattr(qa, key, qa_result[key])
-    qa.archival_timestamp = qa_result['archival_timestamp']
-    qa.updated = now
+def save_qa_results(results, commit=True):
+    """
+    Saves the results of QA checks to the qa table, all in one statement, and
+    updates the qa_package rows of their datasets.
 
-    model.Session.commit()
+    :param results: list of (resource, qa_result) tuples
+    :param commit: set to False to leave committing to the caller
+    """
+    import ckan.model as model
+    from ckanext.qa.model import QA, update_package_qa
 
-    log.info('QA results updated ok')
-    return qa  # for tests
+    now = datetime.datetime.now()
+
+    rows = []
+    for resource, qa_result in results:
+        if toolkit.check_ckan_version(max_version='2.2.99'):
+            package_id = resource.resource_group.package_id
+        else:
+            package_id = resource.package_id
+        row = {'resource_id': resource.id, 'package_id': package_id,
+               'fingerprint': qa_result.get('fingerprint'), 'updated': now}
+        for key in ('openness_score', 'openness_score_reason', 'format',
+                    'archival_timestamp'):
+            row[key] = qa_result[key]
+        rows.append(row)
+    QA.upsert(rows)
+    # and the aggregated QA of their datasets, in the same transaction
+    update_package_qa(row['package_id'] for row in rows)
+
+    if commit:
+        model.Session.commit()
+    show_cache.invalidate(set(row['package_id'] for row in rows))
+
+    log.info('QA results updated ok: %i resources', len(rows))
@@ -1,6 +1,7 @@
 import pytest
 import os
 import threading
+from sqlalchemy import event
 from ckanext.archiver.tests.mock_flask_server import create_app
 
 
@@ -25,3 +26,51 @@ def files():
         files.append((format_extension, filepath))
 
     yield files
+
+
+@pytest.fixture
+def qa_tables(clean_db):
+    from ckan import model
+    from ckanext.archiver import model as archiver_model
+    from ckanext.qa import model as qa_model
+
+    archiver_model.init_tables(model.meta.engine)
+    qa_model.init_tables(model.meta.engine)
+
+
+def record_statements(func):
+    '''Calls func and returns its result, and the SQL statements it
+    executed.'''
+    from ckan import model
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(model.meta.engine, 'before_cursor_execute',
+                 before_cursor_execute)
+    try:
+        result = func()
+    finally:
+        event.remove(model.meta.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+    return result, statements
+
+
+def add_qa(resource_id, openness_score, with_archival=False):
+    '''Saves QA for the resource with the given score (and an Archival, if
+    with_archival is set), and updates its dataset's qa_package.'''
+    from ckan import model
+    from ckanext.archiver.model import Archival
+    from ckanext.qa import model as qa_model
+
+    qa = qa_model.QA.create(resource_id)
+    qa.openness_score = openness_score
+    qa.openness_score_reason = 'Score %s' % openness_score
+    model.Session.add(qa)
+    if with_archival:
+        archival = Archival.create(resource_id)
+        archival.status_id = 0
+        model.Session.add(archival)
+    qa_model.update_package_qa([qa.package_id])
+    model.Session.commit()
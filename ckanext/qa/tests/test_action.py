@@ -0,0 +1,85 @@
+import pytest
+
+from ckan import model
+from ckan.logic import get_action, ValidationError
+from ckantoolkit.tests import factories as ckan_factories
+
+from ckanext.qa.logic import action
+from ckanext.qa.tests.fixtures import add_qa, record_statements
+
+
+@pytest.mark.usefixtures('with_plugins', 'qa_tables')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+class TestShowMany():
+    def _context(self):
+        return {'model': model, 'session': model.Session, 'ignore_auth': True}
+
+    def _make_datasets(self, num_datasets):
+        datasets = []
+        for i in range(num_datasets):
+            dataset = ckan_factories.Dataset(
+                resources=[{'url': 'http://example.com/%i.csv' % i}])
+            add_qa(dataset['resources'][0]['id'], i % 5,
+                   with_archival=True)
+            datasets.append(dataset)
+        return datasets
+
+    def test_package_openness_show_many(self):
+        dataset1, dataset2 = self._make_datasets(2)
+        not_scored = ckan_factories.Dataset()
+
+        result = get_action('qa_package_openness_show_many')(
+            self._context(),
+            {'ids': [dataset2['id'], 'unknown', not_scored['id'],
+                     dataset1['id'], dataset2['id']]})
+
+        assert result['results'] == dict(
+            (dataset['id'], get_action('qa_package_openness_show')(
+                self._context(), {'id': dataset['id']}))
+            for dataset in (dataset1, dataset2, not_scored))
+        assert result['results'][not_scored['id']]['openness_score'] is None
+        assert result['not_found'] == ['unknown']
+
+    def test_resource_show_many(self):
+        dataset1, dataset2 = self._make_datasets(2)
+        res_ids = [dataset1['resources'][0]['id'],
+                   dataset2['resources'][0]['id']]
+
+        result = get_action('qa_resource_show_many')(
+            self._context(), {'ids': ','.join(res_ids + ['unknown'])})
+
+        assert result['results'] == dict(
+            (res_id, get_action('qa_resource_show')(
+                self._context(), {'id': res_id}))
+            for res_id in res_ids)
+        assert result['results'][res_ids[1]]['openness_score'] == 1
+        assert result['results'][res_ids[1]]['name'] == dataset2['name']
+        assert result['not_found'] == ['unknown']
+
+    @pytest.mark.parametrize('action_name', ['qa_package_openness_show_many',
+                                             'qa_resource_show_many'])
+    def test_number_of_queries_does_not_depend_on_ids(self, action_name):
+        datasets = self._make_datasets(5)
+        if action_name == 'qa_resource_show_many':
+            ids = [dataset['resources'][0]['id'] for dataset in datasets]
+        else:
+            ids = [dataset['id'] for dataset in datasets]
+
+        result1, statements1 = record_statements(
+            lambda: get_action(action_name)(self._context(), {'ids': ids[:1]}))
+        result5, statements5 = record_statements(
+            lambda: get_action(action_name)(self._context(), {'ids': ids}))
+
+        assert len(result1['results']) == 1
+        assert len(result5['results']) == 5
+        assert len(statements1) == len(statements5)
+
+    def test_limit(self, monkeypatch):
+        monkeypatch.setattr(action, 'get_show_many_limit', lambda: 2)
+
+        with pytest.raises(ValidationError):
+            get_action('qa_package_openness_show_many')(
+                self._context(), {'ids': ['a', 'b', 'c']})
+        # duplicates don't count
+        get_action('qa_package_openness_show_many')(
+            self._context(), {'ids': ['a', 'b', 'a']})
@@ -0,0 +1,172 @@
+import datetime
+
+import pytest
+from sqlalchemy import inspect, text
+
+from ckan import model
+from ckan.lib import dictization
+from ckan.logic import get_action
+from ckantoolkit.tests import factories as ckan_factories
+
+from ckanext.qa import model as qa_model
+
+
+@pytest.mark.usefixtures('with_plugins', 'qa_tables')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+class TestInitTables():
+    def test_duplicate_results_removed(self):
+        dataset = ckan_factories.Dataset(resources=[{'url': 'http://a.com/'}])
+        resource_id = dataset['resources'][0]['id']
+        model.Session.commit()
+        # recreate the table as it was when resource_id was not unique
+        with model.meta.engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_qa_resource_id'))
+            connection.execute(text(
+                'CREATE INDEX ix_qa_resource_id ON qa (resource_id)'))
+        for day, score in ((1, 1), (3, 3), (2, 2)):
+            qa = qa_model.QA.create(resource_id)
+            qa.openness_score = score
+            qa.updated = datetime.datetime(2020, 1, day)
+            model.Session.add(qa)
+        model.Session.commit()
+
+        qa_model.init_tables(model.meta.engine)
+
+        qas = model.Session.query(qa_model.QA) \
+            .filter_by(resource_id=resource_id).all()
+        assert [qa.openness_score for qa in qas] == [3]
+        assert [index['unique']
+                for index in inspect(model.meta.engine).get_indexes('qa')
+                if index['column_names'] == ['resource_id']] == [True]
+
+    def test_package_qa_filled(self):
+        dataset = ckan_factories.Dataset(resources=[
+            {'url': 'http://a.com/1'}, {'url': 'http://a.com/2'}])
+        for resource, score in zip(dataset['resources'], (2, 4)):
+            qa = qa_model.QA.create(resource['id'])
+            qa.openness_score = score
+            model.Session.add(qa)
+        model.Session.commit()
+        # as it was before there was a qa_package table
+        qa_model.PackageQA.__table__.drop(model.meta.engine)
+
+        qa_model.init_tables(model.meta.engine)
+
+        package_qa = qa_model.PackageQA.get(dataset['id'])
+        assert package_qa.openness_score == 4
+        assert package_qa.get_resource_score_counts() == {'2': 1, '4': 1}
+
+
+@pytest.mark.usefixtures('with_plugins', 'qa_tables')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+class TestPackageQA():
+    def test_deleted_resource(self):
+        dataset = ckan_factories.Dataset(resources=[
+            {'url': 'http://a.com/1'}, {'url': 'http://a.com/2'}])
+        for resource, score in zip(dataset['resources'], (2, 4)):
+            qa = qa_model.QA.create(resource['id'])
+            qa.openness_score = score
+            model.Session.add(qa)
+        qa_model.update_package_qa([dataset['id']])
+        model.Session.commit()
+        assert qa_model.PackageQA.get(dataset['id']).openness_score == 4
+
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True}
+        get_action('resource_delete')(
+            context, {'id': dataset['resources'][1]['id']})
+
+        model.Session.expire_all()
+        assert qa_model.PackageQA.get(dataset['id']).openness_score == 2
+
+        get_action('resource_delete')(
+            context, {'id': dataset['resources'][0]['id']})
+
+        assert qa_model.PackageQA.get(dataset['id']) is None
+
+    def test_rebuild(self):
+        dataset = ckan_factories.Dataset(resources=[{'url': 'http://a.com/1'}])
+        qa = qa_model.QA.create(dataset['resources'][0]['id'])
+        qa.openness_score = 5
+        model.Session.add(qa)
+        model.Session.commit()
+        assert qa_model.PackageQA.get(dataset['id']) is None
+
+        assert qa_model.rebuild_package_qa() >= 1
+        model.Session.commit()
+
+        assert qa_model.PackageQA.get(dataset['id']).openness_score == 5
+        assert get_action('qa_package_openness_show')(
+            {'model': model, 'session': model.Session, 'ignore_auth': True},
+            {'id': dataset['id']})['openness_score'] == 5
+
+    def test_rescored_resource(self):
+        dataset = ckan_factories.Dataset(resources=[
+            {'url': 'http://a.com/1'}, {'url': 'http://a.com/2'}])
+        for resource, score in zip(dataset['resources'], (1, 2)):
+            qa = qa_model.QA.create(resource['id'])
+            qa.openness_score = score
+            model.Session.add(qa)
+        qa_model.update_package_qa([dataset['id']])
+        model.Session.commit()
+        # the QA objects and PackageQA are held in the session, as when
+        # tasks.update_package_ gets them before rescoring
+        qa_objs = qa_model.QA.get_for_package(dataset['id'])
+        assert sorted(qa.openness_score for qa in qa_objs) == [1, 2]
+        package_qa = qa_model.PackageQA.get(dataset['id'])
+        assert package_qa.openness_score == 2
+
+        qa_model.QA.upsert([{
+            'resource_id': dataset['resources'][0]['id'],
+            'package_id': dataset['id'],
+            'openness_score': 5, 'openness_score_reason': 'Score 5',
+            'updated': datetime.datetime.now()}])
+        qa_model.update_package_qa([dataset['id']])
+        model.Session.commit()
+
+        assert qa_model.PackageQA.get(dataset['id']) is package_qa
+        assert package_qa.openness_score == 5
+        assert package_qa.openness_score_reason == 'Score 5'
+        assert package_qa.get_resource_score_counts() == {'2': 1, '5': 1}
+
+
+class TestQAAsDict():
+    def get_qa(self):
+        return qa_model.QA(
+            id='qa-id', package_id='package-id', resource_id='resource-id',
+            resource_timestamp=None, archival_timestamp=datetime.datetime(2020, 1, 2, 3, 4, 5, 6),
+            openness_score=3, openness_score_reason=u'Content of file '
+            u'appeared to be format "CSV" – 3 stars',
+            format='CSV', fingerprint=None,
+            created=datetime.datetime(2020, 1, 1),
+            updated=datetime.datetime(2020, 1, 2))
+
+    def test_same_as_table_dictize(self):
+        qa = self.get_qa()
+
+        qa_dict = qa.as_dict()
+
+        expected = dictization.table_dictize(qa, {'model': model})
+        del expected['fingerprint']
+        assert qa_dict == expected
+        assert qa_dict['archival_timestamp'] == '2020-01-02T03:04:05.000006'
+        assert qa_dict['resource_timestamp'] is None
+        assert 'fingerprint' not in qa_dict
+
+    def test_not_all_loaded(self):
+        qa = qa_model.QA(resource_id='resource-id', openness_score=3,
+                         updated=datetime.datetime(2020, 1, 2))
+
+        expected = dictization.table_dictize(qa, {'model': model})
+        del expected['fingerprint']
+        assert qa.as_dict() == expected
+
+    def test_without_ids(self):
+        qa = self.get_qa()
+
+        qa_dict = qa.as_dict(include_ids=False)
+
+        expected = dictization.table_dictize(qa, {'model': model})
+        for key in ('id', 'package_id', 'resource_id', 'fingerprint'):
+            del expected[key]
+        assert qa_dict == expected
@@ -0,0 +1,217 @@
+import datetime
+
+import pytest
+
+from ckan import model
+from ckan.lib import search
+from ckan.logic import get_action
+from ckantoolkit.tests import factories as ckan_factories
+
+from ckanext.qa import helpers
+from ckanext.qa import model as qa_model
+from ckanext.qa import show_cache
+from ckanext.qa import tasks
+from ckanext.qa.plugin import QAPlugin
+from ckanext.qa.model import QA
+from ckanext.qa.tests.fixtures import add_qa, record_statements
+
+
+@pytest.mark.usefixtures('with_plugins', 'qa_tables')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+class TestPackageController():
+    @pytest.fixture(autouse=True)
+    def init_data(cls, clean_index):
+        show_cache.clear()
+
+    def _context(self):
+        return {'model': model, 'session': model.Session, 'ignore_auth': True}
+
+    def _make_datasets(self, num_datasets, org):
+        datasets = []
+        for i in range(num_datasets):
+            dataset = ckan_factories.Dataset(
+                owner_org=org['id'],
+                resources=[{'url': 'http://example.com/%i.csv' % i},
+                           {'url': 'http://example.com/%i.xls' % i}])
+            add_qa(dataset['resources'][0]['id'], i % 5)
+            datasets.append(dataset)
+        return datasets
+
+    def _search(self, org):
+        results, statements = record_statements(
+            lambda: get_action('package_search')(
+                self._context(),
+                {'fq': 'owner_org:%s' % org['id'], 'rows': 100}))
+        return results, len(statements)
+
+    def _show(self, dataset):
+        pkg_dict, statements = record_statements(
+            lambda: get_action('package_show')(self._context(),
+                                               {'id': dataset['id']}))
+        num_qa_queries = len([statement for statement in statements
+                              if 'FROM qa JOIN resource' in statement])
+        return pkg_dict, num_qa_queries
+
+    def test_show(self):
+        org = ckan_factories.Organization()
+        [dataset] = self._make_datasets(1, org)
+
+        pkg_dict = get_action('package_show')(self._context(),
+                                              {'id': dataset['id']})
+
+        assert pkg_dict['qa']['openness_score'] == 0
+        assert pkg_dict['resources'][0]['qa']['openness_score'] == 0
+        assert 'qa' not in pkg_dict['resources'][1]
+
+    def test_search(self):
+        org = ckan_factories.Organization()
+        datasets = self._make_datasets(3, org)
+
+        results, num_queries = self._search(org)
+
+        assert results['count'] == 3
+        scores = dict((pkg_dict['id'], pkg_dict['qa']['openness_score'])
+                      for pkg_dict in results['results'])
+        assert scores == dict((dataset['id'], i)
+                              for i, dataset in enumerate(datasets))
+        for pkg_dict in results['results']:
+            show_dict = get_action('package_show')(self._context(),
+                                                   {'id': pkg_dict['id']})
+            assert pkg_dict['qa'] == show_dict['qa']
+            assert pkg_dict['resources'][0]['qa'] == \
+                show_dict['resources'][0]['qa']
+
+    def test_search_queries_do_not_depend_on_results(self):
+        org1 = ckan_factories.Organization()
+        self._make_datasets(1, org1)
+        org2 = ckan_factories.Organization()
+        self._make_datasets(5, org2)
+
+        results1, num_queries1 = self._search(org1)
+        results2, num_queries2 = self._search(org2)
+
+        assert results1['count'] == 1
+        assert results2['count'] == 5
+        assert num_queries1 == num_queries2
+
+    def test_index_fields(self):
+        org = ckan_factories.Organization()
+        dataset = ckan_factories.Dataset(
+            owner_org=org['id'],
+            resources=[{'url': 'http://example.com/a.csv'},
+                       {'url': 'http://example.com/b.csv'},
+                       {'url': 'http://example.com/c.csv'}])
+        for resource, score, format_ in zip(dataset['resources'], (3, 1, 3),
+                                            ('CSV', 'XLS', 'CSV')):
+            add_qa(resource['id'], score)
+            qa = QA.get_for_resource(resource['id'])
+            qa.format = format_
+        model.Session.commit()
+        pkg_dict = get_action('package_show')(self._context(),
+                                              {'id': dataset['id']})
+
+        index_dict = QAPlugin().before_index(pkg_dict)
+
+        assert 'qa' not in index_dict
+        assert index_dict['qa_openness_score'] == '3'
+        assert index_dict['qa_resources_score_3'] == '2'
+        assert index_dict['qa_resources_score_1'] == '1'
+        assert index_dict['vocab_qa_formats'] == ['CSV', 'XLS']
+
+    def test_qa_search(self):
+        org = ckan_factories.Organization()
+        datasets = self._make_datasets(7, org)
+        ckan_factories.Dataset(owner_org=org['id'])  # not scored
+        other_org = ckan_factories.Organization()
+        self._make_datasets(2, other_org)
+        for dataset in datasets:
+            search.rebuild(dataset['id'])
+
+        score_counts = helpers.qa_search('owner_org:"%s"' % org['id'])
+
+        assert score_counts == {'0': 2, '1': 2, '2': 1, '3': 1, '4': 1}
+
+    def _save_qa(self, dataset, openness_score):
+        resource = model.Resource.get(dataset['resources'][0]['id'])
+        tasks.save_qa_result(resource, {
+            'openness_score': openness_score,
+            'openness_score_reason': 'Score %s' % openness_score,
+            'format': 'CSV', 'archival_timestamp': None})
+
+    def test_show_cached_in_request(self, app):
+        org = ckan_factories.Organization()
+        [dataset] = self._make_datasets(1, org)
+
+        with app.flask_app.test_request_context():
+            pkg_dict, num_qa_queries = self._show(dataset)
+            assert num_qa_queries == 1
+            pkg_dict['qa']['openness_score'] = 5  # doesn't change the cache
+
+            pkg_dict, num_qa_queries = self._show(dataset)
+            assert num_qa_queries == 0
+            assert pkg_dict['qa']['openness_score'] == 0
+            assert pkg_dict['resources'][0]['qa']['openness_score'] == 0
+
+            # saving QA invalidates it
+            self._save_qa(dataset, 3)
+            pkg_dict, num_qa_queries = self._show(dataset)
+            assert num_qa_queries == 1
+            assert pkg_dict['qa']['openness_score'] == 3
+
+        # a new request starts again
+        with app.flask_app.test_request_context():
+            pkg_dict, num_qa_queries = self._show(dataset)
+            assert num_qa_queries == 1
+
+    def test_show_cached_in_process(self, monkeypatch):
+        monkeypatch.setattr(show_cache, 'get_max_size', lambda: 1)
+        org = ckan_factories.Organization()
+        dataset, other_dataset = self._make_datasets(2, org)
+        stats = dict(show_cache.stats)
+
+        pkg_dict, num_qa_queries = self._show(dataset)
+        assert num_qa_queries == 1
+        pkg_dict, num_qa_queries = self._show(dataset)
+        assert num_qa_queries == 0
+        assert pkg_dict['qa']['openness_score'] == 0
+        assert show_cache.stats['process_hits'] == stats['process_hits'] + 1
+        assert show_cache.stats['misses'] == stats['misses'] + 1
+        assert 0 < show_cache.get_stats()['hit_ratio'] < 1
+
+        # QA saved by another process (i.e. without invalidating the cache)
+        qa = QA.get_for_resource(dataset['resources'][0]['id'])
+        qa.openness_score = 2
+        qa.updated = datetime.datetime.now()
+        qa_model.update_package_qa([qa.package_id])
+        model.Session.commit()
+        pkg_dict, num_qa_queries = self._show(dataset)
+        assert num_qa_queries == 1
+        assert pkg_dict['qa']['openness_score'] == 2
+
+        # the least recently used is evicted
+        self._show(other_dataset)
+        pkg_dict, num_qa_queries = self._show(dataset)
+        assert num_qa_queries == 1
+
+    def test_show_cached_in_process_rescored(self, monkeypatch):
+        monkeypatch.setattr(show_cache, 'get_max_size', lambda: 10)
+        org = ckan_factories.Organization()
+        [dataset] = self._make_datasets(1, org)
+        pkg_dict, num_qa_queries = self._show(dataset)
+        assert pkg_dict['qa']['openness_score'] == 0
+        # held in the session, as in a QA worker
+        qa_objs = QA.get_for_package(dataset['id'])
+
+        # rescored as by a QA worker (i.e. without invalidating the cache)
+        QA.upsert([{'resource_id': qa_objs[0].resource_id,
+                    'package_id': dataset['id'],
+                    'openness_score': 4,
+                    'openness_score_reason': 'Score 4',
+                    'updated': datetime.datetime.now()}])
+        qa_model.update_package_qa([dataset['id']])
+        model.Session.commit()
+
+        pkg_dict, num_qa_queries = self._show(dataset)
+        assert num_qa_queries == 1
+        assert pkg_dict['qa']['openness_score'] == 4
+        assert pkg_dict['resources'][0]['qa']['openness_score'] == 4
@@ -0,0 +1,128 @@
+import time
+
+import pytest
+
+from ckan import plugins as p
+from ckan.lib.search.index import PackageSearchIndex
+from ckantoolkit.tests import factories as ckan_factories
+
+from ckanext.qa import reindex
+from ckanext.qa import tasks
+
+
+@pytest.mark.usefixtures('with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+@pytest.mark.ckan_config('qa.reindex_batch_size', '3')
+class TestReindexBuffer():
+    @pytest.fixture(autouse=True)
+    def init_data(self, monkeypatch):
+        redis = reindex._connect_to_redis()
+        redis.delete(reindex._get_key(), reindex._get_key() + ':since')
+        self.batches = []
+        monkeypatch.setattr(reindex, 'index_packages', self.batches.append)
+
+    def test_flushed_when_full(self):
+        for package_id in ('a', 'b', 'a', 'c'):
+            reindex.add(package_id)
+            if package_id == 'a':
+                assert self.batches == []
+        assert self.batches == [['a', 'b', 'c']]
+        assert reindex.flush() == 0
+
+    def test_flush(self):
+        reindex.add('b')
+        reindex.add('a')
+
+        assert reindex.flush() == 2
+        assert self.batches == [['a', 'b']]
+        assert reindex.flush() == 0
+
+    @pytest.mark.ckan_config('qa.reindex_flush_interval', '0')
+    def test_flushed_after_interval(self):
+        reindex.add('a')
+        assert self.batches == [['a']]
+
+    def test_flushed_after_interval_when_job_done(self, monkeypatch):
+        monkeypatch.setattr(reindex, '_is_last_job', lambda: False)
+        reindex.add('a')
+        reindex.job_done()
+        assert self.batches == []
+
+        # the interval elapses, with no more datasets added
+        redis = reindex._connect_to_redis()
+        redis.set(reindex._get_key() + ':since', time.time() - 3600)
+        reindex.job_done()
+        assert self.batches == [['a']]
+
+    def test_flushed_when_last_job_done(self, monkeypatch):
+        reindex.add('a')
+        reindex.job_done()  # not in a job
+        assert self.batches == []
+
+        monkeypatch.setattr(reindex, '_is_last_job', lambda: True)
+        reindex.job_done()
+        assert self.batches == [['a']]
+
+    def test_update_package_job_done(self, monkeypatch):
+        jobs_done = []
+        monkeypatch.setattr(reindex, 'job_done', lambda: jobs_done.append(1))
+        with pytest.raises(tasks.QAError):
+            tasks.update_package('missing')
+        assert jobs_done == [1]
+
+    def test_exit_flush_registered_in_worker(self, monkeypatch):
+        registered = []
+        monkeypatch.setattr(reindex, '_registered_exit_flush', False)
+        monkeypatch.setattr(reindex.atexit, 'register', registered.append)
+
+        plugin = p.get_plugin('qa')
+        plugin.before_fork()
+        plugin.before_fork()
+
+        assert registered == [reindex._flush_at_exit]
+
+    def test_failed_flush_kept_for_next_time(self, monkeypatch):
+        def index_packages(package_ids):
+            raise Exception('Solr is down')
+        reindex.add('a')
+        monkeypatch.setattr(reindex, 'index_packages', index_packages)
+        with pytest.raises(Exception):
+            reindex.flush()
+        monkeypatch.setattr(reindex, 'index_packages', self.batches.append)
+        # they are still flushed when the interval elapses
+        assert reindex._connect_to_redis().get(
+            reindex._get_key() + ':since') is not None
+
+        assert reindex.flush() == 1
+        assert self.batches == [['a']]
+
+    def test_added_during_flush_keeps_its_time(self, monkeypatch):
+        def index_packages(package_ids):
+            reindex.add('b')
+            self.batches.append(package_ids)
+        reindex.add('a')
+        monkeypatch.setattr(reindex, 'index_packages', index_packages)
+
+        assert reindex.flush() == 1
+        assert reindex._connect_to_redis().get(
+            reindex._get_key() + ':since') is not None
+
+    def test_not_buffered_with_batch_size_1(self, monkeypatch):
+        monkeypatch.setattr(reindex, 'get_batch_size', lambda: 1)
+        reindex.add('a')
+        assert self.batches == [['a']]
+
+
+@pytest.mark.usefixtures('with_plugins', 'qa_tables')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+class TestIndexPackages():
+    def test_one_commit(self, monkeypatch):
+        commits = []
+        monkeypatch.setattr(PackageSearchIndex, 'commit',
+                            lambda self: commits.append(True))
+        datasets = [ckan_factories.Dataset() for i in range(2)]
+
+        reindex.index_packages([dataset['id'] for dataset in datasets] +
+                               ['missing'])
+
+        assert commits == [True]
@@ -0,0 +1,299 @@
+import datetime
+import json
+from collections import Counter
+
+import pytest
+
+from ckan import model
+from ckan.logic import get_action
+from ckantoolkit.tests import factories as ckan_factories
+
+from ckanext.qa import reports
+from ckanext.qa import report_snapshot
+from ckanext.qa import model as qa_model
+from ckanext.qa.model import QA
+from ckanext.qa.tests.fixtures import add_qa
+
+
+@pytest.mark.usefixtures('with_plugins', 'qa_tables')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+class TestOpennessIndex():
+    def test_score_counts(self):
+        org = ckan_factories.Organization(title='Org')
+        ckan_factories.Organization(title='Empty org')
+        dataset = ckan_factories.Dataset(
+            owner_org=org['id'],
+            resources=[{'url': 'http://example.com/a.csv'},
+                       {'url': 'http://example.com/b.csv'},
+                       {'url': 'http://example.com/c.csv'}])
+        add_qa(dataset['resources'][0]['id'], 1)
+        add_qa(dataset['resources'][1]['id'], 3)
+        # the score of a deleted resource doesn't count
+        add_qa(dataset['resources'][2]['id'], 5)
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True}
+        get_action('resource_delete')(
+            context, {'id': dataset['resources'][2]['id']})
+        dataset2 = ckan_factories.Dataset(
+            owner_org=org['id'],
+            resources=[{'url': 'http://example.com/d.csv'}])
+        add_qa(dataset2['resources'][0]['id'], 3)
+        ckan_factories.Dataset(owner_org=org['id'])  # not scored
+
+        report = reports.openness_index()
+
+        assert report['table'] == [{
+            'organization_title': 'Org',
+            'organization_name': org['name'],
+            'total_stars': 6,
+            'average_stars': 3.0,
+            '3': 2,
+            None: 1,
+            }]
+        assert report['total_score_counts'] == {'3': 2, None: 1}
+        assert report['num_packages_scored'] == 3
+        assert report['num_packages'] == 3
+
+    def test_same_as_package_openness_show(self):
+        org = ckan_factories.Organization()
+        scores = []
+        for openness_score in (0, 2, 2, None):
+            dataset = ckan_factories.Dataset(
+                owner_org=org['id'],
+                resources=[{'url': 'http://example.com/data.csv'}])
+            if openness_score is not None:
+                add_qa(dataset['resources'][0]['id'], openness_score)
+            context = {'model': model, 'session': model.Session,
+                       'ignore_auth': True}
+            scores.append(get_action('qa_package_openness_show')(
+                context, {'id': dataset['id']})['openness_score'])
+
+        report = reports.openness_index()
+
+        [row] = report['table']
+        assert row['organization_name'] == org['name']
+        assert dict((k, v) for k, v in row.items()
+                    if k in ('0', '2', None)) == \
+            reports.jsonify_counter(Counter(scores))
+
+
+def add_parent(child_org, parent_org):
+    model.Session.add(model.Member(
+        group=model.Group.get(child_org['id']), table_id=parent_org['id'],
+        table_name='group', capacity='parent', state='active'))
+    model.Session.commit()
+
+
+def add_dataset(org, openness_score):
+    dataset = ckan_factories.Dataset(
+        owner_org=org['id'],
+        resources=[{'url': 'http://example.com/data.csv'}])
+    add_qa(dataset['resources'][0]['id'], openness_score)
+    return dataset
+
+
+@pytest.mark.usefixtures('with_plugins', 'qa_tables')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+class TestSubOrganizations():
+    @pytest.fixture
+    def orgs(self):
+        # dept
+        #  +- agency
+        #  |   +- office
+        #  +- board
+        dept = ckan_factories.Organization(title='Dept')
+        agency = ckan_factories.Organization(title='Agency')
+        office = ckan_factories.Organization(title='Office')
+        board = ckan_factories.Organization(title='Board')
+        add_parent(agency, dept)
+        add_parent(office, agency)
+        add_parent(board, dept)
+        add_dataset(dept, 1)
+        add_dataset(agency, 2)
+        add_dataset(office, 2)
+        add_dataset(office, 3)
+        add_dataset(board, 5)
+        return dept, agency, office, board
+
+    def test_organization_children(self, orgs):
+        dept, agency, office, board = orgs
+        children = reports.get_organization_children()
+
+        assert sorted(children[dept['id']]) == sorted([agency['id'], board['id']])
+        assert children[agency['id']] == [office['id']]
+        assert list(reports.walk_down_tree(agency['id'], children)) == \
+            [agency['id'], office['id']]
+
+    def test_index(self, orgs):
+        dept, agency, office, board = orgs
+
+        report = reports.openness_index(include_sub_organizations=True)
+
+        score_counts = dict(
+            (row['organization_name'],
+             dict((k, v) for k, v in row.items() if k in ('1', '2', '3', '5')))
+            for row in report['table'])
+        assert score_counts == {
+            dept['name']: {'1': 1, '2': 2, '3': 1, '5': 1},
+            agency['name']: {'2': 2, '3': 1},
+            office['name']: {'2': 1, '3': 1},
+            board['name']: {'5': 1},
+            }
+        # the totals are not counted twice
+        assert report['total_score_counts'] == {'1': 1, '2': 2, '3': 1, '5': 1}
+
+    def test_index_same_as_hierarchy_query(self, orgs):
+        report = reports.openness_index(include_sub_organizations=True)
+
+        without_sub_orgs = dict(
+            (row['organization_name'], row)
+            for row in reports.openness_index()['table'])
+        for row in report['table']:
+            org = model.Group.by_name(row['organization_name'])
+            total_stars = without_sub_orgs[org.name]['total_stars']
+            for sub_org in org.get_children_group_hierarchy(type='organization'):
+                total_stars += without_sub_orgs[sub_org[1]]['total_stars']
+            assert row['total_stars'] == total_stars
+
+    def test_organization(self, orgs):
+        dept, agency, office, board = orgs
+
+        report = reports.openness_for_organization(
+            organization=agency['name'], include_sub_organizations=True)
+
+        assert [row['organization_name'] for row in report['table']] == \
+            [agency['name'], office['name'], office['name']]
+        assert report['score_counts'] == {'2': 2, '3': 1}
+        assert report['num_packages'] == 3
+
+        report = reports.openness_for_organization(
+            organization=dept['name'], include_sub_organizations=True)
+        assert report['num_packages'] == 5
+        assert report['total_stars'] == 13
+
+    def test_all_combinations_same_as_each(self, orgs):
+        all_reports = reports.openness_reports_for_all_combinations()
+
+        assert len(all_reports) == 2 * (len(orgs) + 1)
+        for option_dict, report in all_reports:
+            assert report == reports.openness_report(**option_dict)
+
+    def test_combinations_are_generated_in_one_pass(self, orgs, monkeypatch):
+        def generate_one(*args, **kwargs):
+            raise AssertionError('Not generated in one pass')
+        monkeypatch.setattr(reports, 'openness_index', generate_one)
+        monkeypatch.setattr(reports, 'openness_for_organization', generate_one)
+
+        # as ckanext-report refreshes its cache
+        options = []
+        for option_dict in reports.openness_report_combinations():
+            report = reports.openness_report(**option_dict)
+            assert 'table' in report
+            options.append(option_dict)
+
+        assert options == reports.openness_report_combinations_list()
+        assert reports._generated_reports == {}
+
+    def test_incremental(self, orgs, monkeypatch):
+        dept, agency, office, board = orgs
+        monkeypatch.setattr(report_snapshot, 'is_enabled', lambda: True)
+        # the datasets were all just made, so are within the margin
+        monkeypatch.setattr(reports, 'CHANGE_MARGIN', datetime.timedelta(0))
+        report_snapshot.clear()
+        get_package_rows = reports.get_package_rows
+        read_org_ids = []
+
+        def spy_get_package_rows(org_ids=None):
+            read_org_ids.append(org_ids)
+            return get_package_rows(org_ids)
+        monkeypatch.setattr(reports, 'get_package_rows', spy_get_package_rows)
+
+        def assert_same_as_each():
+            # compared as cached, since the order of the score counts is not
+            # significant
+            for option_dict, report in \
+                    reports.openness_reports_for_all_combinations():
+                assert json.loads(json.dumps(report)) == json.loads(
+                    json.dumps(reports.openness_report(**option_dict)))
+
+        # the first time, all are read
+        assert_same_as_each()
+        assert read_org_ids == [None]
+        del read_org_ids[:]
+
+        # nothing has changed
+        assert_same_as_each()
+        assert read_org_ids == [[]]
+        del read_org_ids[:]
+
+        # a change of QA
+        office_datasets = reports.openness_for_organization(office['id'])
+        qa = model.Session.query(QA) \
+            .join(model.Package, QA.package_id == model.Package.id) \
+            .filter(model.Package.name ==
+                    office_datasets['table'][0]['dataset_name']).one()
+        qa.openness_score = 4
+        qa.updated = datetime.datetime.now()
+        qa_model.update_package_qa([qa.package_id])
+        model.Session.commit()
+        assert_same_as_each()
+        assert read_org_ids == [[office['id']]]
+        del read_org_ids[:]
+
+        # a new dataset
+        add_dataset(board, 0)
+        assert_same_as_each()
+        assert read_org_ids == [[board['id']]]
+        del read_org_ids[:]
+
+        # a purged dataset
+        purged = reports.openness_for_organization(agency['id'])
+        get_action('dataset_purge')(
+            {'ignore_auth': True},
+            {'id': purged['table'][0]['dataset_name']})
+        assert_same_as_each()
+        assert read_org_ids == [[agency['id']]]
+        del read_org_ids[:]
+
+        # a dataset moved without being modified
+        moved = model.Package.by_name(
+            reports.openness_for_organization(dept['id'])['table'][0]
+            ['dataset_name'])
+        model.Session.execute(
+            model.package_table.update()
+            .where(model.package_table.c.id == moved.id)
+            .values(owner_org=board['id']))
+        model.Session.commit()
+        model.Session.expire_all()
+        assert_same_as_each()
+        assert sorted(read_org_ids[0]) == sorted([dept['id'], board['id']])
+        del read_org_ids[:]
+
+    def test_incremental_change_committed_after_snapshot(self, orgs,
+                                                         monkeypatch):
+        dept, agency, office, board = orgs
+        monkeypatch.setattr(report_snapshot, 'is_enabled', lambda: True)
+        report_snapshot.clear()
+        reports.openness_reports_for_all_combinations()
+        # make the datasets older than the margin
+        hour = datetime.timedelta(hours=1)
+        model.Session.execute(QA.__table__.update()
+                              .values(updated=QA.updated - hour))
+        model.Session.execute(
+            model.package_table.update()
+            .values(metadata_modified=model.package_table.c.metadata_modified -
+                    hour))
+        model.Session.commit()
+        assert reports.get_changed_organizations(
+            report_snapshot.get(), [dept['id'], office['id']]) == []
+
+        # QA stamped before the snapshot was taken, but committed after it
+        qa = model.Session.query(QA) \
+            .join(model.Package, QA.package_id == model.Package.id) \
+            .filter(model.Package.owner_org == office['id']).first()
+        qa.updated = report_snapshot.get()['built'] - \
+            datetime.timedelta(minutes=1)
+        model.Session.commit()
+        assert reports.get_changed_organizations(
+            report_snapshot.get(), [dept['id'], office['id']]) == \
+            [office['id']]
@@ -0,0 +1,90 @@
+import logging
+import os
+
+import pytest
+from redis.exceptions import ConnectionError
+
+from ckan import model
+from ckantoolkit.tests import factories as ckan_factories
+
+import ckanext.qa.tasks
+import ckanext.qa.sniff_format
+from ckanext.qa import slowest
+from ckanext.qa import utils
+from ckanext.archiver.model import Archival
+
+
+def event(resource_id, total):
+    return {'event': 'resource_score', 'resource_id': resource_id,
+            'stages': {'sniff': total}, 'total': total, 'detectors': []}
+
+
+@pytest.mark.usefixtures('with_plugins', 'qa_tables')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+@pytest.mark.ckan_config('qa.slowest_size', '2')
+class TestSlowest():
+    @pytest.fixture(autouse=True)
+    def init_data(cls, ckan_config, monkeypatch):
+        monkeypatch.setattr(ckanext.qa.tasks, 'sniff_file_format',
+                            ckanext.qa.sniff_format.sniff_file_format)
+        slowest.clear()
+
+    def test_only_slowest_kept(self):
+        for resource_id, total in (('a', 1.0), ('b', 3.0), ('c', 2.0),
+                                   ('d', 0.5), ('c', 4.0)):
+            slowest.add(event(resource_id, total))
+
+        assert [(e['resource_id'], e['total'])
+                for e in slowest.get_slowest()] == [('c', 4.0), ('b', 3.0)]
+        assert len(slowest.get_slowest(limit=1)) == 1
+
+    def test_redis_py_2(self, monkeypatch):
+        # its zadd takes the members and scores as keyword arguments
+        calls = []
+
+        class Pipeline(object):
+            def zadd(self, key, *args, **kwargs):
+                calls.append((args, kwargs))
+        monkeypatch.setattr(slowest, 'REDIS_VERSION', (2, 10, 6))
+
+        slowest._zadd(Pipeline(), 'key', 'a', 1.0)
+
+        assert calls == [((), {'a': 1.0})]
+
+    def test_redis_error_logged(self, monkeypatch, caplog):
+        def connect_to_redis():
+            raise ConnectionError('Redis is down')
+        monkeypatch.setattr(slowest, '_connect_to_redis', connect_to_redis)
+
+        with caplog.at_level(logging.WARNING):
+            slowest.add(event('a', 1.0))
+
+        assert [record.levelname for record in caplog.records
+                if record.name == slowest.__name__] == ['WARNING']
+
+    def test_resource_score(self, capsys):
+        dataset = ckan_factories.Dataset(
+            license_id='uk-ogl', resources=[{'url': 'http://example.com/data'}])
+        resource = model.Resource.get(dataset['resources'][0]['id'])
+        archival = Archival.create(resource.id)
+        archival.cache_filepath = os.path.join(
+            os.path.dirname(__file__), 'data', 'weather_stations.tsv')
+        model.Session.add(archival)
+        model.Session.commit()
+
+        ckanext.qa.tasks.resource_score(resource)
+
+        [ledger_event] = slowest.get_slowest()
+        assert ledger_event['resource_id'] == resource.id
+        assert ledger_event['package_id'] == dataset['id']
+        assert ledger_event['format'] == 'TSV'
+        assert ledger_event['file_size'] == \
+            os.path.getsize(archival.cache_filepath)
+        assert ledger_event['magic_mime_type'].startswith('text/')
+        assert 'sniff' in ledger_event['stages']
+
+        utils.slowest()
+        output = capsys.readouterr()[0]
+        assert '/dataset/%s/resource/%s' % (dataset['name'], resource.id) \
+            in output
+        assert 'format=TSV' in output
@@ -1,10 +1,13 @@
+import io
 import os
 import pytest
 import logging
 
 from ckan import plugins as p
 
-from ckanext.qa.sniff_format import sniff_file_format, is_json, is_ttl, turtle_regex
+from ckanext.qa.sniff_format import sniff_file_format, is_json, get_json_format, is_ttl, turtle_regex, SniffContext, \
+    get_mime_type_from_signature, SIGNATURE_SIZE, inspect_binary_file, is_excel, get_delimited_format
+from ckanext.qa import ole2
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('ckan.sniff')
@@ -93,7 +96,13 @@ class TestSniffFormat:
         self.check_format('doc')
 
     def test_json(self):
-        self.check_format('json')
+        self.check_format('json', 'charge_points')
+
+    def test_json_newline_delimited(self):
+        self.check_format('json', 'air_quality_readings')
+
+    def test_geojson(self):
+        self.check_format('geojson')
 
     def test_ods(self):
         self.check_format('ods')
@@ -187,6 +196,9 @@ class TestSniffFormat:
     def test_psv(self):
         self.check_format('psv')
 
+    def test_tsv(self):
+        self.check_format('tsv')
+
     def test_wms_1_3(self):
         self.check_format('wms', 'afbi_get_capabilities.wms')
 
@@ -260,6 +272,49 @@ def test_is_json():
     # assert not is_json('[{"cat": [1]}2, 2]', log)
 
 
+def test_get_json_format():
+    assert get_json_format('{\n  "cat": {},\n  "dog": [ ]\n}\n') == {'format': 'JSON'}
+    # newline-delimited
+    assert get_json_format('{"cat": 6}\n{"dog": 5}\n') == {'format': 'JSON'}
+    assert get_json_format('[1, 2]\n[3, 4]') == {'format': 'JSON'}
+    assert not get_json_format('5\n6\n')
+    assert not get_json_format('{"cat": 6}\nhello')
+    assert not get_json_format('{"cat": 6} hello')
+    # truncated
+    assert get_json_format('{"cat": "bo') == {'format': 'JSON'}
+    assert get_json_format('[1, tr') == {'format': 'JSON'}
+    assert not get_json_format('[1, hello')
+    assert get_json_format('{"cat": "a \\"quoted\\" word"}') == {'format': 'JSON'}
+    assert not get_json_format('{"cat" 6}')
+    assert not get_json_format('[1,]')
+    assert not get_json_format('')
+    # GeoJSON
+    assert get_json_format('{"type": "FeatureCollection", "features": [') == {'format': 'GeoJSON'}
+    assert get_json_format('{"type": "Point", "coordinates": [1, 2]}') == {'format': 'GeoJSON'}
+    assert get_json_format('{"type": "Cat", "coordinates": [1, 2]}') == {'format': 'JSON'}
+    assert get_json_format('{"cat": {"type": "Point"}}') == {'format': 'JSON'}
+
+
+def test_get_delimited_format():
+    assert get_delimited_format('a,b,c\n1,2,3\n4,5,6\n') == {'format': 'CSV'}
+    assert get_delimited_format('a;b;c\n1;2;3\n4;5;6\n') == {'format': 'CSV'}
+    assert get_delimited_format('a\tb\tc\n1\t2\t3\n4\t5\t6\n') == {'format': 'TSV'}
+    assert get_delimited_format('a|b|c\n1|2|3\n4|5|6\n') == {'format': 'PSV'}
+    # delimiters in quoted fields don't count
+    assert get_delimited_format('name\tnotes\n' + 'bob\t"x, y"\n' * 12) == {'format': 'TSV'}
+    assert get_delimited_format('"a\tb","c\n\td"\n' * 12) == {'format': 'CSV'}
+    # the most cells wins a tie
+    assert get_delimited_format('1\tSmith, John\t2\n' * 12) == {'format': 'TSV'}
+    assert not get_delimited_format('"a,b,c"\n"d,e,f"\n')
+    assert not get_delimited_format('A line of text, with a comma.\nAnother line.\n' * 12)
+    assert not get_delimited_format('')
+    assert not get_delimited_format('a,b\x00c\n1,2\x003\n')
+    # the buffer is text (on python 2 too), decoded as ISO-8859-1
+    assert get_delimited_format(u'caf\xe9,b\n1,2\n3,4\n') == {'format': 'CSV'}
+    assert get_delimited_format(
+        u'a,b\n1,2\n3,4\n'.encode('utf-16').decode('ISO-8859-1')) == {'format': 'CSV'}
+
+
 def test_turtle_regex():
     template = '<subject> <predicate> %s .'
     assert turtle_regex().search(template % '<url>')
@@ -294,3 +349,104 @@ def test_is_ttl__num_triples():
     triple = '<subject> <predicate> <object>; <predicate> <object>.'
     assert not is_ttl('\n'.join([triple]*2))
     assert is_ttl('\n'.join([triple]*5))
+
+
+def test_sniff_context_text_matches_reading_the_file():
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    for filename in ('terrible_csv.txt', 'elec00.csv', 'index.html'):
+        filepath = os.path.join(fixture_data_dir, filename)
+        with SniffContext(filepath) as ctx:
+            for size in (100, 500, 10000, 100000):
+                with io.open(filepath, 'r', encoding='ISO-8859-1') as f:
+                    assert ctx.text(size) == f.read(size), (filename, size)
+
+
+def test_sniff_context_bytes_read():
+    filepath = os.path.join(os.path.dirname(__file__), 'data', 'elec00.csv')
+    with SniffContext(filepath) as ctx:
+        ctx.text(100)
+        ctx.text(50)
+        assert ctx.bytes_read == 100
+        ctx.text(10000)
+        assert ctx.bytes_read >= 10000
+        assert ctx.bytes_read < ctx.size
+
+
+def test_get_mime_type_from_signature():
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    expected_mime_types = {
+        'Abuse_of_Vulnerable_Adults_report_2009-10.pdf': 'application/pdf',
+        'jobs.xml': 'text/xml',
+        'os_products.atom_feed': 'text/xml',  # has a BOM
+        'cycle-area-list.csv.zip': 'application/zip',
+        '20101130_narrative_and_payscales.odt': 'application/vnd.oasis.opendocument.text',
+        # left to libmagic:
+        'decc_local_authority_data_xlsx.xlsx': None,
+        '6a7baac6-d363-4a9d-8e9d-e584f38c05c3.html': None,
+        'elec00.csv': None,
+    }
+    for filename, expected_mime_type in expected_mime_types.items():
+        with open(os.path.join(fixture_data_dir, filename), 'rb') as f:
+            head = f.read(SIGNATURE_SIZE)
+        assert get_mime_type_from_signature(head) == expected_mime_type, filename
+
+
+def test_sniff_file_format_same_with_and_without_signatures():
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    for filename in os.listdir(fixture_data_dir):
+        filepath = os.path.join(fixture_data_dir, filename)
+        assert sniff_file_format(filepath, use_signatures=True) == \
+            sniff_file_format(filepath, use_signatures=False), filename
+
+
+def test_ole2_creating_application():
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    expected_apps = {
+        'bis-quarterly-publications-dg-expenses-jul-sep-2010.doc': 'Microsoft Office Word',
+        'directors-org-chart-march-2012.ppt': 'Microsoft Office PowerPoint',
+        '10-p108-data-results-2010-finance-survey-mid-cap-businesses.xls': 'Microsoft Excel',
+        'ukti-admin-spend-nov-2011.xls': None,
+    }
+    for filename, expected_app in expected_apps.items():
+        with open(os.path.join(fixture_data_dir, filename), 'rb') as f:
+            doc = ole2.CompoundDocument(f)
+            assert doc.creating_application() == expected_app, filename
+
+
+def test_ole2_not_a_compound_document():
+    filepath = os.path.join(os.path.dirname(__file__), 'data', 'August-2010.xls')
+    with open(filepath, 'rb') as f:
+        with pytest.raises(ole2.CompoundDocumentError):
+            ole2.CompoundDocument(f)
+
+
+def test_inspect_binary_file():
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    expected_formats = {
+        'bis-quarterly-publications-dg-expenses-jul-sep-2010.doc': {'format': 'DOC'},
+        'directors-org-chart-march-2012.ppt': {'format': 'PPT'},
+        '10-p108-data-results-2010-finance-survey-mid-cap-businesses.xls': {'format': 'XLS'},
+        'HS2-ARP-00-GI-RW-00434_RCL_V4.shp': {'format': 'SHP'},
+        'August-2010.xls': None,
+        'Abuse_of_Vulnerable_Adults_report_2009-10.pdf': None,
+    }
+    for filename, expected_format in expected_formats.items():
+        with SniffContext(os.path.join(fixture_data_dir, filename)) as ctx:
+            assert inspect_binary_file(ctx) == expected_format, filename
+
+
+@pytest.mark.parametrize('validate', [False, True])
+def test_is_excel(validate):
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    expected = {
+        '10-p108-data-results-2010-finance-survey-mid-cap-businesses.xls': True,
+        'August-2010.xls': True,
+        'ukti-admin-spend-nov-2011.xls': True,
+        'bis-quarterly-publications-dg-expenses-jul-sep-2010.doc': False,
+        'directors-org-chart-march-2012.ppt': False,
+        'Abuse_of_Vulnerable_Adults_report_2009-10.pdf': False,
+        'spendover25kdownloadSep.csv': False,
+    }
+    for filename, expected_result in expected.items():
+        with SniffContext(os.path.join(fixture_data_dir, filename)) as ctx:
+            assert is_excel(ctx, validate=validate) == expected_result, filename
@@ -3,6 +3,7 @@ import requests
 import logging
 import urllib
 import datetime
+import os
 
 from ckan import model
 from ckan.logic import get_action
@@ -11,12 +12,16 @@ import ckan.lib.helpers as ckan_helpers
 from ckantoolkit.tests import factories as ckan_factories
 
 import ckanext.qa.tasks
+import ckanext.qa.sniff_cache
+import ckanext.qa.sniff_format
+import ckanext.qa.timing
 from ckanext.qa.tasks import resource_score, extension_variants
 import ckanext.archiver
 import ckanext.archiver.tasks
 from ckanext.qa import model as qa_model
 from ckanext.archiver import model as archiver_model
 from ckanext.archiver.model import Archival, Status
+from ckanext.qa.tests.fixtures import record_statements
 
 log = logging.getLogger(__name__)
 
@@ -313,6 +318,110 @@ class TestSaveQaResult():
         assert qa.archival_timestamp == qa_result['archival_timestamp']
         assert qa.updated == qa.updated
 
+    def test_existing_result_updated(self):
+        resource_dict = ckan_factories.Resource()
+        resource = model.Resource.get(resource_dict['id'])
+        ckanext.qa.tasks.save_qa_result(resource, self.get_qa_result())
+
+        qa = ckanext.qa.tasks.save_qa_result(
+            resource, self.get_qa_result(openness_score=2, format='XLS'))
+
+        assert qa.openness_score == 2
+        assert qa.format == 'XLS'
+        assert model.Session.query(qa_model.QA) \
+            .filter_by(resource_id=resource.id).count() == 1
+
+    def test_rescored(self):
+        dataset = ckan_factories.Dataset(
+            resources=[{'url': 'http://example.com/data.csv'}])
+        resource = model.Resource.get(dataset['resources'][0]['id'])
+        # held in the session, as when update_package_ gets it
+        qa = ckanext.qa.tasks.save_qa_result(resource, self.get_qa_result())
+        assert qa.openness_score == 3
+
+        qa = ckanext.qa.tasks.save_qa_result(
+            resource, self.get_qa_result(openness_score=1, format='TXT'))
+
+        assert qa.openness_score == 1
+        assert qa.format == 'TXT'
+
+    def test_many(self):
+        resources = [model.Resource.get(resource_dict['id'])
+                     for resource_dict in ckan_factories.Dataset(resources=[
+                         {'url': 'http://example.com/%i.csv' % i}
+                         for i in range(3)])['resources']]
+        ckanext.qa.tasks.save_qa_result(resources[0], self.get_qa_result())
+
+        ckanext.qa.tasks.save_qa_results([
+            (resource, self.get_qa_result(openness_score=i))
+            for i, resource in enumerate(resources)])
+
+        assert [qa_model.QA.get_for_resource(resource.id).openness_score
+                for resource in resources] == [0, 1, 2]
+
+    def test_package_qa_updated(self):
+        resources = [model.Resource.get(resource_dict['id'])
+                     for resource_dict in ckan_factories.Dataset(resources=[
+                         {'url': 'http://example.com/%i.csv' % i}
+                         for i in range(3)])['resources']]
+        package_id = resources[0].package_id
+
+        ckanext.qa.tasks.save_qa_results([
+            (resource, self.get_qa_result(
+                openness_score=score,
+                openness_score_reason='Scores %s' % score))
+            for resource, score in zip(resources, (1, 3, 1))])
+
+        package_qa = qa_model.PackageQA.get(package_id)
+        assert package_qa.openness_score == 3
+        assert package_qa.openness_score_reason == 'Scores 3'
+        assert package_qa.get_resource_score_counts() == {'1': 2, '3': 1}
+        assert package_qa.as_dict() == qa_model.aggregate_qa_for_a_dataset(
+            qa_model.QA.get_for_package(package_id))
+
+        ckanext.qa.tasks.save_qa_result(
+            resources[1], self.get_qa_result(openness_score=0))
+
+        model.Session.expire_all()
+        package_qa = qa_model.PackageQA.get(package_id)
+        assert package_qa.openness_score == 1
+        assert package_qa.get_resource_score_counts() == {'0': 1, '1': 2}
+
+    def test_number_of_queries(self):
+        resources = [model.Resource.get(resource_dict['id'])
+                     for resource_dict in ckan_factories.Dataset(resources=[
+                         {'url': 'http://example.com/%i.csv' % i}
+                         for i in range(3)])['resources']]
+
+        qa, statements = record_statements(
+            lambda: ckanext.qa.tasks.save_qa_result(resources[0],
+                                                    self.get_qa_result()))
+        _, statements_for_three = record_statements(
+            lambda: ckanext.qa.tasks.save_qa_results([
+                (resource, self.get_qa_result()) for resource in resources],
+                commit=False))
+
+        # save_qa_result has one more to get the QA it returns
+        assert len(statements_for_three) == len(statements) - 1
+        # the datasets aren't read, e.g. to log them
+        assert not [statement for statement in statements
+                    if 'FROM package ' in statement]
+
+    def test_repr_has_no_queries(self):
+        dataset = ckan_factories.Dataset(
+            resources=[{'url': 'http://example.com/data.csv'}])
+        resource = model.Resource.get(dataset['resources'][0]['id'])
+        qa = ckanext.qa.tasks.save_qa_result(resource, self.get_qa_result())
+
+        qa_repr, statements = record_statements(lambda: repr(qa))
+        assert statements == []
+        assert '/dataset/%s/resource/%s' % (dataset['id'], resource.id) \
+            in qa_repr
+
+        qa_with_package_name = qa.with_package_name()
+        assert '/dataset/%s/resource/%s' % (dataset['name'], resource.id) \
+            in str(qa_with_package_name)
+
 
 @pytest.mark.usefixtures('with_plugins')
 @pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
@@ -339,6 +448,138 @@ class TestUpdatePackage():
         assert qa.openness_score == 0
         assert qa.openness_score_reason == 'License not open'
 
+    def _test_dataset(self, monkeypatch):
+        self.reindexes = []
+        monkeypatch.setattr(ckanext.qa.tasks, '_update_search_index',
+                            self.reindexes.append)
+        return ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://example.com/file.csv', 'format': 'CSV'}])
+
+    def test_incremental_skips_unchanged(self, monkeypatch):
+        dataset = self._test_dataset(monkeypatch)
+
+        counts = ckanext.qa.tasks.update_package_(dataset['id'], incremental=True)
+        assert counts == {'rescored': 1, 'skipped': 0}
+        assert self.reindexes == [dataset['id']]
+
+        counts = ckanext.qa.tasks.update_package_(dataset['id'], incremental=True)
+        assert counts == {'rescored': 0, 'skipped': 1}
+        assert self.reindexes == [dataset['id']]
+
+    def test_incremental_rescores_changed(self, monkeypatch):
+        dataset = self._test_dataset(monkeypatch)
+        ckanext.qa.tasks.update_package_(dataset['id'], incremental=True)
+
+        resource = model.Resource.get(dataset['resources'][0]['id'])
+        resource.url = 'http://example.com/file.xls'
+        model.Session.commit()
+        counts = ckanext.qa.tasks.update_package_(dataset['id'], incremental=True)
+
+        assert counts == {'rescored': 1, 'skipped': 0}
+        assert len(self.reindexes) == 2
+        assert qa_model.QA.get_for_resource(resource.id).format == 'XLS'
+
+    def test_incremental_no_reindex_if_score_unchanged(self, monkeypatch):
+        dataset = self._test_dataset(monkeypatch)
+        ckanext.qa.tasks.update_package_(dataset['id'], incremental=True)
+
+        resource = model.Resource.get(dataset['resources'][0]['id'])
+        resource.format = 'XLS'  # the url extension takes precedence
+        model.Session.commit()
+        counts = ckanext.qa.tasks.update_package_(dataset['id'], incremental=True)
+
+        assert counts == {'rescored': 1, 'skipped': 0}
+        assert len(self.reindexes) == 1
+
+    def test_number_of_queries_does_not_depend_on_resources(self, monkeypatch):
+        monkeypatch.setattr(ckanext.qa.tasks, '_update_search_index',
+                            lambda package_id: None)
+        set_sniffed_format(None)
+        query_counts = []
+        for num_resources in (2, 10):
+            dataset = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+                {'url': 'http://example.com/file%i.csv' % i, 'format': 'CSV'}
+                for i in range(num_resources)])
+            for i, resource in enumerate(dataset['resources']):
+                archival = Archival.create(resource['id'])
+                archival.updated = TODAY
+                if i % 2:
+                    # a broken link keeps the format of its previous QA
+                    archival.is_broken = True
+                    archival.failure_count = 1
+                model.Session.add(archival)
+            model.Session.commit()
+            # first run creates the QA rows, second run updates them
+            query_counts.append(tuple(
+                len(record_statements(lambda: ckanext.qa.tasks.update_package_(
+                    dataset['id']))[1])
+                for run in range(2)))
+        assert query_counts[0] == query_counts[1]
+
+    def test_sniffing_in_threads_gives_same_results(self, monkeypatch):
+        monkeypatch.setattr(ckanext.qa.tasks, '_update_search_index',
+                            lambda package_id: None)
+        monkeypatch.setattr(ckanext.qa.tasks, 'sniff_file_format',
+                            ckanext.qa.sniff_format.sniff_file_format)
+        data_dir = os.path.join(os.path.dirname(__file__), 'data')
+        filenames = ['311011.csv', 'parks.geojson', 'weather_stations.tsv',
+                     'road_casualties.psv', 'does_not_exist.csv', '311011.csv']
+        dataset = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://example.com/data%i' % i} for i in range(len(filenames))])
+        for resource, filename in zip(dataset['resources'], filenames):
+            archival = Archival.create(resource['id'])
+            archival.cache_filepath = os.path.join(data_dir, filename)
+            archival.updated = TODAY
+            model.Session.add(archival)
+        model.Session.commit()
+
+        def get_results():
+            return [(qa.resource_id, qa.openness_score,
+                     qa.openness_score_reason, qa.format)
+                    for qa in model.Session.query(qa_model.QA)
+                    .filter_by(package_id=dataset['id'])
+                    .order_by(qa_model.QA.resource_id)]
+        ckanext.qa.tasks.update_package_(dataset['id'])
+        sequential_results = get_results()
+        model.Session.query(qa_model.QA) \
+            .filter_by(package_id=dataset['id']).delete()
+        model.Session.commit()
+        monkeypatch.setattr(ckanext.qa.tasks, 'get_sniff_threads', lambda: 4)
+        ckanext.qa.tasks.update_package_(dataset['id'])
+
+        assert get_results() == sequential_results
+        assert set(format_ for _, _, _, format_ in sequential_results) == \
+            set(['CSV', 'GeoJSON', 'TSV', None])
+
+    def test_broken_links_not_sniffed_in_threads(self, monkeypatch):
+        sniffed = []
+
+        def sniff_file_format(filepath):
+            sniffed.append(filepath)
+        monkeypatch.setattr(ckanext.qa.tasks, 'sniff_file_format',
+                            sniff_file_format)
+        data_dir = os.path.join(os.path.dirname(__file__), 'data')
+        archivals = []
+        for resource_id, filename, is_broken in (
+                ('a', '311011.csv', False), ('b', 'parks.geojson', True)):
+            archival = Archival(resource_id=resource_id, is_broken=is_broken,
+                                cache_filepath=os.path.join(data_dir, filename))
+            archivals.append(archival)
+
+        sniffed_formats = ckanext.qa.tasks.sniff_archived_files(archivals, 4)
+
+        assert list(sniffed_formats) == ['a']
+        assert sniffed == [os.path.join(data_dir, '311011.csv')]
+
+    def test_not_incremental(self, monkeypatch):
+        dataset = self._test_dataset(monkeypatch)
+        ckanext.qa.tasks.update_package_(dataset['id'])
+
+        counts = ckanext.qa.tasks.update_package_(dataset['id'])
+
+        assert counts == {'rescored': 1, 'skipped': 0}
+        assert len(self.reindexes) == 2
+
 
 @pytest.mark.usefixtures('with_plugins')
 @pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
@@ -364,3 +605,136 @@ class TestUpdateResource():
         assert qa
         assert qa.openness_score == 0
         assert qa.openness_score_reason == 'License not open'
+
+
+@pytest.mark.usefixtures('with_plugins', 'qa_tables')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+@pytest.mark.ckan_config('qa.sniff_cache_size', '2')
+class TestSniffCache():
+    def _test_resource(self, hash_):
+        pkg = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'anything', 'format': 'TXT', 'description': 'Test'}])
+        res_id = pkg['resources'][0]['id']
+        archival = Archival.create(res_id)
+        archival.cache_filepath = __file__  # just needs to exist
+        archival.hash = hash_
+        archival.updated = TODAY
+        model.Session.add(archival)
+        model.Session.commit()
+        return model.Resource.get(res_id)
+
+    def test_same_contents_not_sniffed_again(self):
+        set_sniffed_format('CSV')
+        assert resource_score(self._test_resource('abc'))['format'] == 'CSV'
+        hits = ckanext.qa.sniff_cache.stats['hits']
+        set_sniffed_format('XLS')
+        assert resource_score(self._test_resource('abc'))['format'] == 'CSV'
+        assert ckanext.qa.sniff_cache.stats['hits'] == hits + 1
+        assert resource_score(self._test_resource('def'))['format'] == 'XLS'
+
+    def test_detector_version_change(self, monkeypatch):
+        set_sniffed_format('CSV')
+        resource_score(self._test_resource('abc'))
+        monkeypatch.setattr(ckanext.qa.sniff_cache, 'SNIFF_DETECTOR_VERSION', 0)
+        set_sniffed_format('XLS')
+        assert resource_score(self._test_resource('abc'))['format'] == 'XLS'
+
+    def _keys(self):
+        return [entry.key for entry in model.Session.query(qa_model.SniffResult)
+                .order_by(qa_model.SniffResult.key)]
+
+    def test_least_recently_used_evicted(self, monkeypatch):
+        monkeypatch.setattr(ckanext.qa.sniff_cache, 'EVICTION_CHECK_INTERVAL', 2)
+        monkeypatch.setitem(ckanext.qa.sniff_cache._state,
+                            'puts_since_eviction_check', 0)
+        for key in ('a', 'b', 'c'):
+            ckanext.qa.sniff_cache.put(key, {'format': 'CSV'})
+        model.Session.commit()
+        # it is only checked every other put
+        assert self._keys() == ['a', 'b', 'c']
+
+        ckanext.qa.sniff_cache.put('d', {'format': 'CSV'})
+        model.Session.commit()
+        assert self._keys() == ['c', 'd']
+
+    def test_stored_by_another_worker(self):
+        # another worker stores a result for the same contents meanwhile
+        with model.meta.engine.begin() as connection:
+            connection.execute(qa_model.SniffResult.__table__.insert().values(
+                key='abc', result='{"format": "XLS"}',
+                detector_version=ckanext.qa.sniff_cache.SNIFF_DETECTOR_VERSION))
+
+        ckanext.qa.sniff_cache.put('abc', {'format': 'CSV'})
+        model.Session.commit()
+
+        assert ckanext.qa.sniff_cache.get('abc') == (True, {'format': 'XLS'})
+
+
+@pytest.mark.usefixtures('with_plugins', 'qa_tables')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+@pytest.mark.ckan_config('qa.timing_sink', 'ckanext.qa.timing:MemorySink')
+class TestTiming():
+    @pytest.fixture(autouse=True)
+    def init_data(cls, ckan_config, monkeypatch):
+        monkeypatch.setattr(ckanext.qa.tasks, '_update_search_index',
+                            lambda package_id: None)
+        monkeypatch.setattr(ckanext.qa.tasks, 'sniff_file_format',
+                            ckanext.qa.sniff_format.sniff_file_format)
+        cls.events = ckanext.qa.timing.get_sink().events
+        del cls.events[:]
+
+    def _test_dataset(self):
+        data_dir = os.path.join(os.path.dirname(__file__), 'data')
+        dataset = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://example.com/data'},
+            {'url': 'http://example.com/data.csv'}])
+        archival = Archival.create(dataset['resources'][0]['id'])
+        archival.cache_filepath = os.path.join(data_dir, 'weather_stations.tsv')
+        archival.updated = TODAY
+        model.Session.add(archival)
+        model.Session.commit()
+        return dataset
+
+    def test_update_package(self):
+        dataset = self._test_dataset()
+
+        ckanext.qa.tasks.update_package_(dataset['id'])
+
+        assert [event['event'] for event in self.events] == \
+            ['resource_score', 'resource_score', 'update_package']
+        sniffed, not_archived, package_event = self.events
+        assert sniffed['resource_id'] == dataset['resources'][0]['id']
+        assert sniffed['format'] == 'TSV'
+        assert list(sniffed['stages']) == ['link_check', 'sniff', 'licence']
+        detectors = [name for name, duration in sniffed['detectors']]
+        assert 'get_delimited_format' in detectors
+        assert list(not_archived['stages']) == \
+            ['link_check', 'sniff', 'format_fallbacks', 'licence']
+        assert not_archived['detectors'] == []
+        assert list(package_event['stages']) == \
+            ['prefetch', 'score', 'save', 'reindex']
+        assert package_event['rescored'] == 2
+        assert package_event['total'] >= package_event['stages']['score']
+
+    def test_sniffing_in_threads(self, monkeypatch):
+        monkeypatch.setattr(ckanext.qa.tasks, 'get_sniff_threads', lambda: 2)
+        dataset = self._test_dataset()
+
+        ckanext.qa.tasks.update_package_(dataset['id'])
+
+        sniffed = self.events[0]
+        assert sniffed['format'] == 'TSV'
+        assert 'get_delimited_format' in \
+            [name for name, duration in sniffed['detectors']]
+        assert 'sniff_in_threads' in self.events[-1]['stages']
+
+    def test_update_resource(self):
+        dataset = self._test_dataset()
+
+        ckanext.qa.tasks.update_resource_(dataset['resources'][0]['id'])
+
+        assert [event['event'] for event in self.events] == \
+            ['resource_score', 'update_resource']
+        assert list(self.events[0]['stages']) == \
+            ['archival', 'link_check', 'sniff', 'licence']
+        assert list(self.events[1]['stages']) == ['score', 'save', 'reindex']
@@ -0,0 +1,157 @@
+'''
+Timing of the stages of QA, to show where the time goes in a slow QA job.
+
+A Timer collects the durations of the stages of a piece of work (e.g. scoring
+a resource), plus which of the sniffing detectors ran and how long each took,
+and then emits them as one event to the configured sink.
+
+The sink is set with config option qa.timing_sink:
+
+* log - (default) logs each event as a line of JSON
+* none - timings are not recorded
+* a class, as "module:ClassName", whose instances have a method emit(event)
+  e.g. to aggregate percentiles. MemorySink is one for tests.
+
+An event is a dict like:
+
+    {'event': 'resource_score', 'resource_id': '...',
+     'stages': {'archival': 0.0012, 'sniff': 0.0231, ...},
+     'total': 0.0264,
+     'detectors': [['get_mime_type_from_magic', 0.0152], ...],
+     ...}
+
+with durations in seconds.
+'''
+import functools
+import importlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ckan.plugins.toolkit import config
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# The Timer that the detectors running on each thread record to, if any
+_local = threading.local()
+
+_sinks = {}  # sink instances, keyed by the config value
+
+
+class LogSink(object):
+    def emit(self, event):
+        log.info('QA timing: %s', json.dumps(event))
+
+
+class MemorySink(object):
+    '''Keeps the events in a list, for tests.'''
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+
+def get_sink():
+    '''Returns the configured sink, or None if timing is off.'''
+    sink_name = config.get('qa.timing_sink', 'log')
+    if sink_name not in _sinks:
+        if sink_name == 'none':
+            _sinks[sink_name] = None
+        elif sink_name == 'log':
+            _sinks[sink_name] = LogSink()
+        else:
+            module_name, class_name = sink_name.split(':')
+            sink_class = getattr(importlib.import_module(module_name),
+                                 class_name)
+            _sinks[sink_name] = sink_class()
+    return _sinks[sink_name]
+
+
+class Timer(object):
+    '''Times the stages of a piece of work, to emit as one event.
+
+    e.g.
+    >>> timer = Timer('resource_score', resource_id=resource.id)
+    >>> with timer.stage('sniff'), timer.record_detectors():
+    ...     sniff_file_format(filepath)
+    >>> timer.emit(score=3)
+    '''
+    def __init__(self, event, **fields):
+        self.fields = OrderedDict(event=event)
+        self.fields.update(fields)
+        self.stages = OrderedDict()
+        self.detectors = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, duration):
+        self.stages[name] = self.stages.get(name, 0) + duration
+
+    @contextmanager
+    def record_detectors(self):
+        '''Records the detectors that run on this thread (see @detector), and
+        anything they note().'''
+        previous_timer = getattr(_local, 'timer', None)
+        _local.timer = self
+        try:
+            yield
+        finally:
+            _local.timer = previous_timer
+
+    def merge(self, timer):
+        '''Adds the stages, detectors and noted fields of another Timer.'''
+        for name, duration in timer.stages.items():
+            self.add(name, duration)
+        self.detectors.extend(timer.detectors)
+        for name, value in timer.fields.items():
+            self.fields.setdefault(name, value)
+
+    def emit(self, **fields):
+        sink = get_sink()
+        if sink is not None:
+            sink.emit(self.get_event(**fields))
+
+    def get_event(self, **fields):
+        event = OrderedDict(self.fields)
+        event.update(fields)
+        event['stages'] = OrderedDict(
+            (name, round(duration, 6)) for name, duration in self.stages.items())
+        event['total'] = round(sum(self.stages.values()), 6)
+        event['detectors'] = [[name, round(duration, 6)]
+                              for name, duration in self.detectors]
+        return event
+
+
+def detector(func):
+    '''Decorator for the sniffing detector functions, which records the time
+    each call takes, when a Timer is recording detectors on this thread.'''
+    @functools.wraps(func)
+    def timed_func(*args, **kwargs):
+        timer = getattr(_local, 'timer', None)
+        if timer is None:
+            return func(*args, **kwargs)
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timer.detectors.append((func.__name__, time.time() - start))
+    return timed_func
+
+
+def note(name, value):
+    '''Adds a field to the event of the Timer recording detectors on this
+    thread, if there is one. e.g. the file's mimetype'''
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.fields[name] = value
@@ -11,9 +11,9 @@ def init_db():
     init_tables(model.meta.engine)
 
 
-def update(ids, queue):
+def update(ids, queue, incremental=False):
     from ckan import model
-    from ckanext.qa import lib
+    from ckanext.qa import lib, reindex
     packages = []
     resources = []
     if len(ids) > 0:
@@ -75,7 +75,7 @@ def update(ids, queue):
 
     log.info('Queue: %s', queue)
     for package in packages:
-        lib.create_qa_update_package_task(package, queue)
+        lib.create_qa_update_package_task(package, queue, incremental)
         log.info('Queuing dataset %s (%s resources)',
                  package.name, len(package.resources))
 
@@ -84,6 +84,10 @@ def update(ids, queue):
         log.info('Queuing resource %s/%s', package.name, resource.id)
         lib.create_qa_update_task(resource, queue)
 
+    if reindex.get_batch_size() > 1:
+        # reindex the last batch, once the jobs queued before it are done
+        lib.create_qa_flush_search_index_task(queue)
+
     log.info('Completed queueing')
 
 
@@ -117,6 +121,45 @@ def view(package_ref=None):
                                               row.error))
 
 
+def slowest(limit=20, clear=False):
+    from ckan import model
+    from ckanext.qa import slowest as ledger
+
+    if clear:
+        ledger.clear()
+        print('Cleared the slowest resources')
+        return
+    if not ledger.is_enabled():
+        print('The slowest resources are not being recorded - set '
+              'qa.slowest_size in the config')
+    events = ledger.get_slowest(limit)
+    print('%i slowest resources to score:' % len(events))
+    for event in events:
+        package = model.Package.get(event.get('package_id'))
+        print('%8.3fs /dataset/%s/resource/%s' % (
+              event['total'], package.name if package else event.get('package_id'),
+              event['resource_id']))
+        print('          format=%s size=%s magic=%s' % (
+              event.get('format'), event.get('file_size'),
+              event.get('magic_mime_type')))
+        print('          stages: %s' % ' '.join(
+              '%s=%.3fs' % stage for stage in event['stages'].items()))
+        detectors = sorted(event['detectors'], key=lambda d: -d[1])[:3]
+        if detectors:
+            print('          slowest detectors: %s' % ' '.join(
+                  '%s=%.3fs' % (name, duration) for name, duration in detectors))
+
+
+def rebuild_package_qa():
+    from ckan import model
+    from ckanext.qa import model as qa_model
+
+    num_packages = qa_model.rebuild_package_qa()
+    model.Session.commit()
+    print('Rebuilt the QA of %i datasets from the QA of their resources'
+          % num_packages)
+
+
 def clean():
     from ckan import model
 